@@ -16,7 +16,9 @@
 # Copyright (C) 2011 Simon Newton
 # The handlers for the admin page.
 
+import change_log
 import common
+import facet_counts
 from data.controller_data import CONTROLLER_DATA
 from data.manufacturer_data import MANUFACTURER_DATA
 from data.model_data import DEVICE_MODEL_DATA
@@ -25,12 +27,17 @@ from data.pid_data import ESTA_PIDS, MANUFACTURER_PIDS
 from data.product_categories import PRODUCT_CATEGORIES
 from data.software_data import SOFTWARE_DATA
 from data.splitter_data import SPLITTER_DATA
-import datetime
 import html_differ
+import index_stats
+import legacy_data
 import logging
 import memcache_keys
 import model_loader
+import page_cache
+import pid_search
 import product_loader
+import responder_search
+import search_index
 import timestamp_keys
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
@@ -41,22 +48,7 @@ from google.appengine.ext.webapp import template
 from model import *
 from utils import StringToInt
 from pid_loader import PidLoader
-
-
-def UpdateModificationTime(timestamp_name):
-  """Update a particular timestamp."""
-  query = LastUpdateTime.all()
-  query.filter('name = ', timestamp_name)
-  result = query.fetch(1)
-  if not result:
-    result = LastUpdateTime(name = timestamp_name)
-  else:
-    result = result[0]
-  result.update_time = datetime.datetime.now()
-  result.put()
-
-  # delete the index info cache
-  memcache.delete(memcache_keys.INDEX_INFO)
+from update_times import UpdateModificationTime
 
 
 class BaseAdminPageHandler(webapp.RequestHandler):
@@ -97,9 +89,9 @@ class AdminPageHandler(BaseAdminPageHandler):
     manufacturers_to_delete = []
     # invalidate the cache now
     memcache.delete(memcache_keys.MANUFACTURER_CACHE_KEY)
-    memcache.delete(memcache_keys.MANUFACTURER_MODEL_COUNTS)
-    memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
     added = removed = updated = errors = 0
+    # esta id to new name
+    renamed = {}
 
     for manufacturer in Manufacturer.all():
       id = manufacturer.esta_id
@@ -110,7 +102,9 @@ class AdminPageHandler(BaseAdminPageHandler):
         if new_name != manufacturer.name:
           logging.info('Updating %s -> %s' % (manufacturer.name, new_name))
           manufacturer.name = new_name
+          change_log.MarkModified(manufacturer)
           manufacturer.put()
+          renamed[id] = new_name
           updated += 1
       else:
         manufacturers_to_delete.append(manufacturer)
@@ -126,8 +120,11 @@ class AdminPageHandler(BaseAdminPageHandler):
         continue
 
       logging.info('adding %d (%s)' % (manufacturer_id, manufacturer_name))
-      manufacturer = Manufacturer(esta_id = manufacturer_id,
-                                  name = manufacturer_name)
+      manufacturer = Manufacturer(
+          key_name = Manufacturer.KeyName(manufacturer_id),
+          esta_id = manufacturer_id,
+          name = manufacturer_name)
+      change_log.MarkModified(manufacturer)
       manufacturer.put()
       added += 1
 
@@ -136,19 +133,31 @@ class AdminPageHandler(BaseAdminPageHandler):
       logging.info('removing %s' % manufacturer.name)
       manufacturer.delete()
       removed += 1
+    change_log.RecordDeletions(
+        change_log.MANUFACTURER,
+        [{'id': m.esta_id} for m in manufacturers_to_delete])
+    facet_counts.UpdateNames(facet_counts.MANUFACTURER_FACETS, renamed)
+    if renamed:
+      # the manufacturer names are part of the search terms
+      pid_search.ScheduleRebuild()
+      responder_search.ScheduleRebuild()
     logging.info('update complete')
     UpdateModificationTime(timestamp_keys.MANUFACTURERS)
     return ('Manufacturers: added %d, removed %d, updated %d, errors %d' %
             (added, removed, updated, errors))
 
   def ClearPids(self):
-    memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-    memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
+    memcache.delete(memcache_keys.PID_NAMES)
     for item in Command.all():
       item.delete()
 
     for item in Pid.all():
       item.delete()
+    change_log.RecordClear(change_log.PID)
+    search_index.Remove(pid_search.KIND)
+    facet_counts.Clear(facet_counts.MANUFACTURER_PIDS)
+    index_stats.Rebuild()
+    UpdateModificationTime(timestamp_keys.PIDS)
     return ''
 
   def ClearManufacturerPids(self):
@@ -157,23 +166,41 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     count = 0
     if manufacturer is not None:
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
-
+      keys = []
       for pid in manufacturer.pid_set:
-        if pid.discovery_command:
-          pid.discovery_command.delete()
-        if pid.get_command:
-          pid.get_command.delete()
-        if pid.set_command:
-          pid.set_command.delete()
-        pid.delete()
+        keys.append(pid.key())
+        keys.append(search_index.EntryKey(pid_search.KIND, pid.key()))
+        if legacy_data.Exists(legacy_data.COMMANDS):
+          for command_type in Pid.COMMAND_TYPES:
+            prop = Pid.properties()['%s_command' % command_type]
+            command_key = prop.get_value_for_datastore(pid)
+            if command_key:
+              keys.append(command_key)
         count += 1
+      db.delete(keys)
+      change_log.RecordClear(change_log.PID,
+                             {'manufacturer_id': manufacturer.esta_id})
+      facets = facet_counts.FacetUpdater()
+      facets.Adjust(facet_counts.MANUFACTURER_PIDS, manufacturer.esta_id,
+                    manufacturer.name, -count)
+      facets.Apply()
+      if manufacturer.esta_id != index_stats.ESTA_ID:
+        index_stats.Adjust(manufacturer_pids=-count)
+      memcache.delete(memcache_keys.PID_NAMES)
+      UpdateModificationTime(timestamp_keys.PIDS)
     return 'Deleted %d PIDs' % count
 
+  def RebuildFacetCounts(self):
+    """Recount all the sidebar data from scratch."""
+    facets = ([facet_counts.CATEGORY_MODELS, facet_counts.TAG_MODELS] +
+              facet_counts.MANUFACTURER_FACETS +
+              [t for m, t in facet_counts.PRODUCT_FACETS.itervalues()])
+    for facet in facets:
+      facet_counts.Rebuild(facet)
+    return 'Rebuilt %d facets' % len(facets)
+
   def FlushCache(self):
     keys = [
-        memcache_keys.PRODUCT_COUNT_KEY,
         memcache_keys.MANUFACTURER_MODEL_COUNTS,
         memcache_keys.CATEGORY_MODEL_COUNTS,
         memcache_keys.TAG_MODEL_COUNTS,
@@ -181,6 +208,8 @@ class AdminPageHandler(BaseAdminPageHandler):
     ]
     for key in keys:
       memcache.delete(key)
+    common.InvalidateReferenceData()
+    page_cache.Invalidate()
     return ''
 
   def LoadPids(self):
@@ -191,8 +220,9 @@ class AdminPageHandler(BaseAdminPageHandler):
         modified += 1
 
     if modified > 0:
+      loader.ApplyFacetChanges()
+      common.BuildPidNames()
       UpdateModificationTime(timestamp_keys.PIDS)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
 
     return 'Added / Updated %d PIDs' % modified
 
@@ -204,6 +234,24 @@ class AdminPageHandler(BaseAdminPageHandler):
     task = taskqueue.Task(method='GET', url='/tasks/rank_devices')
     task.add()
 
+  def MigratePidCommands(self):
+    task = taskqueue.Task(method='GET', url='/tasks/migrate_pid_commands')
+    task.add()
+
+  def MigrateEntityKeys(self):
+    task = taskqueue.Task(method='GET', url='/tasks/migrate_entity_keys')
+    task.add()
+
+  def RebuildPidSearchIndex(self):
+    pid_search.ScheduleRebuild()
+
+  def RebuildResponderSearchIndex(self):
+    responder_search.ScheduleRebuild()
+
+  def UpdateLatestSoftware(self):
+    task = taskqueue.Task(method='GET', url='/tasks/update_latest_software')
+    task.add()
+
   def LoadManufacturerPids(self):
     loader = PidLoader()
     modified = 0
@@ -213,14 +261,14 @@ class AdminPageHandler(BaseAdminPageHandler):
           modified += 1
 
     if modified > 0:
+      loader.ApplyFacetChanges()
+      index_stats.Adjust(manufacturer_pids=loader.AddedCount())
+      common.BuildPidNames()
       UpdateModificationTime(timestamp_keys.PIDS)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-      memcache.delete(memcache_keys.MANUFACTURER_PID_COUNTS)
 
     return 'Modified %d PIDs' % modified
 
   def ClearModels(self):
-    memcache.delete(memcache_keys.MODEL_COUNT_KEY)
     for item in Responder.all():
       item.delete()
 
@@ -232,17 +280,25 @@ class AdminPageHandler(BaseAdminPageHandler):
 
     for item in ResponderTagRelationship.all():
       item.delete()
+
+    change_log.RecordClear(change_log.RESPONDER)
+    search_index.Remove(responder_search.KIND)
+    # the PID index refers to the responders
+    db.delete(PidSupportShard.all(keys_only=True).fetch(None))
+    db.delete(ResponderChange.all(keys_only=True).fetch(None))
+    for facet in (facet_counts.MANUFACTURER_MODELS,
+                  facet_counts.CATEGORY_MODELS,
+                  facet_counts.TAG_MODELS):
+      facet_counts.Clear(facet)
+    index_stats.Rebuild()
+    UpdateModificationTime(timestamp_keys.DEVICES)
     return ''
 
   def UpdateModels(self):
     loader = model_loader.ModelLoader(DEVICE_MODEL_DATA)
     added, updated = loader.Update()
     if added or updated:
-      memcache.delete(memcache_keys.INDEX_INFO)
-      memcache.delete(memcache_keys.PRODUCT_COUNT_KEY)
-      memcache.delete(memcache_keys.MANUFACTURER_MODEL_COUNTS)
-      memcache.delete(memcache_keys.CATEGORY_MODEL_COUNTS)
-      memcache.delete(memcache_keys.TAG_MODEL_COUNTS)
+      index_stats.Adjust(responders=len(added))
 
     UpdateModificationTime(timestamp_keys.DEVICES)
     return ('Models:\nAdded: %s\nUpdated: %s' %
@@ -287,6 +343,9 @@ class AdminPageHandler(BaseAdminPageHandler):
       logging.info('removing %s' % category.name)
       category.delete()
       removed += 1
+
+    if added or removed or updated:
+      common.InvalidateReferenceData()
     logging.info('update complete')
     return ('categories: added %d, removed %d, updated %d' %
             (added, removed, updated))
@@ -338,6 +397,11 @@ class AdminPageHandler(BaseAdminPageHandler):
         if key in keys_to_blobs:
           del keys_to_blobs[key]
 
+    for snapshot in ExportSnapshot.all():
+      for blob in (snapshot.raw_data, snapshot.gzip_data):
+        if blob.key() in keys_to_blobs:
+          del keys_to_blobs[blob.key()]
+
     for key, blob_info in keys_to_blobs.iteritems():
       logging.info('deleting %s' % key)
       blob_info.delete()
@@ -369,76 +433,63 @@ class AdminPageHandler(BaseAdminPageHandler):
     else:
       return 'No images to fetch'
 
-  def ClearProductType(self, product_class):
+  def ClearProductType(self, product_class, timestamp_key):
     """Delete all instances of a product class."""
     for splitter in product_class.all():
       for tag in splitter.tag_set:
         tag.delete()
       splitter.delete()
+    change_log.RecordClear(change_log.PRODUCT,
+                           {'type': product_class.class_name()})
+    for facet in facet_counts.PRODUCT_FACETS[product_class.class_name()]:
+      facet_counts.Clear(facet)
+    index_stats.Rebuild()
+    UpdateModificationTime(timestamp_key)
     return ''
 
-  def LoadProductType(self, data, product_type, memcache_keys, timestamp_key):
+  def LoadProductType(self, data, product_type, timestamp_key):
     """Load products from data.
 
     Args:
       data: The data to load
       product_type: the subclass to use
-      memcache_keys: a list of keys to invalidate after loading
       timestamp_key: a timestamp key to update.
     """
     loader = product_loader.ProductLoader(data, product_type)
     added, updated = loader.Update()
     if added or updated:
-       for key in memcache_keys:
-         memcache.delete(key)
+       index_stats.Adjust(products=len(added))
 
     UpdateModificationTime(timestamp_key)
     return ('Products:\nAdded: %s\nUpdated: %s' %
             (', '.join(added), ', '.join(updated)))
 
   def ClearControllers(self):
-    return self.ClearProductType(Controller)
+    return self.ClearProductType(Controller, timestamp_keys.CONTROLLERS)
 
   def UpdateControllers(self):
-    return self.LoadProductType(
-        CONTROLLER_DATA,
-        Controller,
-        [memcache_keys.MANUFACTURER_CONTROLLER_COUNTS,
-         memcache_keys.TAG_CONTROLLER_COUNTS],
-        timestamp_keys.CONTROLLERS)
+    return self.LoadProductType(CONTROLLER_DATA, Controller,
+                                timestamp_keys.CONTROLLERS)
 
   def ClearNodes(self):
-    return self.ClearProductType(Node)
+    return self.ClearProductType(Node, timestamp_keys.NODES)
 
   def UpdateNodes(self):
-    return self.LoadProductType(
-        NODE_DATA,
-        Node,
-        [memcache_keys.MANUFACTURER_NODE_COUNTS,
-         memcache_keys.TAG_NODE_COUNTS],
-        timestamp_keys.NODES)
+    return self.LoadProductType(NODE_DATA, Node, timestamp_keys.NODES)
 
   def ClearSplitters(self):
-    return self.ClearProductType(Splitter)
+    return self.ClearProductType(Splitter, timestamp_keys.SPLITTERS)
 
   def UpdateSplitters(self):
-    return self.LoadProductType(
-        SPLITTER_DATA,
-        Splitter,
-        [memcache_keys.MANUFACTURER_SPLITTER_COUNTS,
-         memcache_keys.TAG_SPLITTER_COUNTS],
-        timestamp_keys.SPLITTERS)
+    return self.LoadProductType(SPLITTER_DATA, Splitter,
+                                timestamp_keys.SPLITTERS)
 
   def ClearSoftware(self):
-    return self.ClearProductType(Software)
+    return self.ClearProductType(Software, timestamp_keys.SOFTWARE)
 
   def UpdateSoftware(self):
-    return self.LoadProductType(
-        SOFTWARE_DATA,
-        Software,
-        [memcache_keys.MANUFACTURER_SOFTWARE_COUNTS,
-         memcache_keys.TAG_SOFTWARE_COUNTS],
-        timestamp_keys.SOFTWARE)
+    return self.LoadProductType(SOFTWARE_DATA, Software,
+                                timestamp_keys.SOFTWARE)
 
   def HandleRequest(self):
     ACTIONS = {
@@ -455,10 +506,16 @@ class AdminPageHandler(BaseAdminPageHandler):
         'initiate_image_fetch': self.InitiateImageFetch,
         'load_mp': self.LoadManufacturerPids,
         'load_p': self.LoadPids,
+        'migrate_commands': self.MigratePidCommands,
+        'migrate_keys': self.MigrateEntityKeys,
         'rank_devices': self.RankDevices,
+        'rebuild_facets': self.RebuildFacetCounts,
+        'rebuild_pid_search': self.RebuildPidSearchIndex,
+        'rebuild_responder_search': self.RebuildResponderSearchIndex,
         'responder_pid_index': self.BuildResponderPidIndex,
         'update_categories': self.UpdateProductCategories,
         'update_controllers': self.UpdateControllers,
+        'update_latest_software': self.UpdateLatestSoftware,
         'update_m': self.UpdateManufacturers,
         'update_models': self.UpdateModels,
         'update_nodes': self.UpdateNodes,
@@ -539,8 +596,13 @@ class ResponderModerator(BaseAdminPageHandler):
 
     updater = model_loader.ModelUpdater()
     was_added, was_changed = updater.UpdateResponder(manufacturer, model_data)
+    updater.ApplyFacetChanges()
     logging.info('Was added %s' % was_added)
     logging.info('Was changed %s' % was_changed)
+    if was_added:
+      index_stats.Adjust(responders=1)
+    if was_added or was_changed:
+      UpdateModificationTime(timestamp_keys.DEVICES)
 
     # finally mark this one as done
     responder_info.processed = True
@@ -831,6 +893,7 @@ class AdjustTestScore(BaseAdminPageHandler):
             (responder.model_description, rating_int))
         responder.rdm_responder_rating = db.Rating(rating_int)
         responder.put()
+        page_cache.Invalidate()
 
     self.response.headers['Content-Type'] = 'text/html'
     self.response.out.write(template.render(
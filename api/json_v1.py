@@ -17,10 +17,17 @@
 # Version 1 of the JSON API.
 
 from model import *
+import change_log
 import common
+import facet_counts
 import json
+import legacy_data
 import logging
 import memcache_keys
+import pid_definitions
+import pid_search
+import pid_usage
+import responder_search
 import timestamp_keys
 import utils
 from google.appengine.api import memcache
@@ -34,6 +41,8 @@ class ManufacturerList(webapp.RequestHandler):
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
     self.response.headers['Cache-Control'] = 'public; max-age=300;'
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS]):
+      return
 
     response = memcache.get(memcache_keys.MANUFACTURER_CACHE_KEY)
     if response is None:
@@ -55,6 +64,8 @@ class ManufacturerList(webapp.RequestHandler):
 class ManufacturerLookup(webapp.RequestHandler):
   """Query on manufacturer ID."""
   def get(self):
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS]):
+      return
     manufacturer = common.GetManufacturer(self.request.get('manufacturer'))
     if manufacturer is None:
       self.error(404)
@@ -72,19 +83,23 @@ class ManufacturerLookup(webapp.RequestHandler):
 class ResponderFirmware(webapp.RequestHandler):
   """Return the latest firmware for a responder."""
   def get(self):
+    if common.CheckNotModified(self, [timestamp_keys.DEVICES,
+                                      timestamp_keys.MANUFACTURERS]):
+      return
     responder = common.LookupModel(self.request.get('manufacturer'),
                                     self.request.get('model'))
     if responder is None:
       self.error(404)
       return
 
-    version = common.GetLatestSoftware(responder);
-    if version is None:
+    common.LoadLatestSoftware([responder])
+    if responder.latest_software_version_id is None:
       self.error(404)
+      return
 
     output = {
-      'version': version.version_id,
-      'label' : version.label,
+      'version': responder.latest_software_version_id,
+      'label' : responder.latest_software_label,
       'URL': '',
     }
     self.response.headers['Content-Type'] = 'text/json'
@@ -95,6 +110,9 @@ class ResponderFirmware(webapp.RequestHandler):
 class ResponderPersonalities(webapp.RequestHandler):
   """Returns the personalities for a responder."""
   def get(self):
+    if common.CheckNotModified(self, [timestamp_keys.DEVICES,
+                                      timestamp_keys.MANUFACTURERS]):
+      return
     responder = common.LookupModel(self.request.get('manufacturer'),
                                    self.request.get('model'))
     if responder is None:
@@ -130,27 +148,371 @@ class ResponderPersonalities(webapp.RequestHandler):
     self.response.out.write(json.dumps(output))
 
 
-class UpdateTimeHandler(webapp.RequestHandler):
-  """Return the last update time for various parts of the index."""
+def ParsePairs(value):
+  """Parse a comma separated list of <id>:<id> pairs, either id can be in hex.
+
+  Returns:
+    A list of (int, int) tuples, without duplicates, or None if the list was
+    invalid.
+  """
+  pairs = []
+  seen = set()
+  for pair_str in value.split(','):
+    if not pair_str.strip():
+      continue
+    ids = tuple(utils.StringToInt(i) for i in pair_str.split(':'))
+    if len(ids) != 2 or None in ids:
+      return None
+    if ids not in seen:
+      seen.add(ids)
+      pairs.append(ids)
+  return pairs
+
+
+class ResponderBulkLookup(webapp.RequestHandler):
+  """Return the latest firmware, personalities, sensors & supported PIDs for
+     many responders at once.
+
+  The responders are passed in ?responders= as a comma separated list of
+  <manufacturer_id>:<device_model_id>, either can be in hex. This can be sent
+  as a POST if the list is long.
+
+  The responders & their latest versions are batch gets, but the
+  personalities & sensors take one query per version each, so at most
+  2 * MAX_RESPONDERS queries, run utils.MAX_PARALLEL_QUERIES at a time.
+  """
+  ESTA_ID = 0
+  MAX_RESPONDERS = 500
+
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, [timestamp_keys.DEVICES,
+                                      timestamp_keys.MANUFACTURERS]):
+      return
+    self.Lookup()
+
+  def post(self):
+    # the ETag doesn't cover the body, so there's no conditional POST
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.Lookup()
+
+  def Lookup(self):
+    pairs = ParsePairs(self.request.get('responders'))
+    if pairs is None or len(pairs) > self.MAX_RESPONDERS:
+      self.error(400)
+      return
+
+    responders = self.LoadResponders(pairs)
+    versions = self.LoadLatestVersions(responders)
+    version_keys = [version.key() for version in versions.itervalues()]
+    personalities = utils.QueryByReference(ResponderPersonality.sw_version,
+                                           version_keys)
+    sensors = utils.QueryByReference(ResponderSensor.sw_version, version_keys)
+    pid_names = common.GetPidNames()
+
+    output = []
+    missing = []
+    for pair in pairs:
+      responder = responders.get(pair)
+      if responder is None:
+        missing.append({
+          'manufacturer_id': pair[0],
+          'device_model_id': pair[1],
+        })
+        continue
+      output.append(self.BuildResponder(
+          pair, responder, versions.get(pair), personalities, sensors,
+          pid_names))
+
+    self.response.out.write(json.dumps({
+      'responders': output,
+      'missing': missing,
+    }))
+
+  def LoadResponders(self, pairs):
+    """Fetch the Responders with a batch get.
+
+    Until the key migration has completed, the responders which aren't found
+    are looked up by query, see legacy_data.py.
+
+    Returns:
+      A dict of (manufacturer_id, device_model_id) to Responder.
+    """
+    keys = [db.Key.from_path('Responder', Responder.KeyName(*pair))
+            for pair in pairs]
+    responders = {}
+    for pair, responder in zip(pairs, db.get(keys)):
+      if responder is None and legacy_data.Exists(legacy_data.KEYS):
+        manufacturer = common.GetManufacturer(pair[0])
+        if manufacturer is not None:
+          responder = common.LookupResponder(manufacturer, pair[1])
+      if responder is not None:
+        responders[pair] = responder
+    common.LoadLatestSoftware(responders.values())
+    return responders
+
+  def LoadLatestVersions(self, responders):
+    """Fetch the latest SoftwareVersion for each responder, with a batch get.
+
+    Args:
+      responders: the output of LoadResponders().
+
+    Returns:
+      A dict of (manufacturer_id, device_model_id) to SoftwareVersion.
+    """
+    pairs = [pair for pair, responder in responders.iteritems()
+             if responder.latest_software_key is not None]
+    versions = db.get([db.Key(responders[pair].latest_software_key)
+                       for pair in pairs])
+    return dict((pair, version) for pair, version in zip(pairs, versions)
+                if version is not None)
+
+  def BuildResponder(self, pair, responder, version, personalities, sensors,
+                     pid_names):
+    """Build the output for a single responder."""
+    output = {
+      'manufacturer_id': pair[0],
+      'device_model_id': pair[1],
+      'model_description': responder.model_description,
+    }
+    if version is None:
+      return output
 
-    # timestamp name : json key
-    timestamp_pairs = {
-        timestamp_keys.CONTROLLERS: 'controller_update_time',
-        timestamp_keys.DEVICES: 'device_update_time',
-        timestamp_keys.MANUFACTURERS: 'manufacturer_update_time',
-        timestamp_keys.PIDS: 'pid_update_time',
-        timestamp_keys.SOFTWARE: 'software_update_time',
-        timestamp_keys.SPLITTERS: 'splitter_update_time',
+    output['software_version'] = {
+      'version_id': version.version_id,
+      'label': version.label,
     }
 
+    params = []
+    for param in sorted(responder.latest_supported_parameters):
+      manufacturer_id = param >= 0x8000 and pair[0] or self.ESTA_ID
+      param_info = {'id': param}
+      name = pid_names.get((manufacturer_id, param))
+      if name is not None:
+        param_info['name'] = name
+      params.append(param_info)
+    output['supported_parameters'] = params
+
+    output['personalities'] = sorted(
+        [{'description': p.description,
+          'index': p.index,
+          'slot_count': p.slot_count}
+         for p in personalities.get(version.key(), [])],
+        key=lambda p: p['index'])
+    output['sensors'] = sorted(
+        [{'description': s.description,
+          'index': s.index,
+          'type': s.type,
+          'supports_recording': s.supports_recording,
+          'supports_min_max': s.supports_min_max_recording}
+         for s in sensors.get(version.key(), [])],
+        key=lambda s: s['index'])
+    return output
+
+
+class PidBulkLookup(webapp.RequestHandler):
+  """Return the definitions of many PIDs at once.
+
+  The PIDs are passed in ?pids= as a comma separated list of
+  <manufacturer_id>:<pid_id>, either can be in hex. PIDs below 0x8000 are
+  always looked up as ESTA PIDs. This can be sent as a POST if the list is
+  long.
+  """
+  ESTA_ID = 0
+  MAX_PIDS = 500
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS,
+                                      timestamp_keys.PIDS]):
+      return
+    self.Lookup()
+
+  def post(self):
+    # the ETag doesn't cover the body, so there's no conditional POST
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.Lookup()
+
+  def Lookup(self):
+    pairs = ParsePairs(self.request.get('pids'))
+    if pairs is None or len(pairs) > self.MAX_PIDS:
+      self.error(400)
+      return
+
+    # rewriting the ESTA PIDs can create duplicates, so drop them again
+    lookups = []
+    seen = set()
+    for manufacturer_id, pid_id in pairs:
+      if pid_id < 0x8000:
+        manufacturer_id = self.ESTA_ID
+      if (manufacturer_id, pid_id) not in seen:
+        seen.add((manufacturer_id, pid_id))
+        lookups.append((manufacturer_id, pid_id))
+    pids = db.get([db.Key.from_path('Pid', Pid.KeyName(*l)) for l in lookups])
+    for i, (manufacturer_id, pid_id) in enumerate(lookups):
+      # until the key migration has completed, fall back to a query
+      if pids[i] is None and legacy_data.Exists(legacy_data.KEYS):
+        manufacturer = common.GetManufacturer(manufacturer_id)
+        if manufacturer is not None:
+          pids[i] = common.LookupPid(manufacturer, pid_id)
+    found = [p for p in pids if p is not None]
+    utils.PrefetchReferences(found, Pid.manufacturer)
+    common.LoadLegacyCommands(found)
+
+    output = []
+    missing = []
+    for (manufacturer_id, pid_id), pid in zip(lookups, pids):
+      if pid is None:
+        missing.append({
+          'manufacturer_id': manufacturer_id,
+          'pid_id': pid_id,
+        })
+      else:
+        output.append(self.BuildPid(pid))
+
+    self.response.out.write(json.dumps({
+      'pids': output,
+      'missing': missing,
+    }))
+
+  def BuildPid(self, pid):
+    """Build the output for a single PID."""
+    output = {
+      'manufacturer_id': pid.manufacturer.esta_id,
+      'manufacturer_name': pid.manufacturer.name,
+      'pid_id': pid.pid_id,
+      'name': pid.name,
+      'link': pid.link,
+      'notes': pid.notes,
+      'draft': pid.draft,
+    }
+    for command_type in Pid.COMMAND_TYPES:
+      if not pid.HasCommand(command_type):
+        continue
+      request, response = pid_definitions.BuildCommand(pid, command_type)
+      sub_device_range = getattr(pid, '%s_sub_device_range' % command_type)
+      output['%s_command' % command_type] = {
+        'request': request,
+        'response': response,
+        'sub_device_range': sub_device_range,
+        'sub_device_range_str': SUBDEVICE_RANGE_DICT.get(sub_device_range, ''),
+      }
+    return output
+
+
+class PidSearch(webapp.RequestHandler):
+  """Search PIDs by name, for the typeahead."""
+  DEFAULT_LIMIT = 10
+  MAX_LIMIT = 50
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.headers['Cache-Control'] = 'public; max-age=300;'
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS,
+                                      timestamp_keys.PIDS]):
+      return
+
+    limit = utils.StringToInt(self.request.get('limit'), False)
+    if limit is None or limit <= 0:
+      limit = self.DEFAULT_LIMIT
+    limit = min(limit, self.MAX_LIMIT)
+    query_string = self.request.get('q').strip().lower()
+
+    # the output includes the manufacturer names, so it depends on both
+    update_times = common.GetUpdateTimes()
+    versions = []
+    for name in (timestamp_keys.MANUFACTURERS, timestamp_keys.PIDS):
+      update_time = update_times.get(name)
+      if update_time is None:
+        versions.append('0')
+      else:
+        versions.append('%d%06d' % (utils.TimestampToInt(update_time),
+                                    update_time.microsecond))
+    cache_key = '%s:%s:%d:%s' % (memcache_keys.PID_SEARCH_PREFIX,
+                                 ','.join(versions), limit, query_string)
+    output = memcache.get(cache_key)
+    if output is None:
+      output = []
+      for pid in pid_search.Search(query_string, limit):
+        output.append({
+          'manufacturer_id': pid.manufacturer.esta_id,
+          'manufacturer_name': pid.manufacturer.name,
+          'pid_id': pid.pid_id,
+          'name': pid.name,
+        })
+      memcache.set(cache_key, output)
+    self.response.out.write(json.dumps({'pids': output}))
+
+
+class ResponderSearch(webapp.RequestHandler):
+  """Search responders by name, manufacturer name, tag or personality.
+
+  Results are returned ?page_size= at a time, ?page= is 1 offset.
+  """
+  DEFAULT_PAGE_SIZE = 20
+  MAX_PAGE_SIZE = 100
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    self.response.headers['Cache-Control'] = 'public; max-age=300;'
+    if common.CheckNotModified(self, [timestamp_keys.DEVICES,
+                                      timestamp_keys.MANUFACTURERS]):
+      return
+
+    page = utils.StringToInt(self.request.get('page'), False)
+    if page is None or page < 1:
+      page = 1
+    page_size = utils.StringToInt(self.request.get('page_size'), False)
+    if page_size is None or page_size <= 0:
+      page_size = self.DEFAULT_PAGE_SIZE
+    page_size = min(page_size, self.MAX_PAGE_SIZE)
+
+    results = []
+    capped = False
+    query_string = self.request.get('q')
+    if query_string.strip():
+      results, capped = responder_search.Search(query_string)
+    start = (page - 1) * page_size
+
+    responders = []
+    for result in results[start:start + page_size]:
+      responders.append({
+        'manufacturer_id': result['manufacturer']['esta_id'],
+        'manufacturer_name': result['manufacturer']['name'],
+        'device_model_id': result['device_model_id'],
+        'model_description': result['model_description'],
+      })
+    self.response.out.write(json.dumps({
+      'total': len(results),
+      # if True, only the best matches were returned & total is a lower bound
+      'capped': capped,
+      'page': page,
+      'page_size': page_size,
+      'responders': responders,
+    }))
+
+
+class UpdateTimeHandler(webapp.RequestHandler):
+  """Return the last update time for various parts of the index."""
+  # timestamp name : json key
+  TIMESTAMP_PAIRS = {
+      timestamp_keys.CONTROLLERS: 'controller_update_time',
+      timestamp_keys.DEVICES: 'device_update_time',
+      timestamp_keys.MANUFACTURERS: 'manufacturer_update_time',
+      timestamp_keys.PIDS: 'pid_update_time',
+      timestamp_keys.SOFTWARE: 'software_update_time',
+      timestamp_keys.SPLITTERS: 'splitter_update_time',
+  }
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, self.TIMESTAMP_PAIRS.keys()):
+      return
+
     output = {}
-    for update_timestamp in LastUpdateTime.all():
-      name = update_timestamp.name
-      if name in timestamp_pairs:
-        output[timestamp_pairs[name]] = utils.TimestampToInt(
-            update_timestamp.update_time)
+    for name, update_time in common.GetUpdateTimes().iteritems():
+      if name in self.TIMESTAMP_PAIRS:
+        output[self.TIMESTAMP_PAIRS[name]] = utils.TimestampToInt(update_time)
     self.response.out.write(json.dumps(output))
 
 
@@ -158,19 +520,16 @@ class ProductTags(webapp.RequestHandler):
   """Return the tags and number of products for each."""
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, [self.TimestampKey()]):
+      return
     tag_list = memcache.get(self.MemcacheKey())
     if not tag_list:
       tag_list = []
-      query = ProductTag.all()
-      query.filter('product_type = ', self.ProductType().class_name())
-      query.order('label')
-      for tag in query:
-        products = tag.product_set.count()
-        if products and not tag.exclude_from_search:
-          tag_list.append({
-              'label': tag.label,
-              'count': products,
-          })
+      for row in facet_counts.Get(self.MemcacheKey()):
+        tag_list.append({
+            'label': row['name'],
+            'count': row['count'],
+        })
       memcache.set(self.MemcacheKey(), tag_list)
     self.response.out.write(json.dumps(tag_list))
 
@@ -178,21 +537,12 @@ class ProductManufacturers(webapp.RequestHandler):
   """Return the manufactures and number of products for each."""
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, [self.TimestampKey(),
+                                      timestamp_keys.MANUFACTURERS]):
+      return
     manufacturer_list = memcache.get(self.MemcacheKey())
     if not manufacturer_list:
-      query = self.ProductType().all()
-      manufacturer_by_id = {}
-      for product in query:
-        manufacturer = product.manufacturer
-        if manufacturer.esta_id not in manufacturer_by_id:
-          manufacturer_by_id[manufacturer.esta_id] = {
-            'id': manufacturer.esta_id,
-            'name': manufacturer.name,
-            'count': 0,
-          }
-        manufacturer_by_id[manufacturer.esta_id]['count'] += 1
-      manufacturer_list = manufacturer_by_id.values()
-      manufacturer_list.sort(key=lambda x: x['name'])
+      manufacturer_list = facet_counts.Get(self.MemcacheKey())
       memcache.set(self.MemcacheKey(), manufacturer_list)
     self.response.out.write(json.dumps(manufacturer_list))
 
@@ -206,6 +556,9 @@ class ControllerManufacturers(ProductManufacturers):
   def MemcacheKey(self):
     return memcache_keys.MANUFACTURER_CONTROLLER_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.CONTROLLERS
+
 
 class ControllerTags(ProductTags):
   def ProductType(self):
@@ -214,6 +567,9 @@ class ControllerTags(ProductTags):
   def MemcacheKey(self):
     return memcache_keys.TAG_CONTROLLER_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.CONTROLLERS
+
 # Nodes
 class NodeManufacturers(ProductManufacturers):
   def ProductType(self):
@@ -222,6 +578,9 @@ class NodeManufacturers(ProductManufacturers):
   def MemcacheKey(self):
     return memcache_keys.MANUFACTURER_NODE_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.NODES
+
 class NodeTags(ProductTags):
   def ProductType(self):
     return Node
@@ -229,6 +588,9 @@ class NodeTags(ProductTags):
   def MemcacheKey(self):
     return memcache_keys.TAG_NODE_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.NODES
+
 # Software
 class SoftwareManufacturers(ProductManufacturers):
   def ProductType(self):
@@ -237,6 +599,9 @@ class SoftwareManufacturers(ProductManufacturers):
   def MemcacheKey(self):
     return memcache_keys.MANUFACTURER_SOFTWARE_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.SOFTWARE
+
 class SoftwareTags(ProductTags):
   def ProductType(self):
     return Software
@@ -244,6 +609,9 @@ class SoftwareTags(ProductTags):
   def MemcacheKey(self):
     return memcache_keys.TAG_SOFTWARE_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.SOFTWARE
+
 # Splitters
 class SplitterManufacturers(ProductManufacturers):
   def ProductType(self):
@@ -252,6 +620,9 @@ class SplitterManufacturers(ProductManufacturers):
   def MemcacheKey(self):
     return memcache_keys.MANUFACTURER_SPLITTER_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.SPLITTERS
+
 class SplitterTags(ProductTags):
   def ProductType(self):
     return Splitter
@@ -259,64 +630,44 @@ class SplitterTags(ProductTags):
   def MemcacheKey(self):
     return memcache_keys.TAG_SPLITTER_COUNTS
 
+  def TimestampKey(self):
+    return timestamp_keys.SPLITTERS
+
 
 class PidCounts(webapp.RequestHandler):
-  """Return the count of PID usage."""
+  """Return the count of PID usage.
+
+  This is built in the background by pid_usage.py.
+  """
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
     self.response.headers['Cache-Control'] = 'public; max-age=300;'
-    self.response.out.write(self.BuildResponse())
+    build_time, content = pid_usage.Get()
+    if common.CheckNotModifiedSince(self, [build_time]):
+      return
+    self.response.out.write(content)
 
-  def BuildResponse(self):
-    param_counts = {}
-    responders = 0
-    max_manufacturer_pids = 0
-    max_manufacturer_responder = ''
-    max_pids = 0
-    max_pids_responder = ''
-    for responder in Responder.all():
-      params = []
-      version = common.GetLatestSoftware(responder)
-      if version:
-        params = version.supported_parameters
-
-      manufacturer_pids = 0
-      for param in params:
-        param_counts.setdefault(param, 0)
-        param_counts[param] += 1
-        if param >= 0x8000:
-          manufacturer_pids += 1
-      if params:
-        responders += 1
-      if manufacturer_pids > max_manufacturer_pids:
-        max_manufacturer_responder = responder.model_description
-        max_manufacturer_pids = manufacturer_pids
-      if len(params) > max_pids:
-        max_pids_responder = responder.model_description
-        max_pids = len(params)
-
-    pids = []
-    for param, count in param_counts.iteritems():
-      param_info = {
-        'id': param,
-        'count': count,
-      }
-      if param < 0x8000:
-        query = Pid.all()
-        query.filter('pid_id = ', param)
-        pid = query.fetch(1)
-        if pid:
-          param_info['name'] = pid[0].name
-      pids.append(param_info)
+class Changes(webapp.RequestHandler):
+  """Return the manufacturers, PIDs, responders & products which have changed
+     since ?since=<token>.
 
-    output = {
-        'count': responders,
-        'max_manufacturer_pids': (max_manufacturer_responder,
-                                  max_manufacturer_pids),
-        'max_pids': (max_pids_responder, max_pids),
-        'pids': pids,
-    }
-    return json.dumps(output)
+  Clients should apply the deletions before the modifications, and if 'more'
+  is true, fetch again straight away with the new token. A 'cleared' entry
+  means all matching entities were deleted, so they need to be downloaded
+  again. Without a token this just returns the current one.
+  """
+  def get(self):
+    self.response.headers['Content-Type'] = 'text/plain'
+    since = self.request.get('since')
+    if not since:
+      self.response.out.write(json.dumps({'token': change_log.CurrentToken()}))
+      return
+
+    since_time = change_log.TokenToTime(since)
+    if since_time is None:
+      self.error(400)
+      return
+    self.response.out.write(json.dumps(change_log.GetChanges(since_time)))
 
 app = webapp.WSGIApplication(
   [
@@ -324,6 +675,10 @@ app = webapp.WSGIApplication(
     ('/api/json/1/manufacturer', ManufacturerLookup),
     ('/api/json/1/latest_responder_firmware', ResponderFirmware),
     ('/api/json/1/responder_personalities', ResponderPersonalities),
+    ('/api/json/1/responders', ResponderBulkLookup),
+    ('/api/json/1/pids', PidBulkLookup),
+    ('/api/json/1/pid_search', PidSearch),
+    ('/api/json/1/responder_search', ResponderSearch),
     ('/api/json/1/update_times', UpdateTimeHandler),
     ('/api/json/1/controller_tags', ControllerTags),
     ('/api/json/1/controller_manufacturers', ControllerManufacturers),
@@ -334,5 +689,6 @@ app = webapp.WSGIApplication(
     ('/api/json/1/splitter_tags', SplitterTags),
     ('/api/json/1/splitter_manufacturers', SplitterManufacturers),
     ('/api/json/1/pid_counts', PidCounts),
+    ('/api/json/1/changes', Changes),
   ],
   debug=True)
@@ -17,7 +17,13 @@
 # Version 1 of the Proto API
 
 from model import *
+from utils import TimestampToInt
+import common
 import logging
+import memcache_keys
+import pid_proto
+import timestamp_keys
+from google.appengine.api import memcache
 from google.appengine.ext import webapp
 
 
@@ -26,6 +32,8 @@ class ManufacturerList(webapp.RequestHandler):
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
     self.response.headers['Cache-Control'] = 'public; max-age=300;'
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS]):
+      return
 
     output = []
     for manufacturer in Manufacturer.all():
@@ -37,8 +45,50 @@ class ManufacturerList(webapp.RequestHandler):
     self.response.out.write('\n'.join(output))
 
 
+class PidStore(webapp.RequestHandler):
+  """Return the PID definitions as a binary encoded PidStore.
+
+  This is the same data as /download, but it's much quicker to parse. The
+  ?pids= parameter works the same way.
+  """
+  # the largest response we'll try to store in memcache
+  MEMCACHE_LIMIT = 1000000
+
+  def get(self):
+    self.response.headers['Content-Type'] = 'application/octet-stream'
+    self.response.headers['Cache-Control'] = 'public; max-age=300;'
+    if common.CheckNotModified(self, [timestamp_keys.MANUFACTURERS,
+                                      timestamp_keys.PIDS]):
+      return
+
+    update_times = common.GetUpdateTimes()
+    version = 0
+    if update_times.get(timestamp_keys.PIDS):
+      version = TimestampToInt(update_times[timestamp_keys.PIDS])
+    manufacturer_version = 0
+    if update_times.get(timestamp_keys.MANUFACTURERS):
+      manufacturer_version = TimestampToInt(
+          update_times[timestamp_keys.MANUFACTURERS])
+
+    # Can be '', 'esta', 'esta-draft' or 'manufacturers'
+    pid_selection = self.request.get('pids')
+    cache_key = '%s:%s:%d:%d' % (memcache_keys.PID_STORE_PREFIX,
+                                 pid_selection, version,
+                                 manufacturer_version)
+    response = memcache.get(cache_key)
+    if response is None:
+      esta_pids, manufacturer_pids = pid_proto.LoadPids(pid_selection)
+      response = pid_proto.EncodePidStore(esta_pids, manufacturer_pids,
+                                          version)
+      if (len(response) < self.MEMCACHE_LIMIT and
+          not memcache.add(cache_key, response)):
+        logging.error("Memcache set failed.")
+    self.response.out.write(response)
+
+
 app = webapp.WSGIApplication(
   [
     ('/api/proto/1/manufacturers', ManufacturerList),
+    ('/api/proto/1/pids', PidStore),
   ],
   debug=True)
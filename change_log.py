@@ -0,0 +1,228 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# change_log.py
+# Copyright (C) 2012 Simon Newton
+# The feed of entities which have changed since a point in time.
+#
+# Manufacturers, PIDs, responders & products carry a last_modified time, which
+# the loaders set with MarkModified() when the content changes. Deletions are
+# recorded as Tombstone entities. Entities saved before
+# last_modified was added don't appear in the feed until they're next
+# modified, so clients start with a full download.
+
+import calendar
+import common
+import datetime
+import json
+from model import *
+from utils import PrefetchReferences
+
+MANUFACTURER = 'manufacturer'
+PID = 'pid'
+RESPONDER = 'responder'
+PRODUCT = 'product'
+
+# kind : (model class, output key)
+KINDS = {
+  MANUFACTURER: (Manufacturer, 'manufacturers'),
+  PID: (Pid, 'pids'),
+  RESPONDER: (Responder, 'responders'),
+  PRODUCT: (Product, 'products'),
+}
+
+# The maximum number of entities of each kind returned at once.
+LIMIT = 500
+
+# Queries are eventually consistent, so the token we hand out lags behind the
+# current time. Clients may see the same change more than once.
+CONSISTENCY_WINDOW = datetime.timedelta(seconds=60)
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def TimeToToken(timestamp):
+  """Convert a datetime to a token."""
+  return str(calendar.timegm(timestamp.utctimetuple()) * 1000000 +
+             timestamp.microsecond)
+
+
+def CurrentToken():
+  """Return the token a client should start from after a full download."""
+  return TimeToToken(datetime.datetime.now() - CONSISTENCY_WINDOW)
+
+
+def TokenToTime(token):
+  """Convert a token to a datetime.
+
+  Returns:
+    The datetime, or None if the token was invalid.
+  """
+  try:
+    return _EPOCH + datetime.timedelta(microseconds=int(token))
+  except (ValueError, OverflowError):
+    return None
+
+
+def MarkModified(entity):
+  """Record that the content of an entity has changed, so it's included in
+     the feed. This doesn't save the entity.
+  """
+  entity.last_modified = datetime.datetime.now()
+
+
+def RecordDeletions(kind, ids_list):
+  """Record that entities have been deleted.
+
+  Args:
+    kind: one of KINDS.
+    ids_list: a list of dicts, each one identifies a deleted entity in the
+      same way as the feed does.
+  """
+  db.put([Tombstone(kind=kind, ids=json.dumps(ids)) for ids in ids_list])
+
+
+def RecordClear(kind, ids=None):
+  """Record that all entities of a kind have been deleted.
+
+  Args:
+    kind: one of KINDS.
+    ids: if set, only entities with these fields were deleted, i.e.
+      {'type': 'Controller'}.
+  """
+  Tombstone(kind=kind, ids=json.dumps(ids or {}), cleared=True).put()
+
+
+def _ManufacturerItem(manufacturer):
+  return {
+    'id': manufacturer.esta_id,
+    'name': manufacturer.name,
+    'link': manufacturer.link,
+  }
+
+
+def _PidItem(pid):
+  output = {
+    'manufacturer_id': pid.manufacturer.esta_id,
+    'pid_id': pid.pid_id,
+    'name': pid.name,
+    'link': pid.link,
+    'notes': pid.notes,
+    'draft': pid.draft,
+  }
+  for command_type in Pid.COMMAND_TYPES:
+    if not pid.HasCommand(command_type):
+      continue
+    output[command_type] = {
+      'sub_device_range': getattr(pid, '%s_sub_device_range' % command_type),
+      'request': common.DecodeMessage(
+          pid.key(), getattr(pid, '%s_request' % command_type)),
+      'response': common.DecodeMessage(
+          pid.key(), getattr(pid, '%s_response' % command_type)),
+    }
+  return output
+
+
+def _ResponderItem(responder):
+  return {
+    'manufacturer_id': responder.manufacturer.esta_id,
+    'device_model_id': responder.device_model_id,
+    'model_description': responder.model_description,
+    'link': responder.link,
+    'image_url': responder.image_url,
+    'software_version_id': responder.latest_software_version_id,
+    'software_label': responder.latest_software_label,
+    'supported_parameters': responder.latest_supported_parameters,
+  }
+
+
+def _ProductItem(product):
+  return {
+    'key': str(product.key()),
+    'type': product.class_name(),
+    'manufacturer_id': product.manufacturer.esta_id,
+    'name': product.name,
+    'link': product.link,
+    'image_url': product.image_url,
+  }
+
+
+_ITEM_BUILDERS = {
+  MANUFACTURER: _ManufacturerItem,
+  PID: _PidItem,
+  RESPONDER: _ResponderItem,
+  PRODUCT: _ProductItem,
+}
+
+
+def GetChanges(since):
+  """Get the entities which have changed.
+
+  Args:
+    since: the datetime to return changes from.
+
+  Returns:
+    A dict with the modified & deleted entities of each kind, the kinds which
+    were cleared, the token to pass on the next request and a flag which is
+    True if there are more changes to fetch right away.
+  """
+  token_time = datetime.datetime.now() - CONSISTENCY_WINDOW
+  more = False
+  output = {}
+
+  for kind, (model_class, output_key) in KINDS.iteritems():
+    query = model_class.all()
+    query.filter('last_modified >=', since)
+    query.order('last_modified')
+    entities = query.fetch(LIMIT + 1)
+    if len(entities) > LIMIT:
+      # pick up from here next time
+      entities = entities[:LIMIT]
+      token_time = min(token_time, entities[-1].last_modified)
+      more = True
+
+    if kind != MANUFACTURER:
+      PrefetchReferences(entities, model_class.manufacturer)
+    if kind == PID:
+      common.LoadLegacyCommands(entities)
+    elif kind == RESPONDER:
+      common.LoadLatestSoftware(entities)
+    builder = _ITEM_BUILDERS[kind]
+    output[output_key] = {
+      'modified': [builder(entity) for entity in entities],
+      'deleted': [],
+    }
+
+  query = Tombstone.all()
+  query.filter('deletion_time >=', since)
+  query.order('deletion_time')
+  tombstones = query.fetch(LIMIT + 1)
+  if len(tombstones) > LIMIT:
+    tombstones = tombstones[:LIMIT]
+    token_time = min(token_time, tombstones[-1].deletion_time)
+    more = True
+
+  cleared = []
+  for tombstone in tombstones:
+    ids = json.loads(tombstone.ids)
+    if tombstone.cleared:
+      ids['kind'] = tombstone.kind
+      cleared.append(ids)
+    else:
+      output[KINDS[tombstone.kind][1]]['deleted'].append(ids)
+
+  output['cleared'] = cleared
+  output['token'] = TimeToToken(max(token_time, since))
+  output['more'] = more
+  return output
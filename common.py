@@ -17,17 +17,103 @@
 # Common functions
 
 from model import *
+from utils import GetGeneration, IncrementGeneration, PrefetchReferences
 from utils import StringToInt
+import ast
+import calendar
 import datetime
+import email.utils
+import hashlib
+import index_stats
+import json
+import legacy_data
 import logging
 import memcache_keys
+import page_cache
 import textwrap
+import timestamp_keys
 from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 
 
+# Instance-resident caches for the reference data (manufacturers & product
+# categories). These are backed by memcache and flushed whenever the reference
+# data generation in memcache changes.
+_reference_data_generation = None
+_manufacturer_cache = {}
+_product_category_cache = {}
+
+
+def _CheckReferenceDataGeneration():
+  """Flush the instance caches if the reference data has changed.
+
+  Returns:
+    The current reference data generation.
+  """
+  global _reference_data_generation
+  generation = GetGeneration(memcache_keys.REFERENCE_DATA_GENERATION)
+  if generation != _reference_data_generation:
+    _manufacturer_cache.clear()
+    _product_category_cache.clear()
+    _reference_data_generation = generation
+  return generation
+
+
+def _LookupReferenceEntity(local_cache, prefix, entity_id, lookup_function):
+  """Lookup a reference data entity, using the instance cache & memcache.
+
+  Args:
+    local_cache: the instance dict to use.
+    prefix: the memcache key prefix for this type of entity.
+    entity_id: the id of the entity.
+    lookup_function: called with the id to fetch the entity from the
+      datastore.
+
+  Returns:
+    The entity object, or None if not found.
+  """
+  generation = _CheckReferenceDataGeneration()
+  entity = local_cache.get(entity_id)
+  if entity is not None:
+    return entity
+
+  memcache_key = '%s:%s:%d' % (prefix, generation, entity_id)
+  data = memcache.get(memcache_key)
+  if data is not None:
+    entity = db.model_from_protobuf(data)
+  else:
+    entity = lookup_function(entity_id)
+    if entity is None:
+      return None
+    memcache.set(memcache_key, db.model_to_protobuf(entity).Encode())
+  local_cache[entity_id] = entity
+  return entity
+
+
+def InvalidateReferenceData():
+  """Invalidate the cached manufacturers & product categories on all
+     instances.
+  """
+  _manufacturer_cache.clear()
+  _product_category_cache.clear()
+  IncrementGeneration(memcache_keys.REFERENCE_DATA_GENERATION)
+
+
+def _FetchManufacturer(manufacturer_id):
+  manufacturer = Manufacturer.get_by_key_name(
+      Manufacturer.KeyName(manufacturer_id))
+  if manufacturer is not None or not legacy_data.Exists(legacy_data.KEYS):
+    return manufacturer
+
+  query = Manufacturer.all()
+  query.filter('esta_id = ', manufacturer_id)
+  for manufacturer in query.fetch(1):
+    return manufacturer
+  return None
+
+
 def GetManufacturer(manufacturer_id):
   """Lookup a manufacturer entity by manufacturer id. The manufacturer id can
      be a string in decimal or hex (prepend with 0x), or an int
@@ -37,11 +123,12 @@ def GetManufacturer(manufacturer_id):
   """
   if type(manufacturer_id) not in (int, long):
     manufacturer_id = StringToInt(manufacturer_id)
-  query = Manufacturer.all()
-  query.filter('esta_id = ', manufacturer_id)
-  for manufacturer in query.fetch(1):
-    return manufacturer
-  return None
+  if manufacturer_id is None:
+    return None
+  return _LookupReferenceEntity(_manufacturer_cache,
+                                memcache_keys.MANUFACTURER_ENTITY_PREFIX,
+                                manufacturer_id,
+                                _FetchManufacturer)
 
 def LookupModelFromRequest(request):
   return LookupModel(request.get('manufacturer'),
@@ -54,8 +141,19 @@ def LookupModel(manufacturer, model_id):
   manufacturer = GetManufacturer(manufacturer)
   if manufacturer is None or model_id is None:
     return None
+  return LookupResponder(manufacturer, model_id)
+
+def LookupResponder(manufacturer, model_id):
+  """Lookup a Responder entity given the Manufacturer entity and model id.
+
+  Returns:
+    The Responder entity, or None if not found.
+  """
+  responder = Responder.get_by_key_name(
+      Responder.KeyName(manufacturer.esta_id, model_id))
+  if responder is not None or not legacy_data.Exists(legacy_data.KEYS):
+    return responder
 
-  results = {}
   models = Responder.all()
   models.filter('device_model_id = ', model_id)
   models.filter('manufacturer = ', manufacturer.key())
@@ -65,26 +163,117 @@ def LookupModel(manufacturer, model_id):
     return None
   return model_data[0]
 
-def GetLatestSoftware(responder):
-  """Find the latest software version for a responder.
+def LookupPid(manufacturer, pid_id):
+  """Lookup a Pid entity given the Manufacturer entity and pid id.
 
   Returns:
-    A SoftwareVersion object or None.
+    The Pid entity, or None if not found.
   """
-  max_version = None
-  version = None
-  for version in responder.software_version_set:
-    if max_version is None or version.version_id > max_version:
-      max_version = version.version_id
-      version = version
-  return version
+  pid = Pid.get_by_key_name(Pid.KeyName(manufacturer.esta_id, pid_id))
+  if pid is not None:
+    return LoadLegacyCommands([pid])[0]
+  if not legacy_data.Exists(legacy_data.KEYS):
+    return None
 
-def LookupProductCategory(category_id):
-  """Lookup a ProductCategory entity by id.
+  query = Pid.all()
+  query.filter('pid_id = ', pid_id)
+  query.filter('manufacturer = ', manufacturer.key())
+
+  pid_data = query.fetch(1)
+  if not pid_data:
+    return None
+  return LoadLegacyCommands(pid_data)[0]
+
+def LoadLegacyCommands(pids):
+  """Copy the Command entities into the PIDs which haven't been migrated.
+
+  Until /tasks/migrate_pid_commands has run, some PIDs still reference
+  Command entities rather than embedding the commands. This fills in the
+  embedded fields, with a single batch get, but doesn't save the PIDs.
+
+  Args:
+    pids: a list of Pid entities.
 
   Returns:
-    The entity object, or None if not found.
+    The list of PIDs.
+  """
+  if not legacy_data.Exists(legacy_data.COMMANDS):
+    return pids
+
+  fields = []
+  for pid in pids:
+    for command_type in Pid.COMMAND_TYPES:
+      prop = Pid.properties()['%s_command' % command_type]
+      command_key = prop.get_value_for_datastore(pid)
+      # if the loader has already run, the embedded command takes priority
+      if command_key is not None and not pid.HasCommand(command_type):
+        fields.append((pid, command_type, command_key))
+
+  commands = db.get([key for _, _, key in fields])
+  for (pid, command_type, command_key), command in zip(fields, commands):
+    if command is None:
+      continue
+    setattr(pid, '%s_sub_device_range' % command_type,
+            command.sub_device_range)
+    for message in ('request', 'response'):
+      setattr(pid, '%s_%s' % (command_type, message),
+              EncodeMessage(DecodeMessage(command_key,
+                                          getattr(command, message))))
+  return pids
+
+def SetLatestSoftware(responder, versions):
+  """Copy the details of the latest software version onto a responder.
+
+  This doesn't save the responder.
+
+  Args:
+    responder: the Responder entity.
+    versions: an iterable of all the responder's SoftwareVersion entities.
+
+  Returns:
+    True if the responder was modified, False otherwise.
+  """
+  latest = None
+  for version in versions:
+    if latest is None or version.version_id > latest.version_id:
+      latest = version
+
+  if latest is None:
+    version_id, label, parameters, key = None, None, [], None
+  else:
+    version_id = latest.version_id
+    label = latest.label
+    parameters = [int(p) for p in latest.supported_parameters]
+    key = str(latest.key())
+
+  if (responder.latest_software_version_id == version_id and
+      responder.latest_software_label == label and
+      responder.latest_supported_parameters == parameters and
+      responder.latest_software_key == key):
+    return False
+  responder.latest_software_version_id = version_id
+  responder.latest_software_label = label
+  responder.latest_supported_parameters = parameters
+  responder.latest_software_key = key
+  return True
+
+def LoadLatestSoftware(responders):
+  """Fill in the latest software details of responders which don't have them.
+
+  Until /tasks/update_latest_software has run, the details are only held in
+  the SoftwareVersion entities. This doesn't save the responders.
+
+  Returns:
+    The list of responders.
   """
+  if not legacy_data.Exists(legacy_data.LATEST_SOFTWARE):
+    return responders
+  for responder in responders:
+    if responder.latest_software_key is None:
+      SetLatestSoftware(responder, responder.software_version_set)
+  return responders
+
+def _FetchProductCategory(category_id):
   query = ProductCategory.all()
   query.filter('id = ', category_id)
   categories = query.fetch(1)
@@ -93,6 +282,261 @@ def LookupProductCategory(category_id):
   else:
     return None
 
+
+def LookupProductCategory(category_id):
+  """Lookup a ProductCategory entity by id.
+
+  Returns:
+    The entity object, or None if not found.
+  """
+  if category_id is None:
+    return None
+  return _LookupReferenceEntity(_product_category_cache,
+                                memcache_keys.PRODUCT_CATEGORY_ENTITY_PREFIX,
+                                category_id,
+                                _FetchProductCategory)
+
+def _LoadPidNames():
+  """Load the PID names from the datastore.
+
+  Returns:
+    A dict in the form {(manufacturer_id, pid_id): name}
+  """
+  pids = PrefetchReferences(list(Pid.all()), Pid.manufacturer)
+  pid_names = {}
+  for pid in pids:
+    pid_names[(pid.manufacturer.esta_id, pid.pid_id)] = pid.name
+  return pid_names
+
+def BuildPidNames():
+  """Rebuild the PID name dict and store it in memcache.
+
+  This should be called whenever the PIDs are modified.
+  """
+  if not memcache.set(memcache_keys.PID_NAMES, _LoadPidNames()):
+    logging.error("Memcache set failed.")
+
+def GetPidNames():
+  """Get the PID name dict.
+
+  Returns:
+    A dict in the form {(manufacturer_id, pid_id): name}
+  """
+  pid_names = memcache.get(memcache_keys.PID_NAMES)
+  if pid_names is None:
+    pid_names = _LoadPidNames()
+    # use add so we don't clobber a newer copy from BuildPidNames()
+    if not memcache.add(memcache_keys.PID_NAMES, pid_names):
+      logging.error("Memcache set failed.")
+  return pid_names
+
+# The parsed PID message definitions, keyed by (entity key, content hash).
+_message_cache = {}
+MESSAGE_CACHE_SIZE = 5000
+
+def EncodeMessage(message):
+  """Encode a PID message definition (a request or response) for storage.
+
+  The output is canonical, so two encoded messages can be compared without
+  decoding them.
+  """
+  return json.dumps(message, sort_keys=True, separators=(',', ':'))
+
+def DecodeMessage(key, message_str):
+  """Decode a stored PID message definition.
+
+  Args:
+    key: the key of the entity the message belongs to, used for caching.
+    message_str: the encoded message.
+
+  Returns:
+    The message dict. This is shared between callers and must not be modified.
+  """
+  cache_key = (str(key), hashlib.md5(message_str.encode('utf-8')).hexdigest())
+  message = _message_cache.get(cache_key)
+  if message is None:
+    try:
+      message = json.loads(message_str)
+    except ValueError:
+      # the command migration re-encodes the older messages as JSON
+      if not legacy_data.Exists(legacy_data.COMMANDS):
+        raise
+      message = ast.literal_eval(message_str)
+    if len(_message_cache) >= MESSAGE_CACHE_SIZE:
+      _message_cache.clear()
+    _message_cache[cache_key] = message
+  return message
+
+def _LoadUpdateTimes():
+  """Load the update times from the datastore.
+
+  The entities are fetched by key, so this sees the latest update.
+
+  Returns:
+    A dict of timestamp name to datetime.
+  """
+  keys = [db.Key.from_path('LastUpdateTime', name)
+          for name in timestamp_keys.ALL]
+  update_times = {}
+  for update_timestamp in db.get(keys):
+    if update_timestamp is not None:
+      update_times[update_timestamp.name] = update_timestamp.update_time
+
+  if (len(update_times) != len(keys) and
+      legacy_data.Exists(legacy_data.KEYS)):
+    for update_timestamp in LastUpdateTime.all():
+      if update_timestamp.name not in update_times:
+        update_times[update_timestamp.name] = update_timestamp.update_time
+  return update_times
+
+def BuildUpdateTimes():
+  """Rebuild the update times dict and store it in memcache.
+
+  This should be called whenever a timestamp is updated.
+  """
+  if not memcache.set(memcache_keys.UPDATE_TIMES, _LoadUpdateTimes()):
+    logging.error("Memcache set failed.")
+
+def GetUpdateTimes():
+  """Get the last update time for each section of the index.
+
+  Returns:
+    A dict of timestamp name to datetime.
+  """
+  update_times = memcache.get(memcache_keys.UPDATE_TIMES)
+  if update_times is None:
+    update_times = _LoadUpdateTimes()
+    # use add so we don't clobber a newer copy from BuildUpdateTimes()
+    if not memcache.add(memcache_keys.UPDATE_TIMES, update_times):
+      logging.error("Memcache set failed.")
+  return update_times
+
+def CheckNotModified(handler, timestamp_names, variant=''):
+  """Handle a conditional GET for a response built from sections of the index.
+
+  This sets the ETag and Last-Modified headers from the section timestamps,
+  and sends a 304 if the client already has the current version.
+
+  Args:
+    handler: the webapp.RequestHandler.
+    timestamp_names: the timestamp_keys the response depends on.
+    variant: identifies the representation, i.e. 'gzip', if there is more
+      than one.
+
+  Returns:
+    True if a 304 was sent, in which case the handler should return.
+  """
+  update_times = GetUpdateTimes()
+  return CheckNotModifiedSince(
+      handler, [update_times.get(name) for name in timestamp_names], variant)
+
+def CheckNotModifiedSince(handler, update_times, variant=''):
+  """Handle a conditional GET for a response built at known times.
+
+  Args:
+    handler: the webapp.RequestHandler.
+    update_times: a list of datetimes (or None) the response depends on.
+    variant: identifies the representation, if there is more than one.
+
+  Returns:
+    True if a 304 was sent, in which case the handler should return.
+  """
+  timestamps = []
+  versions = []
+  for update_time in update_times:
+    if update_time is not None:
+      timestamps.append(calendar.timegm(update_time.utctimetuple()))
+      # Last-Modified only has second resolution, the ETag doesn't
+      versions.append('%d.%06d' % (timestamps[-1], update_time.microsecond))
+    else:
+      timestamps.append(0)
+      versions.append('0')
+
+  version = '%s?%s:%s' % (handler.request.path,
+                          handler.request.query_string,
+                          ','.join(versions))
+  if variant:
+    version += ':%s' % variant
+  etag = '"%s"' % hashlib.md5(version).hexdigest()
+  handler.response.headers['ETag'] = etag
+  last_modified = max(timestamps)
+  if last_modified:
+    handler.response.headers['Last-Modified'] = email.utils.formatdate(
+        last_modified, usegmt=True)
+
+  not_modified = False
+  if_none_match = handler.request.headers.get('If-None-Match')
+  if if_none_match:
+    etags = [t.strip() for t in if_none_match.split(',')]
+    not_modified = etag in etags or '*' in etags
+  else:
+    if_modified_since = handler.request.headers.get('If-Modified-Since')
+    if if_modified_since and last_modified:
+      since = email.utils.parsedate_tz(if_modified_since)
+      if since is not None:
+        not_modified = last_modified <= email.utils.mktime_tz(since)
+
+  if not_modified:
+    handler.response.set_status(304)
+  return not_modified
+
+def InvalidateBrowseData():
+  """Invalidate the cached counts & cursors used by the browse pages."""
+  IncrementGeneration(memcache_keys.BROWSE_GENERATION)
+
+def FetchPage(query, query_id, page, page_size, cursor=None):
+  """Fetch a page of results for one of the browse pages.
+
+  Rather than using offsets, which get slower the further in we go, this
+  resumes from the cursor the previous page left off at. The total count and
+  the start cursor of each page are cached.
+
+  The query must have a stable sort order. Entities with equal sort values
+  are returned in key order, so a single sort property is enough.
+
+  Args:
+    query: the db.Query to fetch from.
+    query_id: a string which identifies the query.
+    page: the page number, 0 offset.
+    page_size: the number of results per page.
+    cursor: the cursor to start from, if the client provided one.
+
+  Returns:
+    A tuple in the form (total, results, next_cursor)
+  """
+  generation = GetGeneration(memcache_keys.BROWSE_GENERATION)
+  count_key = '%s:%s:%s' % (memcache_keys.BROWSE_COUNT_PREFIX, generation,
+                            query_id)
+  total = memcache.get(count_key)
+  if total is None:
+    total = query.count()
+    memcache.set(count_key, total)
+
+  cursor_key = '%s:%s:%s:%%d' % (memcache_keys.BROWSE_CURSOR_PREFIX,
+                                 generation, query_id)
+  # A cursor from the client may be stale, or from a different page, so we
+  # only cache the next cursor if we know where this page started.
+  trusted = not cursor
+  if not cursor:
+    cursor = memcache.get(cursor_key % page)
+
+  results = None
+  if cursor:
+    try:
+      query.with_cursor(cursor)
+      results = query.fetch(page_size)
+    except (db.BadRequestError, db.BadValueError):
+      logging.info('Invalid cursor %s' % cursor)
+      query.with_cursor(None)
+  if results is None:
+    results = query.fetch(page_size, offset=page * page_size)
+    trusted = True
+
+  next_cursor = query.cursor()
+  if trusted:
+    memcache.set(cursor_key % (page + 1), next_cursor)
+  return total, results, next_cursor
+
 def MaybeSendEmail(new_responder_count):
   """Send an email there were previously no responders in the moderation queue
 
@@ -127,36 +571,32 @@ class BasePageHandler(webapp.RequestHandler):
     """Subclasses override this."""
     return {}
 
+  def PageCacheKey(self):
+    """Subclasses can override this to have the rendered page cached.
+
+    Returns:
+      A string which identifies the page, or None if it shouldn't be cached.
+    """
+    return None
+
   def get(self):
+    cache_key = self.PageCacheKey()
+    if cache_key is not None:
+      rendered_page = page_cache.Get(cache_key)
+      if rendered_page is not None:
+        self.response.headers['Content-Type'] = 'text/html'
+        self.response.out.write(rendered_page)
+        return
+
     output = self.IndexInfo()
     page_data = self.GetTemplateData()
     if page_data is not None:
       output.update(page_data)
+      rendered_page = template.render(self.TEMPLATE, output)
+      if cache_key is not None:
+        page_cache.Set(cache_key, rendered_page)
       self.response.headers['Content-Type'] = 'text/html'
-      self.response.out.write(template.render(self.TEMPLATE, output))
-
-  def ManufacturerPidCount(self):
-    """Return the number of manufacturer PIDs."""
-    manufacturer_pids = memcache.get(memcache_keys.MANUFACTURER_PID_COUNT_KEY)
-    if manufacturer_pids is None:
-      manufacturer_pids = 0
-
-      for pid in Pid.all():
-        if pid.manufacturer.esta_id != self.ESTA_ID:
-          manufacturer_pids += 1
-      if not memcache.add(memcache_keys.MANUFACTURER_PID_COUNT_KEY,
-                          manufacturer_pids):
-        logging.error("Memcache set failed.")
-    return manufacturer_pids
-
-  def ProductCount(self):
-    """Return the number of product."""
-    product_count = memcache.get(memcache_keys.PRODUCT_COUNT_KEY)
-    if product_count is None:
-      product_count = Responder.all().count() + Product.all().count()
-      if not memcache.add(memcache_keys.PRODUCT_COUNT_KEY, product_count):
-        logging.error("Memcache set failed.")
-    return product_count
+      self.response.out.write(rendered_page)
 
   def IndexInfo(self):
     """Get the information about the index.
@@ -170,13 +610,12 @@ class BasePageHandler(webapp.RequestHandler):
     output = memcache.get(memcache_keys.INDEX_INFO)
     if not output:
       output = {'last_updated': None}
-      results = LastUpdateTime.all()
-      results.order('-update_time')
-      update_timestamp = results.fetch(1)
-      if update_timestamp:
+      update_times = [t for t in GetUpdateTimes().itervalues() if t]
+      if update_times:
         output['last_updated'] = datetime.datetime(
-            *update_timestamp[0].update_time.timetuple()[0:6])
-      output['manufacturer_pid_count'] = self.ManufacturerPidCount()
-      output['product_count'] = self.ProductCount()
+            *max(update_times).timetuple()[0:6])
+      stats = index_stats.Get()
+      output['manufacturer_pid_count'] = stats.manufacturer_pid_count
+      output['product_count'] = stats.responder_count + stats.product_count
       memcache.set(memcache_keys.INDEX_INFO, output)
     return output
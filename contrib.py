@@ -23,6 +23,7 @@ from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from model import *
+from utils import PrefetchReferences
 
 
 class BaseContribPageHandler(webapp.RequestHandler):
@@ -88,7 +89,7 @@ class AddInfoResponderHandler(BaseContribPageHandler):
       if responder.link and responder.image_url:
         continue
       responders.append(responder)
-    return responders
+    return PrefetchReferences(responders, Responder.manufacturer)
 
   def BuildResponderList(self, responders):
     output = []
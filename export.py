@@ -17,20 +17,43 @@
 # The handlers for exporting information to third parties.
 
 from model import *
+from utils import PrefetchReferences, QueryByReference, StringToInt
 from utils import TimestampToInt
 import common
 import json
+import json_stream
 import logging
 import memcache_keys
+import pid_proto
+import snapshots
 import time
 import timestamp_keys
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
 
 
+def BuildTagMap(entity_property, entities):
+  """Load the tags for a batch of entities.
+
+  Args:
+    entity_property: the ReferenceProperty to the tagged entity, i.e.
+      ResponderTagRelationship.responder.
+    entities: the tagged entities.
+
+  Returns:
+    A dict of entity key to a list of tag labels.
+  """
+  relationships = QueryByReference(entity_property,
+                                   [entity.key() for entity in entities])
+  PrefetchReferences([r for rs in relationships.itervalues() for r in rs],
+                     entity_property.model_class.tag)
+  return dict((key, [r.tag.label for r in rs])
+              for key, rs in relationships.iteritems())
+
+
 class PidDefinitionsAsProto(webapp.RequestHandler):
   """Dump the PID definitions in protobuf format."""
-  ESTA_ID = 0
+  SNAPSHOT = snapshots.DOWNLOAD
 
   SUB_DEVICE_RANGE_TO_ENUM = {
     0: 'ROOT_DEVICE',
@@ -76,8 +99,8 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
 
     self.Write('}', indent)
 
-  def WriteMessage(self, type, message_str, indent=0):
-    message = eval(message_str)
+  def WriteMessage(self, type, key, message_str, indent=0):
+    message = common.DecodeMessage(key, message_str)
     self.Write('%s {' % type, indent)
     for item in message['items']:
       self.WriteItem(item, indent+2)
@@ -88,28 +111,16 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
     self.Write('  name: "%s"' % pid.name, indent)
     self.Write('  value: %d' % pid.pid_id, indent)
 
-    if pid.get_command:
-      self.WriteMessage('get_request', pid.get_command.request, indent + 2)
-      self.WriteMessage('get_response', pid.get_command.response, indent + 2)
-      self.Write('  get_sub_device_range: %s' %
-                 self.SUB_DEVICE_RANGE_TO_ENUM[pid.get_command.sub_device_range],
-                 indent)
-
-    if pid.discovery_command:
-      self.WriteMessage('discovery_request',
-                        pid.discovery_command.request, indent + 2)
-      self.WriteMessage('discovery_response',
-                        pid.discovery_command.response, indent + 2)
-      self.Write(
-          '  discovery_sub_device_range: %s' %
-          self.SUB_DEVICE_RANGE_TO_ENUM[pid.discovery_command.sub_device_range],
-          indent)
-
-    if pid.set_command:
-      self.WriteMessage('set_request', pid.set_command.request, indent + 2)
-      self.WriteMessage('set_response', pid.set_command.response, indent + 2)
-      self.Write('  set_sub_device_range: %s' %
-                 self.SUB_DEVICE_RANGE_TO_ENUM[pid.set_command.sub_device_range],
+    for command_type in Pid.COMMAND_TYPES:
+      if not pid.HasCommand(command_type):
+        continue
+      self.WriteMessage('%s_request' % command_type, pid.key(),
+                        getattr(pid, '%s_request' % command_type), indent + 2)
+      self.WriteMessage('%s_response' % command_type, pid.key(),
+                        getattr(pid, '%s_response' % command_type), indent + 2)
+      sub_device_range = self.SUB_DEVICE_RANGE_TO_ENUM[
+          getattr(pid, '%s_sub_device_range' % command_type)]
+      self.Write('  %s_sub_device_range: %s' % (command_type, sub_device_range),
                  indent)
 
     self.Write('}', indent)
@@ -124,120 +135,189 @@ class PidDefinitionsAsProto(webapp.RequestHandler):
     self.Write('}')
 
   def get(self):
-    esta_manufacturer = common.GetManufacturer(self.ESTA_ID)
     self.response.headers['Content-Type'] = 'text/plain'
-
+    use_gzip = snapshots.NegotiateGzip(self)
+    if common.CheckNotModified(self, snapshots.SNAPSHOTS[self.SNAPSHOT],
+                               use_gzip and 'gzip' or ''):
+      return
+    if (not self.request.query_string and
+        snapshots.Serve(self, self.SNAPSHOT, use_gzip)):
+      return
+    snapshots.ServeCached(self, self.SNAPSHOT, self.Generate, use_gzip)
+
+  def Generate(self):
+    """Write the PID definitions."""
     # Can be '', 'esta', 'esta-draft' or 'manufacturers'
-    pid_selection = self.request.get('pids')
-    pids = Pid.all()
-
-    if pid_selection == 'esta':
-      pids.filter('draft =', False)
-      pids.filter('manufacturer = ', esta_manufacturer)
-    elif pid_selection == 'esta-draft':
-      pids.filter('draft =', True)
-      pids.filter('manufacturer = ', esta_manufacturer)
-    elif pid_selection == "manufacturers":
-      pids.filter('manufacturer != ', esta_manufacturer)
-
-    manufacturers = {}
-    esta_pids = []
-    for pid in pids:
-      if pid.manufacturer.esta_id == self.ESTA_ID:
-        esta_pids.append(pid)
-      else:
-        #Build the hash of manufacturer pids by manufacturer
-        manufacturers.setdefault(pid.manufacturer.esta_id, []).append(pid)
-
-    esta_pids.sort(key=lambda p: p.pid_id)
+    esta_pids, manufacturer_pids = pid_proto.LoadPids(self.request.get('pids'))
     for pid in esta_pids:
       self.WritePid(pid)
 
-    for manufacturer_id in sorted(manufacturers):
-      manufacturer_pids = manufacturers[manufacturer_id]
-      manufacturer_pids.sort(key=lambda p: p.pid_id)
-      self.WriteManufacturer(manufacturers[manufacturer_id][0].manufacturer,
-                             manufacturer_pids)
+    for manufacturer, pids in manufacturer_pids:
+      self.WriteManufacturer(manufacturer, pids)
 
-    query = LastUpdateTime.all()
-    query.filter('name = ', timestamp_keys.PIDS)
-    update_time = query.fetch(1)
+    update_time = common.GetUpdateTimes().get(timestamp_keys.PIDS)
     if update_time:
-      timestamp = TimestampToInt(update_time[0].update_time)
-      self.Write('version: %d' % timestamp)
+      self.Write('version: %d' % TimestampToInt(update_time))
 
 
-class ExportModelsHandler(webapp.RequestHandler):
-  """Return all device models for the RDM Protocol Site.
+class BatchedExportHandler(webapp.RequestHandler):
+  """The base class for exports that write a list of entities.
 
-  This is used by the rdmprotocol.org site. Don't change the format without
-  checking in with Peter Kirkup.
+  The entities are read and encoded a batch at a time, the response itself is
+  buffered until the handler returns. By default the output is a single JSON
+  document. With format=ndjson each entity is written on its
+  own line, at most ?limit= of them, and if there are more the X-Next-Cursor
+  header holds the ?cursor= to continue from.
+
+  Without any query parameters the output is served from the stored
+  snapshot, otherwise it's cached in memcache. Either way it's gzipped if the
+  client accepts it, see snapshots.py.
+
+  Sub classes provide LIST_NAME, SNAPSHOT, Query() & BuildItem(entity).
   """
-  def get(self):
-    self.response.headers['Content-Type'] = 'text/plain'
-    results = Responder.all()
+  BATCH_SIZE = 100
+  NDJSON_LIMIT = 1000
 
-    models = []
-    for model in results:
-      model_output = {
-        'manufacturer_name': model.manufacturer.name,
-        'manufacturer_id': model.manufacturer.esta_id,
-        'device_model_id': model.device_model_id,
-        'model_description': model.model_description,
-      }
-      if model.link:
-        model_output['link'] = model.link
-      if model.image_url:
-        model_output['image_url'] = model.image_url
-      tags = list(model.tag_set)
-      if tags:
-        tags = []
-        for tag in model.tag_set:
-          tags.append(tag.tag.label)
-        model_output['tags'] = tags
+  def PrepareBatch(self, entities):
+    """Called with each batch of entities before they're written.
 
-      models.append(model_output)
-    self.response.out.write(json.dumps({'models': models}))
+    Sub classes load the related entities here, for just this batch, so the
+    memory used doesn't grow with the number of entities.
+    """
+    pass
 
+  def get(self):
+    ndjson = self.request.get('format') == 'ndjson'
+    if ndjson:
+      self.response.headers['Content-Type'] = 'application/x-ndjson'
+    else:
+      self.response.headers['Content-Type'] = 'text/plain'
+    use_gzip = snapshots.NegotiateGzip(self)
+    if common.CheckNotModified(self, snapshots.SNAPSHOTS[self.SNAPSHOT],
+                               use_gzip and 'gzip' or ''):
+      return
+    if (not self.request.query_string and
+        snapshots.Serve(self, self.SNAPSHOT, use_gzip)):
+      return
+    snapshots.ServeCached(self, self.SNAPSHOT, lambda: self.Generate(ndjson),
+                          use_gzip)
+
+  def Generate(self, ndjson=False):
+    """Write the list of entities."""
+    query = self.Query()
+    if ndjson:
+      writer = json_stream.NdjsonWriter(self.response.out)
+      limit = StringToInt(self.request.get('limit'), False)
+      if limit is None or limit <= 0 or limit > self.NDJSON_LIMIT:
+        limit = self.NDJSON_LIMIT
+      cursor = self.request.get('cursor')
+      if cursor:
+        try:
+          query.with_cursor(cursor)
+        except (db.BadRequestError, db.BadValueError):
+          self.error(400)
+          return
+    else:
+      writer = json_stream.JsonListWriter(self.response.out, self.LIST_NAME)
+      limit = None
+
+    writer.Start()
+    written = 0
+    while limit is None or written < limit:
+      batch_size = self.BATCH_SIZE
+      if limit is not None:
+        batch_size = min(batch_size, limit - written)
+      entities = query.fetch(batch_size)
+      self.PrepareBatch(entities)
+      for entity in entities:
+        writer.Write(self.BuildItem(entity))
+      written += len(entities)
+      if len(entities) < batch_size:
+        break
+      cursor = query.cursor()
+      query.with_cursor(cursor)
+    else:
+      # the limit was reached, only hand out the cursor if there's more
+      if query.fetch(1):
+        self.response.headers['X-Next-Cursor'] = str(cursor)
+    writer.End()
+
+
+class ExportModelsHandler(BatchedExportHandler):
+  """Return all device models for the RDM Protocol Site.
 
-class ExportControllersHandler(webapp.RequestHandler):
+  This is used by the rdmprotocol.org site. Don't change the format without
+  checking in with Peter Kirkup.
+  """
+  LIST_NAME = 'models'
+  SNAPSHOT = snapshots.EXPORT_MODELS
+
+  def Query(self):
+    return Responder.all()
+
+  def PrepareBatch(self, models):
+    PrefetchReferences(models, Responder.manufacturer)
+    self._tags = BuildTagMap(ResponderTagRelationship.responder, models)
+
+  def BuildItem(self, model):
+    model_output = {
+      'manufacturer_name': model.manufacturer.name,
+      'manufacturer_id': model.manufacturer.esta_id,
+      'device_model_id': model.device_model_id,
+      'model_description': model.model_description,
+    }
+    if model.link:
+      model_output['link'] = model.link
+    if model.image_url:
+      model_output['image_url'] = model.image_url
+    tags = self._tags.get(model.key())
+    if tags:
+      model_output['tags'] = tags
+    return model_output
+
+
+class ExportControllersHandler(BatchedExportHandler):
   """Return all controllers for the RDM Protocol Site.
 
   This is used by the rdmprotocol.org site. Don't change the format without
   checking in with Peter Kirkup.
   """
-  def get(self):
-    self.response.headers['Content-Type'] = 'text/plain'
-    results = Controller.all()
-
-    controllers = []
-    for controller in Controller.all():
-      controller_output = {
-        'manufacturer_name': controller.manufacturer.name,
-        'key': str(controller.key()),
-        'name': controller.name,
-      }
-      if controller.link:
-        controller_output['link'] = controller.link
-      if controller.image_url:
-        controller_output['image_url'] = controller.image_url
-      tags = list(controller.tag_set)
-      if tags:
-        tags = []
-        for tag in controller.tag_set:
-          tags.append(tag.tag.label)
-        controller_output['tags'] = tags
-
-      controllers.append(controller_output)
-    self.response.out.write(json.dumps({'controllers': controllers}))
+  LIST_NAME = 'controllers'
+  SNAPSHOT = snapshots.EXPORT_CONTROLLERS
+
+  def Query(self):
+    return Controller.all()
+
+  def PrepareBatch(self, controllers):
+    PrefetchReferences(controllers, Controller.manufacturer)
+    self._tags = BuildTagMap(ProductTagRelationship.product, controllers)
+
+  def BuildItem(self, controller):
+    controller_output = {
+      'manufacturer_name': controller.manufacturer.name,
+      'key': str(controller.key()),
+      'name': controller.name,
+    }
+    if controller.link:
+      controller_output['link'] = controller.link
+    if controller.image_url:
+      controller_output['image_url'] = controller.image_url
+    tags = self._tags.get(controller.key())
+    if tags:
+      controller_output['tags'] = tags
+    return controller_output
 
 
 class MissingModelsHandler(webapp.RequestHandler):
   """Return all device models that are missing info / image urls in csv."""
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, [timestamp_keys.DEVICES,
+                                      timestamp_keys.MANUFACTURERS]):
+      return
     results = Responder.all()
     results.order('device_model_id')
+    results = PrefetchReferences(list(results), Responder.manufacturer)
 
     models = []
     self.response.out.write(
@@ -273,59 +353,94 @@ class InfoHandler(webapp.RequestHandler):
   """
   ESTA_ID = 0
 
+  # timestamp name : json key
+  TIMESTAMP_PAIRS = {
+      timestamp_keys.CONTROLLERS: 'controller_update_time',
+      timestamp_keys.DEVICES: 'device_update_time',
+      timestamp_keys.MANUFACTURERS: 'manufacturer_update_time',
+      timestamp_keys.PIDS: 'pid_update_time',
+  }
+
   def get(self):
     self.response.headers['Content-Type'] = 'text/plain'
+    if common.CheckNotModified(self, self.TIMESTAMP_PAIRS.keys()):
+      return
 
     output = {}
     # update timestamps for pids & devices
-    for update_timestamp in LastUpdateTime.all():
-      if update_timestamp.name == timestamp_keys.CONTROLLERS:
-        output['controller_update_time'] = TimestampToInt(
-            update_timestamp.update_time)
-      elif update_timestamp.name == timestamp_keys.DEVICES:
-        output['device_update_time'] = TimestampToInt(
-            update_timestamp.update_time)
-      elif update_timestamp.name == timestamp_keys.PIDS:
-        output['pid_update_time'] = TimestampToInt(
-            update_timestamp.update_time)
-      elif update_timestamp.name == timestamp_keys.MANUFACTURERS:
-        output['manufacturer_update_time'] = TimestampToInt(
-            update_timestamp.update_time)
+    for name, update_time in common.GetUpdateTimes().iteritems():
+      if name in self.TIMESTAMP_PAIRS:
+        output[self.TIMESTAMP_PAIRS[name]] = TimestampToInt(update_time)
 
     self.response.out.write(json.dumps(output))
 
-class ModelInfoHandler(webapp.RequestHandler):
+class ModelInfoHandler(BatchedExportHandler):
   """Return responder model info."""
-  def get(self):
-    self.response.headers['Content-Type'] = 'text/plain'
-    results = Responder.all()
-
-    models = []
-    for model in results:
-      model_output = {
-        'manufacturer_name': model.manufacturer.name,
-        'manufacturer_id': model.manufacturer.esta_id,
-        'device_model_id': model.device_model_id,
-        'model_description': model.model_description,
-        'software_versions': [],
+  LIST_NAME = 'models'
+  SNAPSHOT = snapshots.MODEL_INFO
+
+  def Query(self):
+    return Responder.all()
+
+  def PrepareBatch(self, models):
+    PrefetchReferences(models, Responder.manufacturer)
+    # the queries for each model in the batch run in parallel
+    self._versions = QueryByReference(SoftwareVersion.responder,
+                                      [model.key() for model in models])
+    self._personalities = QueryByReference(
+        ResponderPersonality.sw_version,
+        [version.key() for versions in self._versions.itervalues()
+         for version in versions])
+
+  def BuildItem(self, model):
+    model_output = {
+      'manufacturer_name': model.manufacturer.name,
+      'manufacturer_id': model.manufacturer.esta_id,
+      'device_model_id': model.device_model_id,
+      'model_description': model.model_description,
+      'software_versions': [],
+    }
+    for software in self._versions.get(model.key(), []):
+      software_output = {
+        'id': software.version_id,
+        'label': software.label,
+        'personalities': [],
       }
-      models.append(model_output)
-      for software in model.software_version_set:
-        software_output = {
-          'id': software.version_id,
-          'label': software.label,
-          'personalities': [],
+      for personality in self._personalities.get(software.key(), []):
+        personality_output = {
+          'description': personality.description,
+          'index': personality.index,
+          'slot_count': personality.slot_count,
         }
-        for personality in software.personality_set:
-          personality_output = {
-            'description': personality.description,
-            'index': personality.index,
-            'slot_count': personality.slot_count,
-          }
-          software_output['personalities'].append(personality_output)
-        model_output['software_versions'].append(software_output)
-
-    self.response.out.write(json.dumps({'models': models}))
+        software_output['personalities'].append(personality_output)
+      model_output['software_versions'].append(software_output)
+    return model_output
+
+
+# snapshot name : the handler which builds it
+SNAPSHOT_HANDLERS = {
+  snapshots.DOWNLOAD: PidDefinitionsAsProto,
+  snapshots.EXPORT_CONTROLLERS: ExportControllersHandler,
+  snapshots.EXPORT_MODELS: ExportModelsHandler,
+  snapshots.MODEL_INFO: ModelInfoHandler,
+}
+
+
+def BuildSnapshot(name):
+  """Run the handler for an export and store the output.
+
+  Args:
+    name: the name of the snapshot, one of snapshots.SNAPSHOTS.
+  """
+  # take the version first, so that changes made while we're running cause a
+  # rebuild
+  version = snapshots.Version(name)
+  handler = SNAPSHOT_HANDLERS[name]()
+  handler.initialize(webapp.Request.blank('/%s' % name), webapp.Response())
+  handler.response.headers['Content-Type'] = 'text/plain'
+  handler.Generate()
+  snapshots.Store(name, version, handler.response.headers['Content-Type'],
+                  handler.response.body)
 
 
 export_application = webapp.WSGIApplication(
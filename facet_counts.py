@@ -0,0 +1,248 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# facet_counts.py
+# Copyright (C) 2012 Simon Newton
+# The per-manufacturer, per-category & per-tag counts used by the sidebars.
+
+import json
+import logging
+import memcache_keys
+from model import *
+from google.appengine.api import memcache
+
+# The facets. Each one is stored in a FacetCounts entity, and the name doubles
+# as the memcache key for the sidebar data built from it.
+MANUFACTURER_PIDS = memcache_keys.MANUFACTURER_PID_COUNTS
+MANUFACTURER_MODELS = memcache_keys.MANUFACTURER_MODEL_COUNTS
+CATEGORY_MODELS = memcache_keys.CATEGORY_MODEL_COUNTS
+TAG_MODELS = memcache_keys.TAG_MODEL_COUNTS
+
+# Product class name to (manufacturer facet, tag facet)
+PRODUCT_FACETS = {
+  'Controller': (memcache_keys.MANUFACTURER_CONTROLLER_COUNTS,
+                 memcache_keys.TAG_CONTROLLER_COUNTS),
+  'Node': (memcache_keys.MANUFACTURER_NODE_COUNTS,
+           memcache_keys.TAG_NODE_COUNTS),
+  'Software': (memcache_keys.MANUFACTURER_SOFTWARE_COUNTS,
+               memcache_keys.TAG_SOFTWARE_COUNTS),
+  'Splitter': (memcache_keys.MANUFACTURER_SPLITTER_COUNTS,
+               memcache_keys.TAG_SPLITTER_COUNTS),
+}
+
+# The facets keyed by manufacturer
+MANUFACTURER_FACETS = ([MANUFACTURER_PIDS, MANUFACTURER_MODELS] +
+                       [m for m, t in PRODUCT_FACETS.itervalues()])
+
+
+def _NewRow(facet_id, name, hidden=False):
+  return {'id': facet_id, 'name': name, 'count': 0, 'hidden': hidden}
+
+
+def _CountManufacturers(query_function):
+  """Count the entities for each manufacturer.
+
+  Args:
+    query_function: called with a Manufacturer, returns the query to count.
+  """
+  rows = {}
+  for manufacturer in Manufacturer.all():
+    row = _NewRow(manufacturer.esta_id, manufacturer.name)
+    row['count'] = query_function(manufacturer).count(None)
+    rows[str(manufacturer.esta_id)] = row
+  return rows
+
+
+def _CountCategories():
+  rows = {}
+  for category in ProductCategory.all():
+    row = _NewRow(category.id, category.name)
+    row['count'] = category.responder_set.count(None)
+    rows[str(category.id)] = row
+  return rows
+
+
+def _CountResponderTags():
+  rows = {}
+  for tag in ResponderTag.all():
+    row = _NewRow(tag.label, tag.label, tag.exclude_from_search)
+    row['count'] = tag.responder_set.count(None)
+    rows[tag.label] = row
+  return rows
+
+
+def _CountProductManufacturers(product_class):
+  rows = {}
+  for product in product_class.all():
+    manufacturer = product.manufacturer
+    key = str(manufacturer.esta_id)
+    if key not in rows:
+      rows[key] = _NewRow(manufacturer.esta_id, manufacturer.name)
+    rows[key]['count'] += 1
+  return rows
+
+
+def _CountProductTags(product_class):
+  query = ProductTag.all()
+  query.filter('product_type = ', product_class.class_name())
+  rows = {}
+  for tag in query:
+    row = _NewRow(tag.label, tag.label, tag.exclude_from_search)
+    row['count'] = tag.product_set.count(None)
+    rows[tag.label] = row
+  return rows
+
+
+def _Builders():
+  """Return a dict of facet name to the function that counts it from
+     scratch.
+  """
+  builders = {
+    MANUFACTURER_PIDS: lambda: _CountManufacturers(lambda m: m.pid_set),
+    MANUFACTURER_MODELS: lambda: _CountManufacturers(
+        lambda m: m.responder_set),
+    CATEGORY_MODELS: _CountCategories,
+    TAG_MODELS: _CountResponderTags,
+  }
+  for product_class in (Controller, Node, Software, Splitter):
+    manufacturer_facet, tag_facet = PRODUCT_FACETS[product_class.class_name()]
+    builders[manufacturer_facet] = (
+        lambda c=product_class: _CountProductManufacturers(c))
+    builders[tag_facet] = lambda c=product_class: _CountProductTags(c)
+  return builders
+
+
+def _Store(facet, rows):
+  FacetCounts(key_name=facet, counts=json.dumps(rows)).put()
+  memcache.delete(facet)
+
+
+def Rebuild(facet):
+  """Count a facet from scratch. This is expensive.
+
+  Returns:
+    The dict of rows.
+  """
+  rows = _Builders()[facet]()
+  _Store(facet, rows)
+  logging.info('Rebuilt facet counts for %s' % facet)
+  return rows
+
+
+def Clear(facet):
+  """Reset a facet, this is used once all the entities have been deleted."""
+  _Store(facet, {})
+
+
+def Get(facet):
+  """Get the counts for a facet.
+
+  Args:
+    facet: the facet name.
+
+  Returns:
+    A list of dicts with id, name & count keys, sorted by name. Entries with a
+    count of 0, or which have been excluded from search are skipped.
+  """
+  entity = FacetCounts.get_by_key_name(facet)
+  if entity is None:
+    rows = Rebuild(facet)
+  else:
+    rows = json.loads(entity.counts)
+
+  output = []
+  for row in rows.itervalues():
+    if row['count'] > 0 and not row['hidden']:
+      output.append({
+        'id': row['id'],
+        'name': row['name'],
+        'count': row['count'],
+      })
+  output.sort(key=lambda x: x['name'])
+  return output
+
+
+def UpdateNames(facets, names):
+  """Update the names stored in facets, used when manufacturers are renamed.
+
+  Args:
+    facets: the list of facet names to update
+    names: a dict of id to new name.
+  """
+  def Update(facet):
+    entity = FacetCounts.get_by_key_name(facet)
+    if entity is None:
+      return
+    rows = json.loads(entity.counts)
+    for facet_id, name in names.iteritems():
+      row = rows.get(str(facet_id))
+      if row is not None:
+        row['name'] = name
+    entity.counts = json.dumps(rows)
+    entity.put()
+
+  if not names:
+    return
+  for facet in facets:
+    db.run_in_transaction(Update, facet)
+    memcache.delete(facet)
+
+
+class FacetUpdater(object):
+  """Collects changes to the facet counts while loading data, and then writes
+     them with one transaction per facet.
+  """
+  def __init__(self):
+    # facet to {id: row}, where the row holds the delta
+    self._changes = {}
+
+  def Adjust(self, facet, facet_id, name, delta, hidden=False):
+    """Record a change in the number of entities for a facet value.
+
+    Args:
+      facet: the facet name
+      facet_id: the manufacturer id, category id or tag label
+      name: the name to display
+      delta: the change in the count
+      hidden: True if this value shouldn't be displayed.
+    """
+    rows = self._changes.setdefault(facet, {})
+    key = unicode(facet_id)
+    if key not in rows:
+      rows[key] = _NewRow(facet_id, name, hidden)
+    rows[key]['count'] += delta
+
+  def _ApplyChanges(self, facet, changes):
+    entity = FacetCounts.get_by_key_name(facet)
+    if entity is None:
+      # it'll be counted from scratch when it's next requested
+      return
+    rows = json.loads(entity.counts)
+    for key, change in changes.iteritems():
+      row = rows.setdefault(
+          key, _NewRow(change['id'], change['name'], change['hidden']))
+      row['name'] = change['name']
+      row['hidden'] = change['hidden']
+      row['count'] = max(0, row['count'] + change['count'])
+      if row['count'] == 0:
+        del rows[key]
+    entity.counts = json.dumps(rows)
+    entity.put()
+
+  def Apply(self):
+    """Write the changes to the datastore."""
+    for facet, changes in self._changes.iteritems():
+      db.run_in_transaction(self._ApplyChanges, facet, changes)
+      memcache.delete(facet)
+    self._changes = {}
@@ -86,11 +86,9 @@ class HandleModelData(webapp.RequestHandler):
 
       # See if we can get the manufacturer name
       manufacturer_name = None
-      manufacturer_query = Manufacturer.all()
-      manufacturer_query.filter('esta_id = ', manufacturer_id)
-      results = manufacturer_query.fetch(1)
-      if results:
-        manufacturer_name = results[0].name
+      manufacturer = common.GetManufacturer(manufacturer_id)
+      if manufacturer:
+        manufacturer_name = manufacturer.name
 
       for responder in responders:
         if 'device_model' not in responder:
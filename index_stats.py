@@ -0,0 +1,85 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# index_stats.py
+# Copyright (C) 2012 Simon Newton
+# Maintain the counts of products & PIDs in the index.
+
+import logging
+import memcache_keys
+from model import *
+from google.appengine.api import memcache
+
+ESTA_ID = 0
+KEY_NAME = 'index'
+
+
+def Get():
+  """Get the IndexStatistics entity, building it if it doesn't exist."""
+  stats = IndexStatistics.get_by_key_name(KEY_NAME)
+  if stats is None:
+    stats = Rebuild()
+  return stats
+
+
+def Rebuild():
+  """Recount everything and store the result.
+
+  This is expensive, it's used after large deletes, or if the statistics
+  entity doesn't exist.
+
+  Returns:
+    The new IndexStatistics entity.
+  """
+  manufacturer_pids = Pid.all(keys_only=True)
+  esta = Manufacturer.all().filter('esta_id = ', ESTA_ID).get()
+  if esta is not None:
+    manufacturer_pids.filter('manufacturer != ', esta.key())
+
+  stats = IndexStatistics(
+      key_name = KEY_NAME,
+      responder_count = Responder.all(keys_only=True).count(None),
+      product_count = Product.all(keys_only=True).count(None),
+      manufacturer_pid_count = manufacturer_pids.count(None))
+  stats.put()
+  logging.info('Rebuilt index statistics')
+  memcache.delete(memcache_keys.INDEX_INFO)
+  return stats
+
+
+def Adjust(responders=0, products=0, manufacturer_pids=0):
+  """Transactionally update the counts.
+
+  Args:
+    responders: the change in the number of responders.
+    products: the change in the number of (non-responder) products.
+    manufacturer_pids: the change in the number of manufacturer PIDs.
+  """
+  if not (responders or products or manufacturer_pids):
+    return
+
+  def Update():
+    stats = IndexStatistics.get_by_key_name(KEY_NAME)
+    if stats is None:
+      return False
+    stats.responder_count += responders
+    stats.product_count += products
+    stats.manufacturer_pid_count += manufacturer_pids
+    stats.put()
+    return True
+
+  if not db.run_in_transaction(Update):
+    # the new entities will be included in the count
+    Rebuild()
+  memcache.delete(memcache_keys.INDEX_INFO)
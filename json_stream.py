@@ -0,0 +1,59 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# json_stream.py
+# Copyright (C) 2012 Simon Newton
+# Write JSON documents an item at a time.
+
+import json
+
+
+class JsonListWriter(object):
+  """Writes a document in the form {"name": [item, item, ...]}.
+
+  The output is identical to json.dumps({name: items}), but each item is
+  encoded as it's built, rather than holding all the items in a list.
+  """
+  def __init__(self, out, list_name):
+    self._out = out
+    self._list_name = list_name
+    self._count = 0
+
+  def Start(self):
+    self._out.write('{%s: [' % json.dumps(self._list_name))
+
+  def Write(self, item):
+    if self._count:
+      self._out.write(', ')
+    self._out.write(json.dumps(item))
+    self._count += 1
+
+  def End(self):
+    self._out.write(']}')
+
+
+class NdjsonWriter(object):
+  """Writes newline delimited JSON, one item per line."""
+  def __init__(self, out):
+    self._out = out
+
+  def Start(self):
+    pass
+
+  def Write(self, item):
+    self._out.write(json.dumps(item))
+    self._out.write('\n')
+
+  def End(self):
+    pass
@@ -0,0 +1,224 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# key_migrator.py
+# Copyright (C) 2012 Simon Newton
+# Move Manufacturers, Responders, PIDs & LastUpdateTimes onto deterministic
+# key names.
+
+import logging
+import common
+import legacy_data
+import pid_index_builder
+import pid_search
+import responder_search
+import search_index
+import timestamp_keys
+import update_times
+from model import *
+
+
+class KeyMigrator(object):
+  """Re-key entities so they can be fetched with a single get.
+
+  The migration is split into stages, one per kind. Each call to RunBatch()
+  processes one batch and returns where to resume from, so the work can be
+  spread over a chain of tasks. Every step is safe to repeat: the new entity
+  is written first, then the references & child entities are moved and
+  finally the old entity is deleted. Once the last stage completes, the
+  lookups stop falling back to the old keys, see legacy_data.py.
+  """
+  BATCH_SIZE = 50
+
+  MANUFACTURERS = 'manufacturers'
+  RESPONDERS = 'responders'
+  PIDS = 'pids'
+  TIMESTAMPS = 'timestamps'
+  STAGES = [MANUFACTURERS, RESPONDERS, PIDS, TIMESTAMPS]
+
+  def __init__(self):
+    # manufacturer key to esta id
+    self._esta_ids = {}
+
+  def _CopyEntity(self, entity, key_name):
+    """Create a copy of an entity with a new key name."""
+    kind = entity.__class__
+    values = {}
+    for name, prop in kind.properties().iteritems():
+      values[name] = prop.get_value_for_datastore(entity)
+    return kind(key_name=key_name, **values)
+
+  def _EstaId(self, entity):
+    """Return the esta id of the manufacturer an entity refers to."""
+    key = entity.__class__.manufacturer.get_value_for_datastore(entity)
+    if key not in self._esta_ids:
+      self._esta_ids[key] = db.get(key).esta_id
+    return self._esta_ids[key]
+
+  def _MigrateManufacturer(self, manufacturer):
+    key_name = Manufacturer.KeyName(manufacturer.esta_id)
+    if manufacturer.key().name() == key_name:
+      return False
+
+    new_manufacturer = self._CopyEntity(manufacturer, key_name)
+    new_manufacturer.put()
+
+    old_key = manufacturer.key()
+    for kind in (Responder, Product, Pid):
+      query = kind.all()
+      query.filter('manufacturer = ', old_key)
+      entities = []
+      for entity in query:
+        entity.manufacturer = new_manufacturer.key()
+        entities.append(entity)
+      db.put(entities)
+
+    manufacturer.delete()
+    return True
+
+  def _MigrateResponder(self, responder):
+    key_name = Responder.KeyName(self._EstaId(responder),
+                                 responder.device_model_id)
+    if responder.key().name() == key_name:
+      return False
+
+    new_responder = self._CopyEntity(responder, key_name)
+    new_responder.put()
+
+    old_key = responder.key()
+    entities = []
+    for version in responder.software_version_set:
+      version.responder = new_responder.key()
+      entities.append(version)
+    for relationship in responder.tag_set:
+      relationship.responder = new_responder.key()
+      entities.append(relationship)
+
+    # the search index entry is a child of the responder, it's rebuilt once
+    # this stage is complete
+    entities_to_delete = [search_index.EntryKey(responder_search.KIND,
+                                                old_key)]
+
+    # the PID index change log is keyed by the responder key
+    changes = list(responder.change_set)
+    if changes:
+      pid_index_builder.RecordResponderChange(new_responder)
+      db.delete(changes)
+
+    query = Pid.all()
+    query.filter('responders = ', old_key)
+    for pid in query:
+      pid.responders = [new_responder.key() if key == old_key else key
+                        for key in pid.responders]
+      entities.append(pid)
+    db.put(entities)
+    db.delete(entities_to_delete)
+
+    responder.delete()
+    return True
+
+  def _MigratePid(self, pid):
+    key_name = Pid.KeyName(self._EstaId(pid), pid.pid_id)
+    if pid.key().name() == key_name:
+      return False
+
+    new_pid = self._CopyEntity(pid, key_name)
+    new_pid.put()
+
+    query = PidSupportShard.all()
+    query.ancestor(pid.key())
+    shards = query.fetch(None)
+    db.put([PidSupportShard(parent=new_pid.key(),
+                            key_name=shard.key().name(),
+                            entries=shard.entries)
+            for shard in shards])
+    db.delete(shards)
+
+    # the search index entry is a child of the PID
+    db.delete(search_index.EntryKey(pid_search.KIND, pid.key()))
+    pid_search.IndexPids([new_pid])
+
+    pid.delete()
+    return True
+
+  def _MigrateTimestamp(self, timestamp):
+    if timestamp.key().name() == timestamp.name:
+      return False
+
+    # if there is already one keyed by name, it's newer
+    if LastUpdateTime.get_by_key_name(timestamp.name) is None:
+      self._CopyEntity(timestamp, timestamp.name).put()
+    timestamp.delete()
+    return True
+
+  def RunBatch(self, stage=None, cursor=None):
+    """Migrate a batch of entities.
+
+    Args:
+      stage: the stage to run, defaults to the first stage.
+      cursor: the cursor to resume from, or None.
+
+    Returns:
+      A tuple in the form (stage, cursor) to resume from, or (None, None) once
+      the migration is complete.
+    """
+    if stage is None:
+      stage = self.STAGES[0]
+
+    if stage == self.MANUFACTURERS:
+      query = Manufacturer.all()
+      migrate = self._MigrateManufacturer
+    elif stage == self.RESPONDERS:
+      query = Responder.all()
+      migrate = self._MigrateResponder
+    elif stage == self.PIDS:
+      query = Pid.all()
+      migrate = self._MigratePid
+    elif stage == self.TIMESTAMPS:
+      query = LastUpdateTime.all()
+      migrate = self._MigrateTimestamp
+    else:
+      logging.error('Unknown migration stage %s' % stage)
+      return None, None
+
+    if cursor:
+      query.with_cursor(cursor)
+    entities = query.fetch(self.BATCH_SIZE)
+
+    migrated = 0
+    for entity in entities:
+      if migrate(entity):
+        migrated += 1
+    logging.info('Migrated %d of %d %s' % (migrated, len(entities), stage))
+
+    if len(entities) == self.BATCH_SIZE:
+      return stage, query.cursor()
+
+    # This stage is complete, drop anything cached against the old keys.
+    if stage == self.MANUFACTURERS:
+      update_times.UpdateModificationTime(timestamp_keys.MANUFACTURERS)
+    elif stage == self.RESPONDERS:
+      responder_search.ScheduleRebuild()
+      update_times.UpdateModificationTime(timestamp_keys.DEVICES)
+    elif stage == self.PIDS:
+      common.BuildPidNames()
+      update_times.UpdateModificationTime(timestamp_keys.PIDS)
+    else:
+      common.BuildUpdateTimes()
+
+    index = self.STAGES.index(stage) + 1
+    if index < len(self.STAGES):
+      return self.STAGES[index], None
+    legacy_data.MarkComplete(legacy_data.KEYS)
+    return None, None
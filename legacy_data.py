@@ -0,0 +1,73 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# legacy_data.py
+# Copyright (C) 2012 Simon Newton
+# Track which data migrations have completed.
+#
+# Until a migration has run, some entities are still stored in their old
+# form, so the code which reads them falls back to the old form. Every one of
+# those fallbacks is guarded by Exists(), and is skipped once the migration
+# has completed. When all the migrations have completed everywhere, remove
+# the fallbacks, the migration tasks & this module.
+
+import memcache_keys
+from google.appengine.api import memcache
+from model import *
+
+# Manufacturers, Responders, PIDs & LastUpdateTimes onto key names, run by
+# /tasks/migrate_entity_keys, see key_migrator.py.
+KEYS = 'keys'
+# Command entities into the Pid entities, with the messages as JSON, run by
+# /tasks/migrate_pid_commands.
+COMMANDS = 'commands'
+# The latest software details onto each Responder, run by
+# /tasks/update_latest_software.
+LATEST_SOFTWARE = 'latest_software'
+
+# the migrations this instance has seen complete, they never revert
+_completed = set()
+
+
+def _CacheKey(migration):
+  return '%s:%s' % (memcache_keys.MIGRATION_PREFIX, migration)
+
+
+def Exists(migration):
+  """Check if there may still be data that a migration hasn't moved.
+
+  Args:
+    migration: one of the migrations above.
+
+  Returns:
+    True until the migration has completed.
+  """
+  if migration in _completed:
+    return False
+
+  completed = memcache.get(_CacheKey(migration))
+  if completed is None:
+    completed = CompletedMigration.get_by_key_name(migration) is not None
+    # use add so we don't clobber the value from MarkComplete()
+    memcache.add(_CacheKey(migration), completed)
+  if completed:
+    _completed.add(migration)
+  return not completed
+
+
+def MarkComplete(migration):
+  """Record that a migration has completed, which disables its fallbacks."""
+  CompletedMigration(key_name=migration).put()
+  memcache.set(_CacheKey(migration), True)
+  _completed.add(migration)
@@ -16,15 +16,9 @@
 # Copyright (C) 2011 Simon Newton
 # The keys used for memcache.
 
-# Number of products inc. devices
-PRODUCT_COUNT_KEY = 'product_count'
-
 # Number of manufacturer pids
 MANUFACTURER_CACHE_KEY = 'manufacturers'
 
-# Number of manufacturer pids
-MANUFACTURER_PID_COUNT_KEY = 'manufacturer_pid_count'
-
 # PID manufacturer counts
 MANUFACTURER_PID_COUNTS = 'manufacturer_pids'
 
@@ -63,3 +57,53 @@ TAG_SPLITTER_COUNTS = 'tag_splitters'
 
 # Index info data
 INDEX_INFO = 'index_info'
+
+# The last update time of each section of the index
+UPDATE_TIMES = 'update_times'
+
+# The (build_time, content) of the PID usage statistics
+PID_USAGE = 'pid_usage'
+
+# (manufacturer_id, pid_id) to PID name mapping
+PID_NAMES = 'pid_names'
+
+# The generation of the browse page counts & cursors
+BROWSE_GENERATION = 'browse_generation'
+
+# Prefix for the total counts of the browse queries
+BROWSE_COUNT_PREFIX = 'browse_count'
+
+# Prefix for the start cursors of the browse pages
+BROWSE_CURSOR_PREFIX = 'browse_cursor'
+
+# The generation of the rendered page cache
+PAGE_CACHE_GENERATION = 'page_cache_generation'
+
+# Prefix for rendered pages
+PAGE_PREFIX = 'page'
+
+# The generation of the reference data (manufacturers & product categories)
+REFERENCE_DATA_GENERATION = 'reference_data_generation'
+
+# Prefix for cached Manufacturer entities
+MANUFACTURER_ENTITY_PREFIX = 'manufacturer'
+
+# Prefix for cached ProductCategory entities
+PRODUCT_CATEGORY_ENTITY_PREFIX = 'product_category'
+
+# Prefix for the raw & gzipped bodies of the exports that aren't snapshotted
+EXPORT_PREFIX = 'export'
+
+# Prefix for the binary PidStore, by PID selection & update times
+PID_STORE_PREFIX = 'pid_store'
+
+# Prefix for the PID search results, by manufacturer & PID update times, limit
+# & query
+PID_SEARCH_PREFIX = 'pid_search'
+
+# Prefix for the completion flags of the data migrations, see legacy_data.py
+MIGRATION_PREFIX = 'migration'
+
+# Prefix for the ranked responder search results, by device update time &
+# query
+RESPONDER_SEARCH_PREFIX = 'responder_search'
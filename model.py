@@ -29,13 +29,62 @@ SUBDEVICE_RANGE_DICT = {
 
 
 class LastUpdateTime(db.Model):
-  """Tracks the last update time for each section of the index."""
+  """Tracks the last update time for each section of the index.
+
+  New entities are stored with the name as the key name.
+  """
   name = db.StringProperty(required=True)
   update_time = db.DateTimeProperty()
 
 
+class CompletedMigration(db.Model):
+  """Records that a data migration has completed, keyed by the migration
+     name. See legacy_data.py.
+  """
+  completion_time = db.DateTimeProperty(auto_now_add=True)
+
+
+class IndexStatistics(db.Model):
+  """The counts displayed on each page, there is a single instance of this.
+     See index_stats.py.
+  """
+  responder_count = db.IntegerProperty(default=0)
+  # products other than responders
+  product_count = db.IntegerProperty(default=0)
+  manufacturer_pid_count = db.IntegerProperty(default=0)
+
+
+class FacetCounts(db.Model):
+  """The counts displayed in a search sidebar, keyed by the facet name.
+     See facet_counts.py.
+  """
+  # JSON dict of id to {id, name, count, hidden}
+  counts = db.TextProperty()
+
+
+class PrecomputedDocument(db.Model):
+  """A response that's expensive to build, keyed by name."""
+  content = db.TextProperty()
+  build_time = db.DateTimeProperty(auto_now=True)
+
+
+class ExportSnapshot(db.Model):
+  """A stored copy of one of the exports, keyed by the export name. See
+     snapshots.py.
+  """
+  # the update timestamps the snapshot was built from
+  version = db.StringProperty(required=True)
+  content_type = db.StringProperty(required=True)
+  raw_data = blobstore.BlobReferenceProperty(required=True)
+  gzip_data = blobstore.BlobReferenceProperty(required=True)
+  build_time = db.DateTimeProperty(auto_now=True)
+
+
 class Manufacturer(db.Model):
-  """Represents a Manufacturer."""
+  """Represents a Manufacturer.
+
+  New entities are stored with a key name of m:<esta_id>.
+  """
   esta_id = db.IntegerProperty(required=True)
   name = db.StringProperty(required=True)
   # link to the product page
@@ -46,6 +95,13 @@ class Manufacturer(db.Model):
   image_data = blobstore.BlobReferenceProperty()
   # the url we're serving the image on
   image_serving_url = db.LinkProperty()
+  # set by the loaders when the content changes, see change_log.py
+  last_modified = db.DateTimeProperty()
+
+  @staticmethod
+  def KeyName(esta_id):
+    """Return the key name for a manufacturer."""
+    return 'm:%d' % esta_id
 
 
 class ProductCategory(db.Model):
@@ -54,7 +110,10 @@ class ProductCategory(db.Model):
 
 
 class Responder(db.Model):
-  """Represents a particular RDM product / device."""
+  """Represents a particular RDM product / device.
+
+  New entities are stored with a key name of r:<esta_id>:<device_model_id>.
+  """
   manufacturer = db.ReferenceProperty(Manufacturer, required=True)
   # The Device Model ID field from DEVICE_INFO
   device_model_id = db.IntegerProperty()
@@ -77,6 +136,33 @@ class Responder(db.Model):
   score_penalty = db.IntegerProperty()
   # test score, this is updated with the latest score
   rdm_responder_rating = db.RatingProperty()
+  # copied from the SoftwareVersion with the highest version_id, see
+  # common.SetLatestSoftware()
+  latest_software_version_id = db.IntegerProperty()
+  latest_software_label = db.StringProperty()
+  latest_supported_parameters = db.ListProperty(int)
+  # str() of the key of that SoftwareVersion, SoftwareVersion refers to
+  # Responder so this can't be a ReferenceProperty
+  latest_software_key = db.StringProperty(indexed=False)
+  # the parameters & name this responder is listed under in the PID index
+  indexed_parameters = db.ListProperty(int, indexed=False)
+  indexed_name = db.StringProperty(indexed=False)
+  # set by the loaders when the content changes, see change_log.py
+  last_modified = db.DateTimeProperty()
+
+  @staticmethod
+  def KeyName(esta_id, device_model_id):
+    """Return the key name for a responder."""
+    return 'r:%d:%d' % (esta_id, device_model_id)
+
+
+class ResponderChange(db.Model):
+  """A log of the responders that need to be re-indexed, see
+     pid_index_builder.py. The key name is the responder key.
+  """
+  responder = db.ReferenceProperty(Responder, required=True,
+                                   collection_name='change_set')
+  timestamp = db.DateTimeProperty(auto_now=True)
 
 
 class ResponderTag(db.Model):
@@ -148,6 +234,8 @@ class Product(polymodel.PolyModel):
   image_data = blobstore.BlobReferenceProperty()
   # the url we're serving the image on
   image_serving_url = db.LinkProperty()
+  # set by the loaders when the content changes, see change_log.py
+  last_modified = db.DateTimeProperty()
 
 
 class ProductTag(db.Model):
@@ -195,7 +283,11 @@ class Splitter(Product):
 # If both are specified, the enum values must fall into the specified ranges.
 
 class Command(db.Model):
-  """Represents a GET or SET Command Description."""
+  """Represents a GET or SET Command Description.
+
+  This is deprecated, the commands are now stored in the Pid entity. It's only
+  kept around until the existing data has been migrated.
+  """
   sub_device_range = db.IntegerProperty(
       required=True,
       choices=set(xrange(4)))
@@ -204,13 +296,29 @@ class Command(db.Model):
 
 
 class Pid(db.Model):
-  """Represents a PID."""
+  """Represents a PID.
+
+  New entities are stored with a key name of p:<esta_id>:<pid_id>.
+  """
   manufacturer = db.ReferenceProperty(Manufacturer, required=True)
   pid_id = db.IntegerProperty(required=True)
   name = db.StringProperty(required=True);
   link = db.LinkProperty();
   notes = db.TextProperty()
   draft = db.BooleanProperty(default=False)
+  # The commands. For each command type the sub device range is set if the
+  # command is supported, the request & response message definitions are
+  # stored as JSON, see common.EncodeMessage().
+  discovery_sub_device_range = db.IntegerProperty(choices=set(xrange(4)))
+  discovery_request = db.TextProperty()
+  discovery_response = db.TextProperty()
+  get_sub_device_range = db.IntegerProperty(choices=set(xrange(4)))
+  get_request = db.TextProperty()
+  get_response = db.TextProperty()
+  set_sub_device_range = db.IntegerProperty(choices=set(xrange(4)))
+  set_request = db.TextProperty()
+  set_response = db.TextProperty()
+  # Deprecated, these are only used by the command migration.
   discovery_command = db.ReferenceProperty(
       Command,
       collection_name='pid_discovery_command_set')
@@ -218,8 +326,53 @@ class Pid(db.Model):
                                      collection_name='pid_get_command_set')
   set_command = db.ReferenceProperty(Command,
                                      collection_name='pid_set_command_set')
-  # A list of responder keys that support this PID.
+  # Deprecated, the responders are now stored in PidSupportShard entities.
+  # This is cleared when the PID index is rebuilt.
   responders = db.ListProperty(db.Key)
+  # set by the loaders when the content changes, see change_log.py
+  last_modified = db.DateTimeProperty()
+
+  # The command types, in the order they're displayed.
+  COMMAND_TYPES = ['get', 'discovery', 'set']
+
+  @staticmethod
+  def KeyName(esta_id, pid_id):
+    """Return the key name for a PID."""
+    return 'p:%d:%d' % (esta_id, pid_id)
+
+  def HasCommand(self, command_type):
+    """Check if this PID supports a command type, i.e. 'get'."""
+    return getattr(self, '%s_sub_device_range' % command_type) is not None
+
+class PidSupportShard(db.Model):
+  """Part of the list of responders that support a PID. The parent is the
+     Pid and the key name is s:<shard number>. See pid_support.py.
+  """
+  # packed (name, manufacturer id, device model id) entries, sorted by name
+  # across the shards
+  entries = db.BlobProperty()
+
+
+class SearchIndexEntry(db.Model):
+  """The search terms for an entity. The parent is the entity and the key
+     name is the kind, see search_index.py.
+  """
+  kind = db.StringProperty(required=True)
+  terms = db.StringListProperty()
+  # extra text used to rank the results, that isn't on the entity itself
+  text = db.TextProperty()
+
+
+class Tombstone(db.Model):
+  """Records the deletion of an entity, see change_log.py."""
+  # one of the change_log kinds
+  kind = db.StringProperty(required=True)
+  # JSON dict of the fields which identify the entity, or if cleared is True,
+  # the fields which all deleted entities matched
+  ids = db.TextProperty()
+  cleared = db.BooleanProperty(default=False)
+  deletion_time = db.DateTimeProperty(auto_now_add=True)
+
 
 class UploadedResponderInfo(db.Model):
   # This doesn't link to a Manufacturer, since we may not know about all
@@ -17,13 +17,15 @@
 # Model search / display handlers
 
 import common
+import facet_counts
 import json
 import logging
 import memcache_keys
 import re
+import responder_search
 from data.sensor_types import SENSOR_TYPES
 from model import *
-from utils import StringToInt
+from utils import PrefetchReferences, StringToInt
 from google.appengine.api import images
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
@@ -46,9 +48,10 @@ class BrowseModels(common.BasePageHandler):
 
     query = Responder.all()
     query.order('-score')
-    total = query.count()
-    models = query.fetch(limit=self.RESULTS_PER_PAGE,
-                         offset=page * self.RESULTS_PER_PAGE)
+    total, models, next_cursor = common.FetchPage(
+        query, 'models', page, self.RESULTS_PER_PAGE,
+        self.request.get('cursor'))
+    PrefetchReferences(models, Responder.manufacturer)
     rows = []
     for model, index in zip(models, range(len(models))):
       if index % self.COLUMNS == 0:
@@ -88,6 +91,7 @@ class BrowseModels(common.BasePageHandler):
       data['previous'] = page
     if start + len(models) < total:
       data['next'] = page + 2
+      data['next_cursor'] = next_cursor
     return data
 
 
@@ -115,16 +119,12 @@ class SearchByManufacturer(BaseSearchHandler):
     manufacturer_list = memcache.get(memcache_keys.MANUFACTURER_MODEL_COUNTS)
     if not manufacturer_list:
       manufacturer_list = []
-      query = Manufacturer.all()
-      query.order('name')
-      for manufacturer in query:
-        responders = manufacturer.responder_set.count()
-        if responders:
-          manufacturer_list.append({
-              'id': manufacturer.esta_id,
-              'name': manufacturer.name,
-              'responder_count': responders,
-          })
+      for row in facet_counts.Get(facet_counts.MANUFACTURER_MODELS):
+        manufacturer_list.append({
+            'id': row['id'],
+            'name': row['name'],
+            'responder_count': row['count'],
+        })
       memcache.set(memcache_keys.MANUFACTURER_MODEL_COUNTS, manufacturer_list)
 
     return {
@@ -136,7 +136,7 @@ class SearchByManufacturer(BaseSearchHandler):
     if self._manufacturer is not None:
       responder_query = self._manufacturer.responder_set
       responder_query.order('device_model_id')
-      return responder_query
+      return PrefetchReferences(list(responder_query), Responder.manufacturer)
     return []
 
 
@@ -152,16 +152,12 @@ class SearchByCategory(BaseSearchHandler):
     category_list = memcache.get(memcache_keys.CATEGORY_MODEL_COUNTS)
     if not category_list:
       category_list = []
-      query = ProductCategory.all()
-      query.order('name')
-      for category in query:
-        responders = category.responder_set.count()
-        if responders:
-          category_list.append({
-              'id': category.id,
-              'name': category.name,
-              'responder_count': responders,
-          })
+      for row in facet_counts.Get(facet_counts.CATEGORY_MODELS):
+        category_list.append({
+            'id': row['id'],
+            'name': row['name'],
+            'responder_count': row['count'],
+        })
       memcache.set(memcache_keys.CATEGORY_MODEL_COUNTS, category_list)
 
     return {
@@ -171,7 +167,8 @@ class SearchByCategory(BaseSearchHandler):
 
   def GetResults(self):
     if self._category is not None:
-      return self._category.responder_set
+      return PrefetchReferences(list(self._category.responder_set),
+                                Responder.manufacturer)
     return []
 
 
@@ -186,15 +183,11 @@ class SearchByTag(BaseSearchHandler):
     tag_list = memcache.get(memcache_keys.TAG_MODEL_COUNTS)
     if not tag_list:
       tag_list = []
-      query = ResponderTag.all()
-      query.order('label')
-      for tag in query:
-        responders = tag.responder_set.count()
-        if responders and not tag.exclude_from_search:
-          tag_list.append({
-              'label': tag.label,
-              'responder_count': responders,
-          })
+      for row in facet_counts.Get(facet_counts.TAG_MODELS):
+        tag_list.append({
+            'label': row['name'],
+            'responder_count': row['count'],
+        })
       memcache.set(memcache_keys.TAG_MODEL_COUNTS, tag_list)
 
     return {
@@ -209,15 +202,61 @@ class SearchByTag(BaseSearchHandler):
       tags = query.fetch(1)
 
       if tags:
-        tag_relationships = tags[0].responder_set
-        return [r.responder for r in tag_relationships]
+        tag_relationships = PrefetchReferences(
+            list(tags[0].responder_set), ResponderTagRelationship.responder)
+        return PrefetchReferences([r.responder for r in tag_relationships],
+                                  Responder.manufacturer)
     return []
 
 
+class SearchByText(BaseSearchHandler):
+  """Search by model name, manufacturer name, tag or personality."""
+  TEMPLATE = 'templates/text_model_search.tmpl'
+  RESULTS_PER_PAGE = 50
+
+  def Init(self):
+    self._query = self.request.get('q').strip()
+    page = StringToInt(self.request.get('page'), False)
+    if page is None or page < 1:
+      page = 1
+    # 0 offset
+    self._page = page - 1
+
+  def GetSearchData(self):
+    return {'query': self._query}
+
+  def GetTemplateData(self):
+    data = BaseSearchHandler.GetTemplateData(self)
+    if self._page:
+      data['previous'] = self._page
+    if (self._page + 1) * self.RESULTS_PER_PAGE < self._total:
+      data['next'] = self._page + 2
+    data['total'] = self._total
+    data['capped'] = self._capped
+    return data
+
+  def GetResults(self):
+    self._total = 0
+    self._capped = False
+    if not self._query:
+      return []
+    results, self._capped = responder_search.Search(self._query)
+    self._total = len(results)
+    start = self._page * self.RESULTS_PER_PAGE
+    return results[start:start + self.RESULTS_PER_PAGE]
+
+
 class DisplayModel(common.BasePageHandler):
   """Display information about a particular model."""
   TEMPLATE = 'templates/display_model.tmpl'
 
+  def PageCacheKey(self):
+    manufacturer_id = StringToInt(self.request.get('manufacturer'))
+    model_id = StringToInt(self.request.get('model'))
+    if manufacturer_id is None or model_id is None:
+      return None
+    return 'model:%d:%d' % (manufacturer_id, model_id)
+
   def GetTemplateData(self):
     model = common.LookupModelFromRequest(self.request)
     if not model:
@@ -233,6 +272,9 @@ class DisplayModel(common.BasePageHandler):
 
     self.response.headers['Content-Type'] = 'text/plain'
 
+    # resolve all the PID names in one go
+    pid_names = common.GetPidNames()
+
     # software version info
     software_versions = []
     for version_info in model.software_version_set:
@@ -247,18 +289,14 @@ class DisplayModel(common.BasePageHandler):
         for param in supported_parameters:
           param_dict = { 'id': param, }
 
-          query = Pid.all()
-          query.filter('pid_id =' , param)
           if param >= 0x8000:
-            query.filter('manufacturer = ', model.manufacturer)
             param_dict['manufacturer_id'] = model.manufacturer.esta_id
           else:
-            query.filter('manufacturer = ', esta_manufacturer)
             param_dict['manufacturer_id'] = esta_manufacturer.esta_id
 
-          results = query.fetch(1)
-          if results:
-            param_dict['name'] = results[0].name
+          name = pid_names.get((param_dict['manufacturer_id'], param))
+          if name is not None:
+            param_dict['name'] = name
           param_output.append(param_dict)
 
         version_output['supported_parameters'] = sorted(
@@ -337,6 +375,7 @@ model_application = webapp.WSGIApplication(
     ('/model/manufacturer', SearchByManufacturer),
     ('/model/category', SearchByCategory),
     ('/model/tag', SearchByTag),
+    ('/model/search', SearchByText),
     ('/model/display', DisplayModel),
   ],
   debug=True)
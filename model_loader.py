@@ -16,8 +16,12 @@
 # Copyright (C) 2011 Simon Newton
 # Loads model data
 
+import change_log
 import logging
 import common
+import facet_counts
+import pid_index_builder
+import responder_search
 from model import *
 
 class ModelLoader(object):
@@ -66,6 +70,7 @@ class ModelLoader(object):
         elif was_modified:
           updated.append(model_info['model_description'])
 
+    self._updater.ApplyFacetChanges()
     return added, updated
 
 
@@ -76,6 +81,19 @@ class ModelUpdater(object):
     self._product_categories = {}
     # string to ResponderTag object
     self._tags = {}
+    self._facets = facet_counts.FacetUpdater()
+
+  def ApplyFacetChanges(self):
+    """Update the sidebar counts with the changes made by this updater."""
+    self._facets.Apply()
+
+  def _AdjustCategory(self, category, delta):
+    self._facets.Adjust(facet_counts.CATEGORY_MODELS, category.id,
+                        category.name, delta)
+
+  def _AdjustTag(self, tag, delta):
+    self._facets.Adjust(facet_counts.TAG_MODELS, tag.label, tag.label, delta,
+                        tag.exclude_from_search)
 
   def _Encode(self, s):
     """Encode a string that may contain binary data."""
@@ -93,13 +111,8 @@ class ModelUpdater(object):
       The entity object, or None if not found.
     """
     if category_id not in self._product_categories:
-      query = ProductCategory.all()
-      query.filter('id = ', category_id)
-      categories = query.fetch(1)
-      if categories:
-        self._product_categories[category_id] = categories[0]
-      else:
-        self._product_categories[category_id] = None
+      self._product_categories[category_id] = common.LookupProductCategory(
+          category_id)
     return self._product_categories[category_id]
 
   def _LookupOrAddTag(self, tag_label):
@@ -122,16 +135,9 @@ class ModelUpdater(object):
 
     return self._tags[tag_label]
 
-  def _LookupResponder(self, manufacturer_key, model_id):
-    """Given a manufacturer key and model_id, lookup the Responder entity."""
-    models = Responder.all()
-    models.filter('device_model_id = ', model_id)
-    models.filter('manufacturer = ', manufacturer_key)
-
-    model_data = models.fetch(1)
-    if not model_data:
-      return None
-    return model_data[0]
+  def _LookupResponder(self, manufacturer, model_id):
+    """Given a manufacturer and model_id, lookup the Responder entity."""
+    return common.LookupResponder(manufacturer, model_id)
 
   def _UpdateResponder(self, responder, model_info):
     """Update this responder entity if there is new data.
@@ -140,10 +146,12 @@ class ModelUpdater(object):
       True if this entity was updated, false otherwise.
     """
     modified = False
+    renamed = False
     model_description = model_info.get('model_description')
     if model_description != responder.model_description and model_description:
       responder.model_description = model_description
       modified = True
+      renamed = True
 
     product_category_id = model_info.get('product_category')
     if product_category_id is not None:
@@ -152,6 +160,9 @@ class ModelUpdater(object):
         # requires update
         new_category = self._LookupProductCategory(product_category_id)
         if new_category:
+          if current_category:
+            self._AdjustCategory(current_category, -1)
+          self._AdjustCategory(new_category, 1)
           responder.product_category = new_category
           modified = True
         else:
@@ -172,7 +183,11 @@ class ModelUpdater(object):
       modified = True
 
     if modified:
+      change_log.MarkModified(responder)
       responder.put()
+    if renamed:
+      # the PID index is sorted by name
+      pid_index_builder.RecordResponderChange(responder)
     return modified
 
   def _AddResponder(self, manufacturer, model_id, model_info):
@@ -187,6 +202,7 @@ class ModelUpdater(object):
       The new Responder entity.
     """
     responder = Responder(
+        key_name = Responder.KeyName(manufacturer.esta_id, model_id),
         manufacturer = manufacturer,
         device_model_id = model_id,
         model_description = model_info['model_description'])
@@ -197,6 +213,7 @@ class ModelUpdater(object):
       category = self._LookupProductCategory(product_category_id)
       if category:
         responder.product_category = category
+        self._AdjustCategory(category, 1)
       else:
         logging.info('No product category found for 0x%hx' %
             product_category_id)
@@ -209,7 +226,10 @@ class ModelUpdater(object):
     if image_url:
       responder.image_url = image_url
 
+    change_log.MarkModified(responder)
     responder.put()
+    self._facets.Adjust(facet_counts.MANUFACTURER_MODELS, manufacturer.esta_id,
+                        manufacturer.name, 1)
     return responder
 
   def _AddSoftwareVersion(self, responder, version_id, version_info):
@@ -219,6 +239,9 @@ class ModelUpdater(object):
       responder: The Responder entity to update
       version_id: the id of the version
       version_info: the dict with the version information
+
+    Returns:
+      The new SoftwareVersion entity.
     """
     # create the new version object and store it
     version_obj = SoftwareVersion(version_id = version_id,
@@ -235,6 +258,7 @@ class ModelUpdater(object):
 
     sensors = version_info.get('sensors', [])
     self._UpdateSensors(version_obj, sensors)
+    return version_obj
 
 
   def _UpdatePersonalities(self, software_version, personalities):
@@ -348,8 +372,10 @@ class ModelUpdater(object):
     """
     new_versions = set(versions.keys())
     modified = False
+    all_versions = []
 
     for version in responder.software_version_set:
+      all_versions.append(version)
       version_id = version.version_id
       if version_id in new_versions:
         new_version_info = versions[version_id]
@@ -381,9 +407,14 @@ class ModelUpdater(object):
     for new_version in new_versions:
       logging.info('Adding %d for %s' %
                    (new_version, responder.model_description))
-      self._AddSoftwareVersion(responder, new_version, versions[new_version])
+      all_versions.append(self._AddSoftwareVersion(responder, new_version,
+                                                   versions[new_version]))
       modified = True
 
+    if common.SetLatestSoftware(responder, all_versions):
+      change_log.MarkModified(responder)
+      responder.put()
+      pid_index_builder.RecordResponderChange(responder)
     return modified
 
   def _UpdateTags(self, responder, new_tags):
@@ -406,6 +437,7 @@ class ModelUpdater(object):
       else:
         logging.info('Deleting %s from %s' %
                      (label, responder.model_description))
+        self._AdjustTag(relationship.tag, -1)
         relationship.delete()
         modified = True
 
@@ -415,6 +447,7 @@ class ModelUpdater(object):
           tag = tag_entity,
           responder = responder)
       relationship.put()
+      self._AdjustTag(tag_entity, 1)
       modified = True
 
     return modified
@@ -429,7 +462,7 @@ class ModelUpdater(object):
     was_modified = False
 
     model_id = model_info['device_model']
-    responder = self._LookupResponder(manufacturer.key(), model_id)
+    responder = self._LookupResponder(manufacturer, model_id)
     if responder:
       # update
       if self._UpdateResponder(responder, model_info):
@@ -455,4 +488,7 @@ class ModelUpdater(object):
       if self._UpdateTags(responder, model_info['tags']):
         logging.info(' tag changed')
         was_modified = True
+
+    if was_added or was_modified:
+      responder_search.IndexResponders([responder])
     return was_added, was_modified
@@ -0,0 +1,98 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# page_cache.py
+# Copyright (C) 2012 Simon Newton
+# A cache for rendered pages.
+
+import collections
+import logging
+import memcache_keys
+from utils import GetGeneration, IncrementGeneration
+from google.appengine.api import memcache
+
+
+class LRUCache(object):
+  """A simple least recently used cache."""
+  def __init__(self, max_size):
+    self._max_size = max_size
+    self._data = collections.OrderedDict()
+
+  def Get(self, key):
+    """Return the value for key, or None if it isn't in the cache."""
+    value = self._data.pop(key, None)
+    if value is not None:
+      self._data[key] = value
+    return value
+
+  def Set(self, key, value):
+    self._data.pop(key, None)
+    self._data[key] = value
+    while len(self._data) > self._max_size:
+      self._data.popitem(last=False)
+
+  def Clear(self):
+    self._data.clear()
+
+
+# The number of pages to hold on each instance.
+INSTANCE_CACHE_SIZE = 200
+
+_instance_cache = LRUCache(INSTANCE_CACHE_SIZE)
+
+
+def _MemcacheKey(page_key):
+  return '%s:%s:%s' % (memcache_keys.PAGE_PREFIX,
+                       GetGeneration(memcache_keys.PAGE_CACHE_GENERATION),
+                       page_key)
+
+
+def Get(page_key):
+  """Lookup a rendered page.
+
+  Args:
+    page_key: the string identifying the page.
+
+  Returns:
+    The rendered page, or None if it isn't cached.
+  """
+  key = _MemcacheKey(page_key)
+  output = _instance_cache.Get(key)
+  if output is None:
+    output = memcache.get(key)
+    if output is not None:
+      _instance_cache.Set(key, output)
+  return output
+
+
+def Set(page_key, output):
+  """Store a rendered page.
+
+  Args:
+    page_key: the string identifying the page.
+    output: the rendered page.
+  """
+  key = _MemcacheKey(page_key)
+  _instance_cache.Set(key, output)
+  if not memcache.set(key, output):
+    logging.error("Memcache set failed.")
+
+
+def Invalidate():
+  """Invalidate all the cached pages, on all instances.
+
+  This should be called whenever data that's displayed on a page changes.
+  """
+  _instance_cache.Clear()
+  IncrementGeneration(memcache_keys.PAGE_CACHE_GENERATION)
@@ -0,0 +1,83 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_definitions.py
+# Copyright (C) 2012 Simon Newton
+# Convert the PID message definitions into the structures used by the PID
+# page and the JSON API.
+
+import common
+
+
+def _CopyToDict(input_d, output_d, keys):
+  for key in keys:
+    if key in input_d:
+      output_d[key] = input_d[key]
+
+
+def PopulateItem(item):
+  """Build the data structure for an item."""
+  item_output = {}
+  _CopyToDict(item,
+              item_output,
+              ['name', 'type', 'min_size', 'max_size', 'multiplier'])
+
+  if item['type'] == 'group':
+    children = []
+    for child_item in item['items']:
+      child_item_output = PopulateItem(child_item)
+      children.append(child_item_output)
+    item_output['items'] = children
+
+  labeled_values = []
+  for value, label in item.get('labels', []):
+    labeled_value_output = {
+      'value': value,
+      'label': label,
+    }
+    labeled_values.append(labeled_value_output)
+  if labeled_values:
+    item_output['enums'] = labeled_values
+
+  ranges = []
+  for min_value, max_value in item.get('range', []):
+    range_output = {
+      'min': min_value,
+      'max': max_value,
+    }
+    ranges.append(range_output)
+  if ranges:
+    item_output['ranges'] = ranges
+  return item_output
+
+
+def BuildMessage(key, message_str):
+  """Build the data structure for a message.
+
+  Args:
+    key: the key of the Pid, used for caching.
+    message_str: the JSON message definition stored in the Pid.
+  """
+  message_data = common.DecodeMessage(key, message_str)
+  return {'items': [PopulateItem(item) for item in message_data['items']]}
+
+
+def BuildCommand(pid, command_type):
+  """Build the request & response messages for a command.
+
+  Returns:
+    A tuple in the form (request, response).
+  """
+  return (BuildMessage(pid.key(), getattr(pid, '%s_request' % command_type)),
+          BuildMessage(pid.key(), getattr(pid, '%s_response' % command_type)))
@@ -16,13 +16,17 @@
 # Copyright (C) 2011 Simon Newton
 # PID search / display handlers.
 
+import facet_counts
 import json
 import logging
 import memcache_keys
+import pid_definitions
+import pid_search
+import pid_support
 import re
 import common
 from model import *
-from utils import StringToInt
+from utils import PrefetchReferences, StringToInt
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
@@ -54,16 +58,12 @@ class SearchByManufacturer(BaseSearchHandler):
     manufacturer_list = memcache.get(memcache_keys.MANUFACTURER_PID_COUNTS)
     if not manufacturer_list:
       manufacturer_list = []
-      query = Manufacturer.all()
-      query.order('name')
-      for manufacturer in query:
-        pids = manufacturer.pid_set.count()
-        if pids:
-          manufacturer_list.append({
-              'id': manufacturer.esta_id,
-              'name': manufacturer.name,
-              'pid_count': pids,
-          })
+      for row in facet_counts.Get(facet_counts.MANUFACTURER_PIDS):
+        manufacturer_list.append({
+            'id': row['id'],
+            'name': row['name'],
+            'pid_count': row['count'],
+        })
       memcache.set(memcache_keys.MANUFACTURER_PID_COUNTS, manufacturer_list)
 
     return {
@@ -72,32 +72,26 @@ class SearchByManufacturer(BaseSearchHandler):
     }
 
   def GetResults(self):
-    if self._manufacturer_id is not None:
-      query = Manufacturer.all()
-      query.filter('esta_id = ', self._manufacturer_id)
-
-      for manufacturer in query.fetch(1):
-        query = manufacturer.pid_set
-        query.filter('draft = ', False)
-        query.order('pid_id')
-        return query
+    manufacturer = common.GetManufacturer(self._manufacturer_id)
+    if manufacturer is not None:
+      query = manufacturer.pid_set
+      query.filter('draft = ', False)
+      query.order('pid_id')
+      return PrefetchReferences(list(query), Pid.manufacturer)
     return []
 
 
 class SearchByName(BaseSearchHandler):
-  """Search by PID name."""
+  """Search by PID name, manufacturer name or notes. This matches prefixes &
+     substrings of the words in the name.
+  """
   TEMPLATE = 'templates/name_pid_search.tmpl'
+  MAX_RESULTS = 100
 
   def GetResults(self):
     name = self.request.get('name')
-    if name is not None:
-      name = name.strip().replace(' ', '_').upper()
-      # do full string matching for now
-      results = Pid.all()
-      results.filter('draft = ', False)
-      results.filter('name =' , name)
-
-      return results
+    if name:
+      return pid_search.Search(name, self.MAX_RESULTS)
     return []
 
 
@@ -111,7 +105,7 @@ class SearchById(BaseSearchHandler):
       results = Pid.all()
       results.filter('pid_id =' , pid_id)
       results.filter('draft = ', False)
-      return results
+      return PrefetchReferences(list(results), Pid.manufacturer)
     return []
 
 
@@ -119,6 +113,22 @@ class DisplayPid(common.BasePageHandler):
   """Display information about a particular PID."""
 
   TEMPLATE = 'templates/display_pid.tmpl'
+  # the number of responders on each page of the supported by list
+  SUPPORTED_BY_PAGE_SIZE = 50
+
+  def PageCacheKey(self):
+    manufacturer_id = StringToInt(self.request.get('manufacturer'))
+    pid_id = StringToInt(self.request.get('pid'), False)
+    if manufacturer_id is None or pid_id is None:
+      return None
+    return 'pid:%d:%d:%d' % (manufacturer_id, pid_id, self.SupportedByPage())
+
+  def SupportedByPage(self):
+    """Return the page of the supported by list to display, 0 offset."""
+    page = StringToInt(self.request.get('page'), False)
+    if page is None or page < 1:
+      return 0
+    return page - 1
 
   def LookupPIDFromRequest(self):
     pid_id = self.request.get('pid')
@@ -130,96 +140,51 @@ class DisplayPid(common.BasePageHandler):
     manufacturer = common.GetManufacturer(self.request.get('manufacturer'))
     if manufacturer is None or pid_id is None:
       return None
+    return common.LookupPid(manufacturer, pid_id)
 
-    results = {}
-    models = Pid.all()
-    models.filter('pid_id = ', pid_id)
-    models.filter('manufacturer = ', manufacturer.key())
-
-    pid_data = models.fetch(1)
-    if pid_data:
-      return pid_data[0]
-    else:
-      return None
-
-  def CopyToDict(self, input_d, output_d, keys):
-    for key in keys:
-      if key in input_d:
-        output_d[key] = input_d[key]
-
-  def PopulateItem(self, item):
-    """Build the data structure for an item."""
-    item_output = {}
-    self.CopyToDict(item,
-                    item_output,
-                    ['name', 'type', 'min_size', 'max_size', 'multiplier'])
-
-    if item['type'] == 'group':
-      children = []
-      for child_item in item['items']:
-        child_item_output = self.PopulateItem(child_item)
-        children.append(child_item_output)
-      item_output['items'] = children
-
-    labeled_values = []
-    for value, label in item.get('labels', []):
-      labeled_value_output = {
-        'value': value,
-        'label': label,
-      }
-      labeled_values.append(labeled_value_output)
-    if labeled_values:
-      item_output['enums'] = labeled_values
-
-    ranges = []
-    for min_value, max_value in item.get('range', []):
-      range_output = {
-        'min': min_value,
-        'max': max_value,
-      }
-      ranges.append(range_output)
-    if ranges:
-      item_output['ranges'] = ranges
-    return item_output
-
-  def PopulateMessage(self, message_output, message_str):
-    message_data = eval(message_str)
-    items = []
-    for item in message_data['items']:
-      item_output = self.PopulateItem(item)
-      items.append(item_output)
-
-    message_output['items'] = items
-
-  def BuildCommand(self, command):
-    request = {}
-    self.PopulateMessage(request, command.request)
-    response = {}
-    self.PopulateMessage(response, command.response)
+  def BuildCommand(self, pid, command_type):
+    request, response = pid_definitions.BuildCommand(pid, command_type)
     command = {
         'request_json': json.dumps(request),
         'response_json': json.dumps(response),
         'subdevice_range': SUBDEVICE_RANGE_DICT.get(
-            command.sub_device_range, ''),
+            getattr(pid, '%s_sub_device_range' % command_type), ''),
     }
     return command
 
+  def BuildSupportedBy(self, pid, page):
+    """Build a page of the responders which support a PID.
+
+    The index is sorted by name, so only the shards for the page are read,
+    and the responders on it are fetched with a single batch get.
+
+    Returns:
+      A tuple in the form (total, supported_by).
+    """
+    total, entries = pid_support.GetPage(
+        pid.key(), page * self.SUPPORTED_BY_PAGE_SIZE,
+        self.SUPPORTED_BY_PAGE_SIZE)
+    responders = db.get([pid_support.ResponderKey(e) for e in entries])
+
+    supported_by = []
+    for (_, manufacturer_id, model_id), responder in zip(entries, responders):
+      if responder is not None:
+        supported_by.append({
+          'name': responder.model_description,
+          'manufacturer': manufacturer_id,
+          'model': model_id,
+        })
+    return total, supported_by
+
   def GetTemplateData(self):
     pid = self.LookupPIDFromRequest()
     if not pid:
       self.error(404)
       return
 
-    supported_by = []
-    for responder_key in pid.responders:
-      responder = Responder.get(responder_key)
-      if responder:
-        supported_by.append({
-          'name': responder.model_description,
-          'manufacturer': responder.manufacturer.esta_id,
-          'model': responder.device_model_id,
-        })
-    supported_by.sort(key=lambda x: x['name'])
+    page = self.SupportedByPage()
+    total, supported_by = self.BuildSupportedBy(pid, page)
+    has_more = (page + 1) * self.SUPPORTED_BY_PAGE_SIZE < total
 
     output = {
       'link': pid.link,
@@ -229,19 +194,17 @@ class DisplayPid(common.BasePageHandler):
       'pid_id': pid.pid_id,
       'pid_name': pid.name,
       'supported_by': supported_by,
+      'supported_by_count': total,
     }
-
-    if pid.get_command:
-      command = self.BuildCommand(pid.get_command)
-      output['get_command'] = command
-
-    if pid.discovery_command:
-      command = self.BuildCommand(pid.discovery_command)
-      output['discovery_command'] = command
-
-    if pid.set_command:
-      command = self.BuildCommand(pid.set_command)
-      output['set_command'] = command
+    if page:
+      output['supported_by_previous'] = page
+    if has_more:
+      output['supported_by_next'] = page + 2
+
+    for command_type in Pid.COMMAND_TYPES:
+      if pid.HasCommand(command_type):
+        output['%s_command' % command_type] = self.BuildCommand(pid,
+                                                                command_type)
     return output
 
 
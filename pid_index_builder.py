@@ -17,76 +17,249 @@
 # Copyright (C) 2012 Simon Newton
 # Build the index of PIDs to responders.
 
-import logging
 import common
+import logging
+import page_cache
+import pid_support
 from model import *
+from google.appengine.api import taskqueue
+
+ESTA_ID = 0
+
+
+def RecordResponderChange(responder):
+  """Note that the PIDs a responder supports may have changed.
+
+  The change is picked up by the next run of /tasks/update_pid_index.
+  """
+  ResponderChange(key_name=str(responder.key()),
+                  responder=responder).put()
+
+
+def RecordPidAdded(pid):
+  """Note that a PID has been added.
+
+  Responders are only indexed under parameters which have a PID, so the
+  responders which support this one need to be indexed again. The change is
+  picked up by the next run of /tasks/update_pid_index.
+  """
+  query = Responder.all(keys_only=True)
+  query.filter('latest_supported_parameters =', pid.pid_id)
+  if pid.pid_id >= 0x8000:
+    query.filter('manufacturer =',
+                 Pid.manufacturer.get_value_for_datastore(pid))
+  db.put([ResponderChange(key_name=str(key), responder=key)
+          for key in query])
+
 
+def ScheduleUpdate():
+  """Process the responder change log in the background."""
+  task = taskqueue.Task(method='GET', url='/tasks/update_pid_index')
+  task.add()
 
-class PidIndexBuilder():
+
+class PidIndexBuilder(object):
   """We need to be smart about this, my first attempt blew through my write
      budget when I built the index.
+
+  Rather than building the whole index in one request, the index is updated a
+  batch of responders at a time. Each responder records the parameters & name
+  it's indexed under, so only the PIDs for parameters that were added or
+  removed from the latest software version need to be written, unless the
+  responder was renamed.
+
+  The index stores responders by name, manufacturer & device model id, so the
+  entity key migration needs to have run.
   """
+  BATCH_SIZE = 50
+
+  SHARDS = 'shards'
+  PIDS = 'pids'
+  RESPONDERS = 'responders'
+  STAGES = [SHARDS, PIDS, RESPONDERS]
+
   def __init__(self):
-    self._pid_cache = {}
-    self._esta = common.GetManufacturer(0)
+    # manufacturer key to esta id
+    self._esta_ids = {}
+
+  def _LoadEstaIds(self, responders):
+    """Populate the esta id cache for the manufacturers of these responders."""
+    keys = set()
+    for responder in responders:
+      key = Responder.manufacturer.get_value_for_datastore(responder)
+      if key not in self._esta_ids:
+        keys.add(key)
+    keys = list(keys)
+    for key, manufacturer in zip(keys, db.get(keys)):
+      if manufacturer is not None:
+        self._esta_ids[key] = manufacturer.esta_id
 
-  def LoadCurrentIndex(self):
-    """Load the current PID to responder map. Also populates the pid_cache.
+  def _PidKey(self, esta_id, param):
+    """Return the key of the Pid for a parameter."""
+    if param < 0x8000:
+      esta_id = ESTA_ID
+    return db.Key.from_path('Pid', Pid.KeyName(esta_id, param))
+
+  def UpdateResponders(self, responder_keys, rebuild=False):
+    """Update the index for a set of responders.
+
+    Args:
+      responder_keys: a list of Responder keys, any responders that have been
+        deleted are skipped.
+      rebuild: if True, ignore the parameters the responders were previously
+        indexed under.
 
     Returns:
-      A dict in the form {
-        (manufacturer_id, pid_id) : set(responder_keys),
-      }
+      The number of PIDs that were modified.
     """
-    index = {}
-    for pid in Pid.all():
-      key = (pid.manufacturer.esta_id, pid.pid_id)
-      responders = set()
-      for responder in pid.responders:
-        responders.add(responder)
-      index[key] = responders
-      self._pid_cache[key] = pid
-    return index
-
-  def KeyFromPID(self, manufacturer, pid_id):
-    """Determine the key from a manufacturer and pid_id."""
-    if pid_id < 0x8000:
-      manufacturer = self._esta
-    return (manufacturer.esta_id, pid_id)
-
-  def BuildIndex(self):
-    current_index = self.LoadCurrentIndex()
-    new_index = {}
-
-    for responder in Responder.all():
-      params = []
-      version = common.GetLatestSoftware(responder)
-      if not version:
+    responders = [r for r in db.get(responder_keys) if r is not None]
+    common.LoadLatestSoftware(responders)
+    self._LoadEstaIds(responders)
+
+    entries = []
+    pid_keys = set()
+    for responder in responders:
+      manufacturer_key = Responder.manufacturer.get_value_for_datastore(
+          responder)
+      esta_id = self._esta_ids.get(manufacturer_key)
+      if esta_id is None:
         continue
-      for param in version.supported_parameters:
-        key = self.KeyFromPID(responder.manufacturer, param)
-        pid = self._pid_cache.get(key, None)
-        if not pid:
-          continue
-
-        new_index.setdefault(key, set()).add(responder.key())
-
-    # now diff the old and new
-    for key, responders in new_index.iteritems():
-      if key in current_index:
-        if current_index[key] != responders:
-          logging.info('Responder set changed for %s' % str(key))
-          pid = self._pid_cache[key]
-          pid.responders = list(responders)
-          pid.put()
-        del current_index[key]
-      else:
-        # this should never happen
-        logging.warn('Missing key for %s' % str(key))
-
-    for key, responders in current_index.iteritems():
-      if responders:
-        logging.info('Removed %s' % responders)
-        pid = self._pid_cache[key]
-        pid.responders = []
-        pid.put()
+      params = (set(responder.latest_supported_parameters) |
+                set(responder.indexed_parameters))
+      pid_keys.update(self._PidKey(esta_id, param) for param in params)
+      entries.append((responder, esta_id))
+
+    # Skip parameters that don't have a PID defined, RecordPidAdded() queues
+    # the responders if the PID is added later.
+    pid_keys = list(pid_keys)
+    existing_pids = set(key for key, pid in zip(pid_keys, db.get(pid_keys))
+                        if pid is not None)
+
+    additions = {}
+    removals = {}
+    modified_responders = []
+    for responder, esta_id in entries:
+      name = responder.model_description
+      supported = set(
+          param for param in responder.latest_supported_parameters
+          if self._PidKey(esta_id, param) in existing_pids)
+      indexed = set()
+      if not rebuild:
+        indexed = set(responder.indexed_parameters)
+      added = supported - indexed
+      if responder.indexed_name != name:
+        # the additions replace the existing entries, with the new name
+        added = supported
+      for param in added:
+        additions.setdefault(self._PidKey(esta_id, param), set()).add(
+            (name, esta_id, responder.device_model_id))
+      for param in indexed - supported:
+        pid_key = self._PidKey(esta_id, param)
+        if pid_key in existing_pids:
+          removals.setdefault(pid_key, set()).add(
+              (esta_id, responder.device_model_id))
+
+      if (set(responder.indexed_parameters) != supported or
+          responder.indexed_name != name):
+        responder.indexed_parameters = sorted(supported)
+        responder.indexed_name = name
+        modified_responders.append(responder)
+
+    modified = 0
+    for pid_key in set(additions.keys()) | set(removals.keys()):
+      if pid_support.Update(pid_key, additions.get(pid_key, set()),
+                            removals.get(pid_key, set())):
+        modified += 1
+
+    db.put(modified_responders)
+    return modified
+
+  def ProcessChangeLog(self):
+    """Update the index for a batch of responders from the change log.
+
+    Returns:
+      True if there may be more changes to process.
+    """
+    changes = ResponderChange.all().fetch(self.BATCH_SIZE)
+    if not changes:
+      return False
+
+    responder_keys = [ResponderChange.responder.get_value_for_datastore(c)
+                      for c in changes]
+    modified = self.UpdateResponders(responder_keys)
+    logging.info('Processed %d responder changes, updated %d PIDs' %
+                 (len(changes), modified))
+    if modified:
+      page_cache.Invalidate()
+
+    # don't drop changes that were recorded while we were running
+    processed = []
+    for change, current in zip(changes, db.get([c.key() for c in changes])):
+      if current is not None and current.timestamp == change.timestamp:
+        processed.append(change.key())
+    db.delete(processed)
+    return len(changes) == self.BATCH_SIZE
+
+  def _ClearLegacyLists(self, pids):
+    """Remove the responder lists stored on the Pid entities.
+
+    Returns:
+      The number of Pid entities that were modified.
+    """
+    modified = [pid for pid in pids if pid.responders]
+    for pid in modified:
+      pid.responders = []
+    db.put(modified)
+    return len(modified)
+
+  def RebuildBatch(self, stage=None, cursor=None):
+    """Rebuild the index for a batch of entities.
+
+    The first stage deletes the existing index, the second clears the lists
+    from before the index was sharded and the last one adds all the
+    responders.
+
+    Args:
+      stage: the stage to run, defaults to the first stage.
+      cursor: the cursor to resume from, or None.
+
+    Returns:
+      A tuple in the form (stage, cursor) to resume from, or (None, None) once
+      the index is complete.
+    """
+    if stage is None:
+      stage = self.STAGES[0]
+
+    if stage == self.SHARDS:
+      query = PidSupportShard.all(keys_only=True)
+    elif stage == self.PIDS:
+      query = Pid.all()
+    elif stage == self.RESPONDERS:
+      query = Responder.all(keys_only=True)
+    else:
+      logging.error('Unknown index stage %s' % stage)
+      return None, None
+
+    if cursor:
+      query.with_cursor(cursor)
+    entities = query.fetch(self.BATCH_SIZE)
+
+    if stage == self.SHARDS:
+      db.delete(entities)
+      modified = len(entities)
+    elif stage == self.PIDS:
+      modified = self._ClearLegacyLists(entities)
+    else:
+      modified = self.UpdateResponders(entities, rebuild=True)
+    logging.info('Indexed %d %s, updated %d' %
+                 (len(entities), stage, modified))
+    if modified:
+      page_cache.Invalidate()
+
+    if len(entities) == self.BATCH_SIZE:
+      return stage, query.cursor()
+
+    index = self.STAGES.index(stage) + 1
+    if index < len(self.STAGES):
+      return self.STAGES[index], None
+    return None, None
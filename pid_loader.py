@@ -17,8 +17,13 @@
 # Copyright (C) 2011 Simon Newton
 # Load PID data.
 
+import change_log
 import common
+import facet_counts
+import legacy_data
 import logging
+import pid_index_builder
+import pid_search
 from model import *
 
 
@@ -28,6 +33,22 @@ class UnknownManufacturerException(Exception):
 
 class PidLoader():
   """Load pids."""
+  ESTA_ID = 0
+
+  def __init__(self):
+    # the number of manufacturer PIDs added
+    self._added = 0
+    self._facets = facet_counts.FacetUpdater()
+    # the Command entities replaced by embedded commands
+    self._old_commands = []
+
+  def AddedCount(self):
+    """Return the number of manufacturer PIDs this loader has added."""
+    return self._added
+
+  def ApplyFacetChanges(self):
+    """Update the sidebar counts with the PIDs this loader has added."""
+    self._facets.Apply()
 
   def LookupPid(self, pid_id, manufacturer_id):
     """
@@ -39,78 +60,62 @@ class PidLoader():
     manufacturer = common.GetManufacturer(manufacturer_id)
     if manufacturer is None:
       raise UnknownManufacturerException(manufacturer_id)
-
-    pid_query = Pid.all()
-    pid_query.filter('pid_id = ', pid_id)
-    pid_query.filter('manufacturer = ', manufacturer.key())
-
-    result_set = pid_query.fetch(1)
-    if result_set:
-      return manufacturer, result_set[0]
-    else:
-      return manufacturer, None
+    return manufacturer, common.LookupPid(manufacturer, pid_id)
 
   def UpdateCommand(self, pid, new_pid_data, command_type):
     """Update a command if required.
 
     Returns:
-     True if the command was updated, False otherwise.
+     True if the PID needs to be saved, False otherwise.
     """
-    command_attr = '%s_command' % command_type
     request_attr = '%s_request' % command_type
     response_attr = '%s_response' % command_type
     sub_device_attr = '%s_sub_device_range' % command_type
 
+    # The Command has already been copied into the PID by
+    # common.LookupPid(), so drop the reference, otherwise the migration would
+    # restore a command we've since removed.
+    migrated = False
+    if legacy_data.Exists(legacy_data.COMMANDS):
+      command_attr = '%s_command' % command_type
+      command_key = Pid.properties()[command_attr].get_value_for_datastore(
+          pid)
+      migrated = command_key is not None
+      if migrated:
+        setattr(pid, command_attr, None)
+        self._old_commands.append(command_key)
+
     # We assume the pull request validator has run and checked the consistency
     # of the PID data.
     has_command = (request_attr in new_pid_data and
                    response_attr in new_pid_data and
                    sub_device_attr in new_pid_data)
 
-    existing_command = getattr(pid, command_attr)
-    if existing_command and has_command:
+    if has_command:
+      new_values = [
+        (sub_device_attr, new_pid_data[sub_device_attr]),
+        (request_attr, common.EncodeMessage(new_pid_data[request_attr])),
+        (response_attr, common.EncodeMessage(new_pid_data[response_attr])),
+      ]
       save = False
-
-      if existing_command.sub_device_range != new_pid_data[sub_device_attr]:
-        existing_command.sub_device_range = new_pid_data[sub_device_attr]
-        save = True
-
-      request = new_pid_data.get(request_attr)
-      if eval(existing_command.request) != request:
-        existing_command.request = str(request)
-        save = True
-
-      response = new_pid_data.get(response_attr)
-      if eval(existing_command.response) != response:
-        existing_command.response = str(response)
-        save = True
+      for attr, value in new_values:
+        if getattr(pid, attr) != value:
+          setattr(pid, attr, value)
+          save = True
 
       if save:
-        existing_command.put()
-        logging.info('Updated existing %s:%s' %
-                     (new_pid_data['name'], command_type))
-      return save
+        logging.info('Set %s:%s' % (new_pid_data['name'], command_type))
+      return save or migrated
 
-    elif existing_command and not has_command:
+    elif pid.HasCommand(command_type):
       # remove the existing command
-      existing_command.delete()
-      setattr(pid, command_attr, None)
+      for attr in (sub_device_attr, request_attr, response_attr):
+        setattr(pid, attr, None)
       logging.info('Removed existing %s:%s' %
                    (command_type, new_pid_data['name']))
       return True
-
-    elif has_command:
-      command = Command(sub_device_range = new_pid_data[sub_device_attr],
-                        request = str(new_pid_data.get(request_attr)),
-                        response = str(new_pid_data.get(response_attr)))
-      command.put()
-      setattr(pid, command_attr, command)
-      logging.info('Set %s:%s' % 
-                   (command_type, new_pid_data['name']))
-      return True
     else:
-      return False
-
+      return migrated
 
   def UpdateIfRequired(self, new_pid_data, manufacturer_id = 0):
     """
@@ -125,9 +130,12 @@ class PidLoader():
     """
     manufacturer, pid = self.LookupPid(new_pid_data['value'], manufacturer_id)
     save = False
+    is_new = not pid
 
-    if not pid:
-      pid = Pid(manufacturer = manufacturer,
+    if is_new:
+      pid = Pid(key_name = Pid.KeyName(manufacturer.esta_id,
+                                        new_pid_data['value']),
+                manufacturer = manufacturer,
                 pid_id = new_pid_data['value'],
                 name = new_pid_data['name'])
 
@@ -143,11 +151,20 @@ class PidLoader():
       pid.draft = new_pid_data.get('draft', False)
       save = True
 
-    save |= self.UpdateCommand(pid, new_pid_data, 'discovery')
-    save |= self.UpdateCommand(pid, new_pid_data, 'get')
-    save |= self.UpdateCommand(pid, new_pid_data, 'set')
+    for command_type in Pid.COMMAND_TYPES:
+      save |= self.UpdateCommand(pid, new_pid_data, command_type)
 
     if save:
       logging.info('Updated %s' % new_pid_data['name'])
+      change_log.MarkModified(pid)
       pid.put()
+      db.delete(self._old_commands)
+      self._old_commands = []
+      pid_search.IndexPids([pid])
+      if is_new:
+        pid_index_builder.RecordPidAdded(pid)
+        self._facets.Adjust(facet_counts.MANUFACTURER_PIDS,
+                            manufacturer.esta_id, manufacturer.name, 1)
+        if manufacturer.esta_id != self.ESTA_ID:
+          self._added += 1
     return save
@@ -0,0 +1,205 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_proto.py
+# Copyright (C) 2012 Simon Newton
+# Load the PID definitions & encode them as a binary PidStore protobuf.
+#
+# The protobuf library isn't available on App Engine, so this writes the wire
+# format directly. The field numbers match Pids.proto from OLA.
+
+import common
+from model import *
+from utils import PrefetchReferences
+
+ESTA_ID = 0
+
+# wire types
+_VARINT = 0
+_LENGTH_DELIMITED = 2
+
+# FieldType enum
+FIELD_TYPES = {
+  'bool': 1,
+  'uint8': 2,
+  'uint16': 3,
+  'uint32': 4,
+  'string': 5,
+  'group': 6,
+  'int8': 7,
+  'int16': 8,
+  'int32': 9,
+  'ipv4': 10,
+  'uid': 11,
+  'mac': 12,
+}
+
+# sub device range stored in the datastore : SubDeviceRange enum
+SUB_DEVICE_RANGES = {
+  0: 1,  # ROOT_DEVICE
+  1: 2,  # ROOT_OR_ALL_SUBDEVICE
+  2: 3,  # ROOT_OR_SUBDEVICE
+  3: 4,  # ONLY_SUBDEVICES
+}
+
+# command type : (request, response, sub device range) field numbers in Pid
+COMMAND_FIELDS = {
+  'get': (3, 4, 7),
+  'set': (5, 6, 8),
+  'discovery': (9, 10, 11),
+}
+
+
+def LoadPids(pid_selection=''):
+  """Load the PIDs in a PidStore.
+
+  Args:
+    pid_selection: '' for all PIDs, or one of 'esta', 'esta-draft' or
+      'manufacturers'.
+
+  Returns:
+    A tuple in the form (esta_pids, manufacturer_pids) where
+    manufacturer_pids is a list of (manufacturer, pids) tuples. Everything is
+    sorted by id.
+  """
+  esta_manufacturer = common.GetManufacturer(ESTA_ID)
+  pids = Pid.all()
+
+  if pid_selection == 'esta':
+    pids.filter('draft =', False)
+    pids.filter('manufacturer = ', esta_manufacturer)
+  elif pid_selection == 'esta-draft':
+    pids.filter('draft =', True)
+    pids.filter('manufacturer = ', esta_manufacturer)
+  elif pid_selection == "manufacturers":
+    pids.filter('manufacturer != ', esta_manufacturer)
+
+  manufacturers = {}
+  esta_pids = []
+  pids = common.LoadLegacyCommands(list(pids))
+  for pid in PrefetchReferences(pids, Pid.manufacturer):
+    if pid.manufacturer.esta_id == ESTA_ID:
+      esta_pids.append(pid)
+    else:
+      #Build the hash of manufacturer pids by manufacturer
+      manufacturers.setdefault(pid.manufacturer.esta_id, []).append(pid)
+
+  esta_pids.sort(key=lambda p: p.pid_id)
+  manufacturer_pids = []
+  for manufacturer_id in sorted(manufacturers):
+    pids = manufacturers[manufacturer_id]
+    pids.sort(key=lambda p: p.pid_id)
+    manufacturer_pids.append((pids[0].manufacturer, pids))
+  return esta_pids, manufacturer_pids
+
+
+def _Varint(value):
+  """Encode an int as a varint, negative values take 10 bytes."""
+  if value < 0:
+    value += 1 << 64
+  output = []
+  while value > 0x7f:
+    output.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  output.append(chr(value))
+  return ''.join(output)
+
+
+def _VarintField(field_number, value):
+  return _Varint(field_number << 3 | _VARINT) + _Varint(value)
+
+
+def _SignedField(field_number, value):
+  """Encode a sint32 field."""
+  return _VarintField(field_number, (value << 1) ^ (value >> 31))
+
+
+def _BytesField(field_number, data):
+  """Encode a string or a sub message."""
+  if isinstance(data, unicode):
+    data = data.encode('utf-8')
+  return (_Varint(field_number << 3 | _LENGTH_DELIMITED) +
+          _Varint(len(data)) + data)
+
+
+def _EncodeField(item):
+  """Encode a Field message from the dict returned by DecodeMessage."""
+  output = [
+    _VarintField(1, FIELD_TYPES[item['type']]),
+    _BytesField(2, item['name']),
+  ]
+  if 'min_size' in item:
+    output.append(_VarintField(3, item['min_size']))
+  if 'max_size' in item:
+    output.append(_VarintField(4, item['max_size']))
+  if 'multiplier' in item:
+    output.append(_SignedField(5, item['multiplier']))
+  for value, label in item.get('labels', []):
+    output.append(_BytesField(
+        6, _VarintField(1, value) + _BytesField(2, label)))
+  for min_value, max_value in item.get('range', []):
+    output.append(_BytesField(
+        7, _VarintField(1, min_value) + _VarintField(2, max_value)))
+  if item['type'] == 'group':
+    for child_item in item['items']:
+      output.append(_BytesField(8, _EncodeField(child_item)))
+  return ''.join(output)
+
+
+def _EncodeMessage(key, message_str):
+  """Encode a Message from the JSON stored in a Pid."""
+  message = common.DecodeMessage(key, message_str)
+  return ''.join(_BytesField(1, _EncodeField(item))
+                 for item in message['items'])
+
+
+def _EncodePid(pid):
+  output = [
+    _BytesField(1, pid.name),
+    _VarintField(2, pid.pid_id),
+  ]
+  for command_type in Pid.COMMAND_TYPES:
+    if not pid.HasCommand(command_type):
+      continue
+    request_field, response_field, range_field = COMMAND_FIELDS[command_type]
+    output.append(_BytesField(request_field, _EncodeMessage(
+        pid.key(), getattr(pid, '%s_request' % command_type))))
+    output.append(_BytesField(response_field, _EncodeMessage(
+        pid.key(), getattr(pid, '%s_response' % command_type))))
+    output.append(_VarintField(range_field, SUB_DEVICE_RANGES[
+        getattr(pid, '%s_sub_device_range' % command_type)]))
+  return ''.join(output)
+
+
+def EncodePidStore(esta_pids, manufacturer_pids, version):
+  """Encode a PidStore message.
+
+  Args:
+    esta_pids: the output of LoadPids().
+    manufacturer_pids: the output of LoadPids().
+    version: the PID update time, as an int.
+
+  Returns:
+    The serialized PidStore.
+  """
+  output = [_BytesField(1, _EncodePid(pid)) for pid in esta_pids]
+  for manufacturer, pids in manufacturer_pids:
+    fields = [
+      _VarintField(1, manufacturer.esta_id),
+      _BytesField(2, manufacturer.name),
+    ]
+    fields.extend(_BytesField(3, _EncodePid(pid)) for pid in pids)
+    output.append(_BytesField(2, ''.join(fields)))
+  output.append(_VarintField(3, version))
+  return ''.join(output)
@@ -0,0 +1,114 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_search.py
+# Copyright (C) 2012 Simon Newton
+# Search PIDs by name, manufacturer name & notes.
+
+import logging
+import search_index
+import urllib
+from model import *
+from utils import PrefetchReferences
+from google.appengine.api import taskqueue
+
+KIND = 'pid'
+BATCH_SIZE = 100
+
+# field : weight
+NAME_WEIGHT = 4
+MANUFACTURER_WEIGHT = 2
+NOTES_WEIGHT = 1
+
+
+def IndexPids(pids):
+  """Update the search index for a list of PIDs."""
+  PrefetchReferences(pids, Pid.manufacturer)
+  search_index.Update(KIND, [
+      (pid.key(),
+       search_index.BuildTerms([pid.name, pid.manufacturer.name],
+                               [pid.notes]),
+       None)
+      for pid in pids])
+
+
+def ScheduleRebuild(cursor=None):
+  """Rebuild the index in the background, a batch of PIDs per task."""
+  params = {'kind': KIND}
+  if cursor:
+    params['cursor'] = cursor
+  url = '/tasks/build_search_index?%s' % urllib.urlencode(params)
+  task = taskqueue.Task(method='GET', url=url)
+  task.add()
+
+
+def RebuildBatch(cursor=None):
+  """Index a batch of PIDs.
+
+  Returns:
+    The cursor to continue from, or None once all PIDs have been indexed.
+  """
+  query = Pid.all()
+  if cursor:
+    query.with_cursor(cursor)
+  pids = query.fetch(BATCH_SIZE)
+  IndexPids(pids)
+  logging.info('Indexed %d PIDs' % len(pids))
+  if len(pids) == BATCH_SIZE:
+    return query.cursor()
+  return None
+
+
+def Search(query_string, limit, include_drafts=False):
+  """Search for PIDs.
+
+  Args:
+    query_string: the text the user entered.
+    limit: the maximum number of PIDs to return.
+    include_drafts: if True, include draft PIDs.
+
+  Returns:
+    A list of Pid entities, best match first.
+  """
+  keys = search_index.Search(KIND, query_string)
+  pids = [p for p in db.get(keys)
+          if p is not None and (include_drafts or not p.draft)]
+  PrefetchReferences(pids, Pid.manufacturer)
+
+  results = []
+  for pid in pids:
+    score = search_index.Score(query_string, [
+        (pid.name, NAME_WEIGHT),
+        (pid.manufacturer.name, MANUFACTURER_WEIGHT),
+        (pid.notes, NOTES_WEIGHT),
+    ])
+    if score:
+      results.append((-score, len(pid.name), pid.pid_id, pid))
+  results.sort()
+  if not results:
+    return _SearchByExactName(query_string, limit, include_drafts)
+  return [r[-1] for r in results[:limit]]
+
+
+def _SearchByExactName(query_string, limit, include_drafts):
+  """Find PIDs with exactly this name.
+
+  This covers the PIDs which haven't been indexed, i.e. before the index has
+  been built.
+  """
+  query = Pid.all()
+  if not include_drafts:
+    query.filter('draft = ', False)
+  query.filter('name = ', query_string.strip().replace(' ', '_').upper())
+  return PrefetchReferences(query.fetch(limit), Pid.manufacturer)
@@ -0,0 +1,159 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_support.py
+# Copyright (C) 2012 Simon Newton
+# The lists of responders which support each PID, sorted by name.
+
+import struct
+from model import *
+
+# The maximum number of responders in each shard.
+SHARD_SIZE = 1000
+
+# Each responder is stored as the manufacturer id, device model id & the
+# length of the name, followed by the UTF-8 encoded name.
+_ENTRY_FORMAT = '>HHH'
+_ENTRY_SIZE = struct.calcsize(_ENTRY_FORMAT)
+
+
+def Encode(entries):
+  """Pack a list of (name, manufacturer_id, device_model_id) tuples."""
+  data = []
+  for name, manufacturer_id, device_model_id in entries:
+    name = name.encode('utf-8')
+    data.append(struct.pack(_ENTRY_FORMAT, manufacturer_id, device_model_id,
+                            len(name)))
+    data.append(name)
+  return ''.join(data)
+
+
+def Decode(data):
+  """Unpack a list of (name, manufacturer_id, device_model_id) tuples."""
+  entries = []
+  offset = 0
+  while data and offset < len(data):
+    manufacturer_id, device_model_id, length = struct.unpack_from(
+        _ENTRY_FORMAT, data, offset)
+    offset += _ENTRY_SIZE
+    entries.append((data[offset:offset + length].decode('utf-8'),
+                    manufacturer_id, device_model_id))
+    offset += length
+  return entries
+
+
+def ResponderKey(entry):
+  """Return the Responder key for an entry."""
+  return db.Key.from_path('Responder', Responder.KeyName(*entry[1:]))
+
+
+def _ShardKeyName(shard_number):
+  return 's:%d' % shard_number
+
+
+def _ShardNumber(shard):
+  return int(shard.key().name()[2:])
+
+
+def GetPage(pid_key, offset, limit):
+  """Get a page of the responders which support a PID.
+
+  The entries are sorted by name across the shards and every shard but the
+  last is kept full, see Update(), so only the shards that hold the page, and
+  the last one for the count, are read.
+
+  Args:
+    pid_key: the key of the Pid entity.
+    offset: the index of the first responder to return.
+    limit: the maximum number of responders to return.
+
+  Returns:
+    A tuple in the form (total, entries), where entries is a list of
+    (name, manufacturer_id, device_model_id) tuples.
+  """
+  query = PidSupportShard.all(keys_only=True)
+  query.ancestor(pid_key)
+  shard_count = len(query.fetch(None))
+  if not shard_count:
+    return 0, []
+
+  last_shard = shard_count - 1
+  first = min(offset // SHARD_SIZE, last_shard)
+  last = min((offset + limit - 1) // SHARD_SIZE, last_shard)
+  numbers = sorted(set(range(first, last + 1) + [last_shard]))
+  shards = db.get([db.Key.from_path('PidSupportShard', _ShardKeyName(n),
+                                    parent=pid_key)
+                   for n in numbers])
+  entries_by_shard = dict(
+      (n, Decode(shard.entries)) for n, shard in zip(numbers, shards)
+      if shard is not None)
+
+  total = last_shard * SHARD_SIZE + len(entries_by_shard.get(last_shard, []))
+  entries = []
+  for n in xrange(first, last + 1):
+    entries.extend(entries_by_shard.get(n, []))
+  start = offset - first * SHARD_SIZE
+  return total, entries[start:start + limit]
+
+
+def Update(pid_key, additions, removals):
+  """Transactionally update the responders which support a PID.
+
+  The list is re-sorted and split into full shards, with the remainder in the
+  last one. Only the shards whose content changed are written.
+
+  Args:
+    pid_key: the key of the Pid entity.
+    additions: a set of (name, manufacturer_id, device_model_id) tuples to
+      add, these replace any existing entry for the responder, i.e. if it was
+      renamed.
+    removals: a set of (manufacturer_id, device_model_id) tuples to remove.
+
+  Returns:
+    True if the list changed, False otherwise.
+  """
+  def Txn():
+    query = PidSupportShard.all()
+    query.ancestor(pid_key)
+    shards = sorted(query.fetch(None), key=_ShardNumber)
+
+    replaced = set(removals) | set(entry[1:] for entry in additions)
+    entries = []
+    for shard in shards:
+      entries.extend(e for e in Decode(shard.entries) if e[1:] not in replaced)
+    entries.extend(additions)
+    entries.sort()
+
+    to_put = []
+    for shard_number, start in enumerate(xrange(0, len(entries), SHARD_SIZE)):
+      data = db.Blob(Encode(entries[start:start + SHARD_SIZE]))
+      if shard_number < len(shards):
+        shard = shards[shard_number]
+        if shard.entries == data:
+          continue
+        shard.entries = data
+      else:
+        shard = PidSupportShard(parent=pid_key,
+                                key_name=_ShardKeyName(shard_number),
+                                entries=data)
+      to_put.append(shard)
+    # the shards that are no longer needed
+    shard_count = (len(entries) + SHARD_SIZE - 1) // SHARD_SIZE
+    to_delete = [old.key() for old in shards[shard_count:]]
+
+    db.put(to_put)
+    db.delete(to_delete)
+    return bool(to_put or to_delete)
+
+  return db.run_in_transaction(Txn)
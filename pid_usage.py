@@ -0,0 +1,120 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# pid_usage.py
+# Copyright (C) 2012 Simon Newton
+# Statistics on which PIDs the responders support.
+
+import common
+import json
+import logging
+import memcache_keys
+from model import *
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+ESTA_ID = 0
+DOCUMENT_NAME = 'pid_usage'
+
+
+def _BuildStatistics():
+  """Walk all the responders and count the PIDs they support.
+
+  Returns:
+    The statistics, as a JSON string.
+  """
+  param_counts = {}
+  responders = 0
+  max_manufacturer_pids = 0
+  max_manufacturer_responder = ''
+  max_pids = 0
+  max_pids_responder = ''
+  for responder in Responder.all():
+    common.LoadLatestSoftware([responder])
+    params = responder.latest_supported_parameters
+    manufacturer_pids = 0
+    for param in params:
+      param_counts.setdefault(param, 0)
+      param_counts[param] += 1
+      if param >= 0x8000:
+        manufacturer_pids += 1
+    if params:
+      responders += 1
+    if manufacturer_pids > max_manufacturer_pids:
+      max_manufacturer_responder = responder.model_description
+      max_manufacturer_pids = manufacturer_pids
+    if len(params) > max_pids:
+      max_pids_responder = responder.model_description
+      max_pids = len(params)
+
+  pid_names = common.GetPidNames()
+  pids = []
+  for param, count in param_counts.iteritems():
+    param_info = {
+      'id': param,
+      'count': count,
+    }
+    if param < 0x8000:
+      name = pid_names.get((ESTA_ID, param))
+      if name is not None:
+        param_info['name'] = name
+    pids.append(param_info)
+
+  output = {
+      'count': responders,
+      'max_manufacturer_pids': (max_manufacturer_responder,
+                                max_manufacturer_pids),
+      'max_pids': (max_pids_responder, max_pids),
+      'pids': pids,
+  }
+  return json.dumps(output)
+
+
+def Build():
+  """Rebuild the statistics and store them.
+
+  Returns:
+    The PrecomputedDocument entity.
+  """
+  document = PrecomputedDocument(key_name=DOCUMENT_NAME,
+                                 content=_BuildStatistics())
+  document.put()
+  logging.info('Built PID usage statistics')
+  memcache.set(memcache_keys.PID_USAGE,
+               (document.build_time, document.content))
+  return document
+
+
+def ScheduleBuild():
+  """Rebuild the statistics in the background."""
+  task = taskqueue.Task(method='GET', url='/tasks/build_pid_usage')
+  task.add()
+
+
+def Get():
+  """Get the PID usage statistics.
+
+  Returns:
+    A tuple in the form (build_time, JSON string).
+  """
+  output = memcache.get(memcache_keys.PID_USAGE)
+  if output is None:
+    document = PrecomputedDocument.get_by_key_name(DOCUMENT_NAME)
+    if document is None:
+      # only happens the first time
+      document = Build()
+    output = (document.build_time, document.content)
+    if not memcache.add(memcache_keys.PID_USAGE, output):
+      logging.error("Memcache set failed.")
+  return output
@@ -21,7 +21,7 @@ import logging
 import memcache_keys
 import re
 from model import *
-from utils import StringToInt
+from utils import PrefetchReferences, StringToInt
 from google.appengine.api import images
 from google.appengine.api import memcache
 from google.appengine.ext import webapp
@@ -39,32 +39,32 @@ class BrowseProducts(common.BasePageHandler):
   COLUMNS = 4
   RESULTS_PER_PAGE = ROWS * COLUMNS
 
-  def GetAll(self, page):
+  def GetAll(self, page, cursor):
     """
     Returns:
-      count, products
+      count, products, next_cursor
     """
     query = self.ProductType().all()
     query.order('-image_url')
-    total = query.count()
-    products = query.fetch(limit=self.RESULTS_PER_PAGE,
-                           offset=page * self.RESULTS_PER_PAGE)
-    return total, products
+    return common.FetchPage(
+        query, 'products:%s' % self.ProductType().class_name(), page,
+        self.RESULTS_PER_PAGE, cursor)
 
-  def FilterByTag(self, page, tag):
+  def FilterByTag(self, page, tag, cursor):
     query = ProductTag.all()
     query.filter('label = ', tag)
     query.filter('product_type = ', self.ProductType().class_name())
     tags = query.fetch(1)
 
     if not tags:
-      return 0, []
+      return 0, [], None
 
     query = tags[0].product_set
-    total = query.count()
-    tag_relationships = query.fetch(limit=self.RESULTS_PER_PAGE,
-                                     offset=page * self.RESULTS_PER_PAGE)
-    return total, [r.product for r in tag_relationships]
+    total, tag_relationships, next_cursor = common.FetchPage(
+        query, 'product_tag:%s' % tags[0].key(), page, self.RESULTS_PER_PAGE,
+        cursor)
+    PrefetchReferences(tag_relationships, ProductTagRelationship.product)
+    return total, [r.product for r in tag_relationships], next_cursor
 
   def FilterByManufacturer(self, page, manufacturer):
     manufacturer_id = StringToInt(manufacturer)
@@ -92,16 +92,18 @@ class BrowseProducts(common.BasePageHandler):
 
     total = 0
     products = []
+    next_cursor = None
+    cursor = self.request.get('cursor')
     tag = self.request.get('tag')
     manufacturer = self.request.get('manufacturer');
     if tag:
       data['tag'] = tag
-      total, products = self.FilterByTag(page, tag)
+      total, products, next_cursor = self.FilterByTag(page, tag, cursor)
     elif manufacturer:
       data['manufacturer'] = manufacturer
       total, products = self.FilterByManufacturer(page, manufacturer)
     else:
-      total, products = self.GetAll(page)
+      total, products, next_cursor = self.GetAll(page, cursor)
 
     data['total'] = total
     rows = []
@@ -132,6 +134,8 @@ class BrowseProducts(common.BasePageHandler):
       data['previous'] = page
     if start + len(products) < total:
       data['next'] = page + 2
+      if next_cursor:
+        data['next_cursor'] = next_cursor
     return data
 
 
@@ -16,7 +16,9 @@
 # Copyright (C) 2012 Simon Newton
 # Loads product data
 
+import change_log
 import common
+import facet_counts
 import logging
 from model import *
 
@@ -30,6 +32,9 @@ class ProductLoader(object):
     self._manufacturers = {}
     # string to ProductTag objects
     self._tags = {}
+    self._facets = facet_counts.FacetUpdater()
+    self._manufacturer_facet, self._tag_facet = (
+        facet_counts.PRODUCT_FACETS[product_type.class_name()])
 
   def _LookupManufacturer(self, manufacturer_id):
     """Lookup a Manufacturer entity by id and cache the result.
@@ -101,6 +106,7 @@ class ProductLoader(object):
       modified = True
 
     if modified:
+      change_log.MarkModified(product)
       product.put()
     return modified
 
@@ -126,9 +132,16 @@ class ProductLoader(object):
     if image_url:
       product.image_url = image_url
 
+    change_log.MarkModified(product)
     product.put()
+    self._facets.Adjust(self._manufacturer_facet, manufacturer.esta_id,
+                        manufacturer.name, 1)
     return product
 
+  def _AdjustTag(self, tag, delta):
+    self._facets.Adjust(self._tag_facet, tag.label, tag.label, delta,
+                        tag.exclude_from_search)
+
   def _UpdateTags(self, product, new_tags):
     """Update the tags for a product
 
@@ -148,6 +161,7 @@ class ProductLoader(object):
         new_tags.remove(label)
       else:
         logging.info('Deleting %s from %s' % (label, product.name))
+        self._AdjustTag(relationship.tag, -1)
         relationship.delete()
         modified = True
 
@@ -157,6 +171,7 @@ class ProductLoader(object):
           tag = tag_entity,
           product = product)
       relationship.put()
+      self._AdjustTag(tag_entity, 1)
       modified = True
 
     return modified
@@ -205,4 +220,5 @@ class ProductLoader(object):
         elif was_modified:
           updated.append(name)
 
+    self._facets.Apply()
     return added, updated
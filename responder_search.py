@@ -0,0 +1,149 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# responder_search.py
+# Copyright (C) 2012 Simon Newton
+# Search responders by name, manufacturer name, tags & personalities.
+
+import common
+import logging
+import memcache_keys
+import search_index
+import timestamp_keys
+import urllib
+from model import *
+from utils import PrefetchReferences, TimestampToInt
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+
+KIND = 'responder'
+BATCH_SIZE = 20
+
+# field : weight
+NAME_WEIGHT = 4
+MANUFACTURER_WEIGHT = 2
+# tags & personalities
+EXTRA_WEIGHT = 1
+
+
+def IndexResponders(responders):
+  """Update the search index for a list of responders."""
+  PrefetchReferences(responders, Responder.manufacturer)
+  entries = []
+  for responder in responders:
+    tags = [r.tag.label for r in PrefetchReferences(
+        list(responder.tag_set), ResponderTagRelationship.tag)]
+    personalities = []
+    for version in responder.software_version_set:
+      personalities.extend(p.description for p in version.personality_set
+                           if p.description)
+
+    terms = search_index.BuildTerms(
+        [responder.model_description, responder.manufacturer.name] + tags,
+        personalities)
+    entries.append((responder.key(), terms,
+                    ' '.join(sorted(set(tags + personalities)))))
+  search_index.Update(KIND, entries)
+
+
+def ScheduleRebuild(cursor=None):
+  """Rebuild the index in the background, a batch of responders per task."""
+  params = {'kind': KIND}
+  if cursor:
+    params['cursor'] = cursor
+  url = '/tasks/build_search_index?%s' % urllib.urlencode(params)
+  task = taskqueue.Task(method='GET', url=url)
+  task.add()
+
+
+def RebuildBatch(cursor=None):
+  """Index a batch of responders.
+
+  Returns:
+    The cursor to continue from, or None once all responders have been
+    indexed.
+  """
+  query = Responder.all()
+  if cursor:
+    query.with_cursor(cursor)
+  responders = query.fetch(BATCH_SIZE)
+  IndexResponders(responders)
+  logging.info('Indexed %d responders' % len(responders))
+  if len(responders) == BATCH_SIZE:
+    return query.cursor()
+  return None
+
+
+def _Rank(query_string):
+  """Find & rank the responders which match a query.
+
+  Returns:
+    A tuple in the form (results, capped), see Search().
+  """
+  entries = search_index.Search(KIND, query_string, keys_only=False)
+  capped = len(entries) >= search_index.MAX_CANDIDATES
+  responders = db.get([entry.parent_key() for entry in entries])
+  PrefetchReferences([r for r in responders if r is not None],
+                     Responder.manufacturer)
+
+  results = []
+  for entry, responder in zip(entries, responders):
+    if responder is None:
+      continue
+    score = search_index.Score(query_string, [
+        (responder.model_description, NAME_WEIGHT),
+        (responder.manufacturer.name, MANUFACTURER_WEIGHT),
+        (entry.text, EXTRA_WEIGHT),
+    ])
+    if score:
+      results.append((-score, -(responder.score or 0), {
+        'manufacturer': {
+          'esta_id': responder.manufacturer.esta_id,
+          'name': responder.manufacturer.name,
+        },
+        'device_model_id': responder.device_model_id,
+        'model_description': responder.model_description,
+      }))
+  results.sort(key=lambda r: r[:2])
+  return [r[-1] for r in results], capped
+
+
+def Search(query_string):
+  """Search for responders.
+
+  The ranked results are cached until the devices are next updated, so
+  paging through them is cheap.
+
+  Args:
+    query_string: the text the user entered.
+
+  Returns:
+    A tuple in the form (results, capped). results is a list of dicts, best
+    match first, each one has manufacturer (esta_id & name), device_model_id
+    and model_description. capped is True if there were more candidates than
+    search_index.MAX_CANDIDATES, in which case only the best matches are
+    returned and the total isn't known.
+  """
+  query_string = query_string.strip().lower()
+  update_time = common.GetUpdateTimes().get(timestamp_keys.DEVICES)
+  version = 0
+  if update_time is not None:
+    version = '%d%06d' % (TimestampToInt(update_time), update_time.microsecond)
+  cache_key = '%s:%s:%s' % (memcache_keys.RESPONDER_SEARCH_PREFIX, version,
+                            query_string)
+  output = memcache.get(cache_key)
+  if output is None:
+    output = _Rank(query_string)
+    memcache.set(cache_key, output)
+  return output
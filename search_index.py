@@ -0,0 +1,235 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# search_index.py
+# Copyright (C) 2012 Simon Newton
+# A token & n-gram index for searching entities by name.
+#
+# Each indexed entity has a SearchIndexEntry child, which lists the terms for
+# the entity. Names are indexed by each whole token, each token prefix of up to
+# MAX_PREFIX characters and every substring of up to MAX_NGRAM characters of
+# each token, so a query token of up to MAX_NGRAM characters is a single term,
+# and a longer one is a set of its n-grams. Longer texts, like the notes, are
+# indexed by whole words, which share a term class with the name prefixes. A
+# search is a query with an equality filter for each term, the candidates are
+# then ranked in memory.
+#
+# Short queries can match more entities than we're willing to rank, so the
+# candidates are gathered best match first: whole tokens, then name prefixes
+# or words of the texts, and finally substrings. Since the prefixes & words
+# share a term class, a query can match some tokens in the name and others in
+# the texts.
+
+import re
+from model import *
+
+MAX_NGRAM = 3
+
+# the longest token prefix that's indexed
+MAX_PREFIX = 8
+
+# the maximum number of whole words indexed per entity, each one is indexed
+# by its first MAX_PREFIX characters
+MAX_WORDS = 200
+
+# the maximum number of terms in a query
+MAX_QUERY_TERMS = 8
+
+# the maximum number of candidates to rank
+MAX_CANDIDATES = 200
+
+_TOKEN_PREFIX = 't:'
+# a name token prefix, or a word of the texts
+_START_PREFIX = 'p:'
+
+# match quality : score
+EXACT_MATCH = 3
+PREFIX_MATCH = 2
+SUBSTRING_MATCH = 1
+
+
+def Tokenize(text):
+  """Split text into lower case tokens, underscores are separators."""
+  if not text:
+    return []
+  return re.findall('[a-z0-9]+', text.lower())
+
+
+def _NGrams(token):
+  ngrams = set()
+  for length in xrange(1, MAX_NGRAM + 1):
+    for start in xrange(0, len(token) - length + 1):
+      ngrams.add(token[start:start + length])
+  return ngrams
+
+
+def BuildTerms(names, texts=()):
+  """Build the terms for an entity.
+
+  Args:
+    names: a list of strings to index by n-gram, i.e. the name.
+    texts: a list of strings to index by whole word, i.e. the notes.
+
+  Returns:
+    A sorted list of terms.
+  """
+  terms = set()
+  for name in names:
+    for token in Tokenize(name):
+      terms.update(_NGrams(token))
+      terms.add(_TOKEN_PREFIX + token)
+      terms.update(_START_PREFIX + token[:length]
+                   for length in xrange(1, min(len(token), MAX_PREFIX) + 1))
+
+  words = set()
+  for text in texts:
+    words.update(Tokenize(text))
+  terms.update(_START_PREFIX + w[:MAX_PREFIX]
+               for w in sorted(words)[:MAX_WORDS])
+  return sorted(terms)
+
+
+def EntryKey(kind, key):
+  """Return the key of the SearchIndexEntry for an entity."""
+  return db.Key.from_path('SearchIndexEntry', kind, parent=key)
+
+
+def Update(kind, entries):
+  """Update the index entries for a set of entities.
+
+  Only entries with new terms are written.
+
+  Args:
+    kind: the type of entity, i.e. 'pid'.
+    entries: a list of (entity key, terms, text) tuples. The text is stored
+      for ranking and may be None.
+  """
+  keys = [EntryKey(kind, key) for key, terms, text in entries]
+  modified = []
+  for (key, terms, text), entry in zip(entries, db.get(keys)):
+    if entry is not None and entry.terms == terms and entry.text == text:
+      continue
+    modified.append(SearchIndexEntry(parent=key, key_name=kind, kind=kind,
+                                     terms=terms, text=text))
+  db.put(modified)
+
+
+def Remove(kind):
+  """Remove all the entries of a kind."""
+  query = SearchIndexEntry.all(keys_only=True)
+  query.filter('kind = ', kind)
+  db.delete(query.fetch(None))
+
+
+def _QueryTerms(tokens):
+  """Return the terms which match names containing all of the tokens."""
+  terms = set()
+  for token in tokens:
+    if len(token) <= MAX_NGRAM:
+      terms.add(token)
+    else:
+      # non-overlapping n-grams, plus one for the end of the token
+      for start in xrange(0, len(token) - MAX_NGRAM + 1, MAX_NGRAM):
+        terms.add(token[start:start + MAX_NGRAM])
+      terms.add(token[-MAX_NGRAM:])
+  # the longest terms are the most selective
+  return sorted(terms, key=len, reverse=True)[:MAX_QUERY_TERMS]
+
+
+def _Lookup(kind, terms, limit, keys_only):
+  query = SearchIndexEntry.all(keys_only=keys_only)
+  query.filter('kind = ', kind)
+  for term in terms:
+    query.filter('terms = ', term)
+  return query.fetch(limit)
+
+
+def Search(kind, query_string, limit=MAX_CANDIDATES, keys_only=True):
+  """Find the entities which may match a query.
+
+  The candidates are gathered best match first, so if there are more than
+  limit, it's the weakest matches that are dropped.
+
+  Args:
+    kind: the type of entity, i.e. 'pid'.
+    query_string: the text the user entered.
+    limit: the maximum number of candidates to return.
+    keys_only: if False, return the SearchIndexEntry entities, for the text.
+
+  Returns:
+    A list of entity keys, or SearchIndexEntry entities. The entities need to
+    be ranked, which also removes the false positives.
+  """
+  tokens = Tokenize(query_string)
+  if not tokens:
+    return []
+
+  def Key(result):
+    if keys_only:
+      return result
+    return result.key()
+
+  tiers = [
+    set(_TOKEN_PREFIX + t for t in tokens),
+    set(_START_PREFIX + t[:MAX_PREFIX] for t in tokens),
+    _QueryTerms(tokens),
+  ]
+  results = []
+  seen = set()
+  for terms in tiers:
+    if len(results) >= limit:
+      break
+    terms = sorted(terms, key=len, reverse=True)[:MAX_QUERY_TERMS]
+    for result in _Lookup(kind, terms, limit, keys_only):
+      if Key(result) not in seen and len(results) < limit:
+        seen.add(Key(result))
+        results.append(result)
+
+  if keys_only:
+    return [key.parent() for key in results]
+  return results
+
+
+def _MatchQuality(query_token, tokens):
+  """Return the best match of a query token against a list of tokens."""
+  best = 0
+  for token in tokens:
+    if token == query_token:
+      return EXACT_MATCH
+    elif token.startswith(query_token):
+      best = max(best, PREFIX_MATCH)
+    elif query_token in token:
+      best = max(best, SUBSTRING_MATCH)
+  return best
+
+
+def Score(query_string, fields):
+  """Score an entity against a query.
+
+  Args:
+    query_string: the text the user entered.
+    fields: a list of (text, weight) tuples.
+
+  Returns:
+    The score, or 0 if one of the query tokens doesn't match any field.
+  """
+  field_tokens = [(Tokenize(text), weight) for text, weight in fields]
+  score = 0
+  for query_token in Tokenize(query_string):
+    token_score = max([weight * _MatchQuality(query_token, tokens)
+                       for tokens, weight in field_tokens] + [0])
+    if not token_score:
+      return 0
+    score += token_score
+  return score
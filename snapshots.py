@@ -0,0 +1,246 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# snapshots.py
+# Copyright (C) 2012 Simon Newton
+# Pre-generated copies of the exports, stored in the blobstore, and gzip
+# negotiation for the export responses.
+
+import common
+import gzip
+import logging
+import memcache_keys
+import timestamp_keys
+import urllib
+from cStringIO import StringIO
+from model import *
+from utils import TimestampToInt
+from google.appengine.api import files
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import blobstore
+
+DOWNLOAD = 'download'
+EXPORT_CONTROLLERS = 'export_controllers'
+EXPORT_MODELS = 'export_models'
+MODEL_INFO = 'model_info'
+
+# snapshot name : the timestamps the export is built from
+SNAPSHOTS = {
+  DOWNLOAD: [timestamp_keys.MANUFACTURERS, timestamp_keys.PIDS],
+  EXPORT_CONTROLLERS: [timestamp_keys.CONTROLLERS,
+                       timestamp_keys.MANUFACTURERS],
+  EXPORT_MODELS: [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS],
+  MODEL_INFO: [timestamp_keys.DEVICES, timestamp_keys.MANUFACTURERS],
+}
+
+# the size of the blobstore reads & writes
+CHUNK_SIZE = 512 * 1024
+
+# the largest value we'll try to store in memcache
+MEMCACHE_LIMIT = 1000000
+
+# the headers which are cached along with a response body
+CACHED_HEADERS = ['Content-Type', 'X-Next-Cursor']
+
+
+def Version(name):
+  """Return the version of the data a snapshot would be built from.
+
+  This includes the microseconds, so two updates in the same second give
+  different versions, and so different build task names.
+  """
+  update_times = common.GetUpdateTimes()
+  timestamps = []
+  for timestamp_name in SNAPSHOTS[name]:
+    update_time = update_times.get(timestamp_name)
+    if update_time is None:
+      timestamps.append('0')
+    else:
+      timestamps.append('%d%06d' % (TimestampToInt(update_time),
+                                    update_time.microsecond))
+  return '-'.join(timestamps)
+
+
+def ScheduleBuild(name):
+  """Build a snapshot in the background.
+
+  The task is named after the data version, so a build is only scheduled once
+  for each version.
+  """
+  url = '/tasks/build_snapshot?%s' % urllib.urlencode({'name': name})
+  task = taskqueue.Task(method='GET', url=url,
+                        name='snapshot-%s-%s' % (name.replace('_', '-'),
+                                                 Version(name)))
+  try:
+    task.add()
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def ScheduleBuilds(timestamp_name):
+  """Rebuild the snapshots which depend on a section of the index."""
+  for name, timestamp_names in SNAPSHOTS.iteritems():
+    if timestamp_name in timestamp_names:
+      ScheduleBuild(name)
+
+
+def _WriteBlob(content, mime_type):
+  """Write a string to the blobstore.
+
+  Returns:
+    The BlobKey.
+  """
+  file_name = files.blobstore.create(mime_type=mime_type)
+  with files.open(file_name, 'a') as f:
+    for offset in xrange(0, len(content), CHUNK_SIZE):
+      f.write(content[offset:offset + CHUNK_SIZE])
+  files.finalize(file_name)
+  return files.blobstore.get_blob_key(file_name)
+
+
+def _Compress(content):
+  """Gzip a string."""
+  buf = StringIO()
+  gzip_file = gzip.GzipFile(fileobj=buf, mode='wb')
+  gzip_file.write(content)
+  gzip_file.close()
+  return buf.getvalue()
+
+
+def Store(name, version, content_type, content):
+  """Store a new snapshot, replacing the existing one.
+
+  Args:
+    name: the name of the snapshot.
+    version: the version of the data the snapshot was built from.
+    content_type: the Content-Type to serve the snapshot with.
+    content: the output of the export.
+  """
+  old_snapshot = ExportSnapshot.get_by_key_name(name)
+  snapshot = ExportSnapshot(
+      key_name=name,
+      version=version,
+      content_type=content_type,
+      raw_data=_WriteBlob(content, content_type),
+      gzip_data=_WriteBlob(_Compress(content), 'application/x-gzip'))
+  snapshot.put()
+  logging.info('Stored %s snapshot, %d bytes' % (name, len(content)))
+
+  if old_snapshot is not None:
+    blobstore.delete([old_snapshot.raw_data.key(),
+                      old_snapshot.gzip_data.key()])
+
+
+def NegotiateGzip(handler):
+  """Check if a client will accept a gzip encoded response.
+
+  Since the response depends on the Accept-Encoding header, this also sets
+  the Vary header.
+
+  Returns:
+    True if the response can be gzipped.
+  """
+  handler.response.headers['Vary'] = 'Accept-Encoding'
+  accept_encoding = handler.request.headers.get('Accept-Encoding', '')
+  for coding in accept_encoding.split(','):
+    params = coding.split(';')
+    if params[0].strip().lower() not in ('gzip', 'x-gzip'):
+      continue
+    for param in params[1:]:
+      name, _, value = param.partition('=')
+      if name.strip() == 'q':
+        try:
+          return float(value) > 0
+        except ValueError:
+          return False
+    return True
+  return False
+
+
+def _CopyBlob(handler, blob_key):
+  """Copy a blob to the response."""
+  reader = blobstore.BlobReader(blob_key, buffer_size=CHUNK_SIZE)
+  data = reader.read(CHUNK_SIZE)
+  while data:
+    handler.response.out.write(data)
+    data = reader.read(CHUNK_SIZE)
+
+
+def Serve(handler, name, use_gzip=False):
+  """Write a snapshot to a response, if the snapshot is current.
+
+  Args:
+    handler: the webapp.RequestHandler.
+    name: the name of the snapshot.
+    use_gzip: if True, send the gzipped copy.
+
+  Returns:
+    True if the snapshot was served, False if the handler needs to build the
+    response itself.
+  """
+  snapshot = ExportSnapshot.get_by_key_name(name)
+  if snapshot is None or snapshot.version != Version(name):
+    ScheduleBuild(name)
+    return False
+
+  handler.response.headers['Content-Type'] = str(snapshot.content_type)
+  if use_gzip:
+    handler.response.headers['Content-Encoding'] = 'gzip'
+    _CopyBlob(handler, snapshot.gzip_data.key())
+  else:
+    _CopyBlob(handler, snapshot.raw_data.key())
+  return True
+
+
+def ServeCached(handler, name, generate, use_gzip=False):
+  """Serve an export which isn't snapshotted, i.e. one with query parameters.
+
+  The raw & gzipped bodies are cached in memcache against the data version,
+  so repeat requests don't rebuild or recompress the output.
+
+  Args:
+    handler: the webapp.RequestHandler.
+    name: the name of the export, one of SNAPSHOTS.
+    generate: called to write the output to the handler's response if it's
+      not in the cache.
+    use_gzip: if True, send the gzipped body.
+  """
+  cache_key = '%s:%s?%s:%s' % (memcache_keys.EXPORT_PREFIX, name,
+                               handler.request.query_string, Version(name))
+  cached = memcache.get(cache_key)
+  if cached is None:
+    generate()
+    if handler.response.status_int != 200:
+      return
+    raw = handler.response.body
+    headers = {}
+    for header in CACHED_HEADERS:
+      if header in handler.response.headers:
+        headers[header] = handler.response.headers[header]
+    cached = (headers, raw, _Compress(raw))
+    if len(raw) + len(cached[2]) < MEMCACHE_LIMIT:
+      if not memcache.set(cache_key, cached):
+        logging.error("Memcache set failed.")
+    if not use_gzip:
+      return
+
+  headers, raw, compressed = cached
+  for header, value in headers.iteritems():
+    handler.response.headers[header] = value
+  if use_gzip:
+    handler.response.headers['Content-Encoding'] = 'gzip'
+    handler.response.body = compressed
+  else:
+    handler.response.body = raw
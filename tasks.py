@@ -16,12 +16,25 @@
 # Copyright (C) 2011 Simon Newton
 # Defines the task queue handlers.
 
+import common
+import export
+import legacy_data
 import logging
+import page_cache
+import pid_index_builder
+import pid_search
+import pid_usage
+import responder_search
+import timestamp_keys
+import update_times
+import urllib
 from google.appengine.api import images
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
 from google.appengine.ext import webapp
 from image_fetcher import ImageFetcher
-from model import Controller, Product, Responder
-from pid_index_builder import PidIndexBuilder
+from key_migrator import KeyMigrator
+from model import Controller, Pid, Product, Responder
 
 
 class FetchResponderImage(webapp.RequestHandler):
@@ -40,6 +53,7 @@ class FetchResponderImage(webapp.RequestHandler):
         responder.image_data = blob_key
         responder.image_serving_url = images.get_serving_url(blob_key)
         responder.put()
+        page_cache.Invalidate()
     return
 
 
@@ -86,16 +100,172 @@ class RankDevices(webapp.RequestHandler):
 
       device.score = score
       device.put()
+    common.InvalidateBrowseData()
     return
 
 class BuildPidResponderIndex(webapp.RequestHandler):
   """Build the mappings between PIDs and the responders which support the
-     PID.
+     PID, one batch per task.
   """
   def get(self):
-    builder = PidIndexBuilder()
-    builder.BuildIndex()
-    return
+    builder = pid_index_builder.PidIndexBuilder()
+    stage, cursor = builder.RebuildBatch(self.request.get('stage') or None,
+                                         self.request.get('cursor') or None)
+    if stage is None:
+      logging.info('PID index build complete')
+      return
+
+    params = {'stage': stage}
+    if cursor:
+      params['cursor'] = cursor
+    url = '/tasks/build_pid_responder_index?%s' % urllib.urlencode(params)
+    task = taskqueue.Task(method='GET', url=url)
+    task.add()
+
+
+class UpdatePidIndex(webapp.RequestHandler):
+  """Update the PID index for the responders in the change log, one batch
+     per task.
+  """
+  def get(self):
+    builder = pid_index_builder.PidIndexBuilder()
+    if builder.ProcessChangeLog():
+      pid_index_builder.ScheduleUpdate()
+
+
+class BuildPidUsage(webapp.RequestHandler):
+  """Build the PID usage statistics."""
+  def get(self):
+    pid_usage.Build()
+
+
+class BuildSnapshot(webapp.RequestHandler):
+  """Build the stored copy of an export."""
+  def get(self):
+    name = self.request.get('name')
+    if name not in export.SNAPSHOT_HANDLERS:
+      logging.error('Unknown snapshot %s' % name)
+      return
+    export.BuildSnapshot(name)
+
+
+class BuildSearchIndex(webapp.RequestHandler):
+  """Rebuild a search index, one batch per task."""
+  # kind : module
+  INDEXES = {
+    pid_search.KIND: pid_search,
+    responder_search.KIND: responder_search,
+  }
+
+  def get(self):
+    index = self.INDEXES.get(self.request.get('kind'))
+    if index is None:
+      logging.error('Unknown search index %s' % self.request.get('kind'))
+      return
+
+    cursor = index.RebuildBatch(self.request.get('cursor') or None)
+    if cursor is None:
+      logging.info('Search index build complete')
+    else:
+      index.ScheduleRebuild(cursor)
+
+
+class MigrateEntityKeys(webapp.RequestHandler):
+  """Move entities onto deterministic key names, one batch per task."""
+  def get(self):
+    migrator = KeyMigrator()
+    stage, cursor = migrator.RunBatch(self.request.get('stage') or None,
+                                      self.request.get('cursor') or None)
+    if stage is None:
+      logging.info('Key migration complete')
+      return
+
+    params = {'stage': stage}
+    if cursor:
+      params['cursor'] = cursor
+    url = '/tasks/migrate_entity_keys?%s' % urllib.urlencode(params)
+    task = taskqueue.Task(method='GET', url=url)
+    task.add()
+
+
+class UpdateLatestSoftware(webapp.RequestHandler):
+  """Copy the latest software version details onto each Responder, one batch
+     per task.
+  """
+  BATCH_SIZE = 50
+
+  def get(self):
+    query = Responder.all()
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    responders = query.fetch(self.BATCH_SIZE)
+
+    modified = []
+    for responder in responders:
+      if common.SetLatestSoftware(responder, responder.software_version_set):
+        modified.append(responder)
+    db.put(modified)
+    for responder in modified:
+      pid_index_builder.RecordResponderChange(responder)
+    logging.info('Updated %d of %d responders' %
+                 (len(modified), len(responders)))
+
+    if len(responders) == self.BATCH_SIZE:
+      url = '/tasks/update_latest_software?%s' % urllib.urlencode(
+          {'cursor': query.cursor()})
+      task = taskqueue.Task(method='GET', url=url)
+      task.add()
+    else:
+      logging.info('Latest software update complete')
+      legacy_data.MarkComplete(legacy_data.LATEST_SOFTWARE)
+      pid_index_builder.ScheduleUpdate()
+
+
+class MigratePidCommands(webapp.RequestHandler):
+  """Move the Command entities into their Pid entities, one batch per task.
+  """
+  BATCH_SIZE = 50
+
+  def get(self):
+    if not legacy_data.Exists(legacy_data.COMMANDS):
+      logging.info('PID command migration has already completed')
+      return
+
+    query = Pid.all()
+    cursor = self.request.get('cursor')
+    if cursor:
+      query.with_cursor(cursor)
+    pids = query.fetch(self.BATCH_SIZE)
+
+    modified = []
+    commands_to_delete = []
+    for pid in common.LoadLegacyCommands(pids):
+      for command_type in Pid.COMMAND_TYPES:
+        command_attr = '%s_command' % command_type
+        command_key = Pid.properties()[command_attr].get_value_for_datastore(
+            pid)
+        if command_key is None:
+          continue
+        setattr(pid, command_attr, None)
+        commands_to_delete.append(command_key)
+        if pid not in modified:
+          modified.append(pid)
+
+    db.put(modified)
+    db.delete(commands_to_delete)
+    logging.info('Migrated %d of %d PIDs' % (len(modified), len(pids)))
+
+    if len(pids) == self.BATCH_SIZE:
+      url = '/tasks/migrate_pid_commands?%s' % urllib.urlencode(
+          {'cursor': query.cursor()})
+      task = taskqueue.Task(method='GET', url=url)
+      task.add()
+    else:
+      logging.info('PID command migration complete')
+      legacy_data.MarkComplete(legacy_data.COMMANDS)
+      # drop anything cached while the PIDs were being migrated
+      update_times.UpdateModificationTime(timestamp_keys.PIDS)
 
 
 tasks_application = webapp.WSGIApplication(
@@ -104,5 +274,12 @@ tasks_application = webapp.WSGIApplication(
     ('/tasks/fetch_product_image', FetchProductImage),
     ('/tasks/rank_devices', RankDevices),
     ('/tasks/build_pid_responder_index', BuildPidResponderIndex),
+    ('/tasks/build_pid_usage', BuildPidUsage),
+    ('/tasks/build_search_index', BuildSearchIndex),
+    ('/tasks/build_snapshot', BuildSnapshot),
+    ('/tasks/migrate_pid_commands', MigratePidCommands),
+    ('/tasks/migrate_entity_keys', MigrateEntityKeys),
+    ('/tasks/update_latest_software', UpdateLatestSoftware),
+    ('/tasks/update_pid_index', UpdatePidIndex),
   ],
   debug=True)
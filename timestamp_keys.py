@@ -23,3 +23,5 @@ NODES = 'nodes'
 PIDS = 'pids'
 SOFTWARE = 'software'
 SPLITTERS = 'splitters'
+
+ALL = [CONTROLLERS, DEVICES, MANUFACTURERS, NODES, PIDS, SOFTWARE, SPLITTERS]
@@ -0,0 +1,61 @@
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or
+#  (at your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful,
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#  GNU Library General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+#
+# update_times.py
+# Copyright (C) 2012 Simon Newton
+# Update the timestamps for each section of the index, and drop everything
+# that was built from the old data.
+
+import common
+import datetime
+import legacy_data
+import memcache_keys
+import page_cache
+import pid_index_builder
+import pid_usage
+import snapshots
+import timestamp_keys
+from google.appengine.api import memcache
+from model import *
+
+
+def UpdateModificationTime(timestamp_name):
+  """Update a particular timestamp."""
+  result = LastUpdateTime(key_name = timestamp_name, name = timestamp_name)
+  result.update_time = datetime.datetime.now()
+  result.put()
+
+  if legacy_data.Exists(legacy_data.KEYS):
+    query = LastUpdateTime.all()
+    query.filter('name = ', timestamp_name)
+    db.delete([old.key() for old in query if old.key() != result.key()])
+
+  if timestamp_name == timestamp_keys.MANUFACTURERS:
+    common.InvalidateReferenceData()
+  if timestamp_name in (timestamp_keys.DEVICES, timestamp_keys.PIDS):
+    # process the responder changes recorded by the loaders
+    pid_index_builder.ScheduleUpdate()
+    pid_usage.ScheduleBuild()
+
+  # Store the new times rather than deleting them, a query run now might
+  # not see the update yet.
+  common.BuildUpdateTimes()
+
+  # delete the index info cache & the rendered pages, which include it
+  memcache.delete(memcache_keys.INDEX_INFO)
+  page_cache.Invalidate()
+  common.InvalidateBrowseData()
+
+  # this needs the new update time, so it comes after BuildUpdateTimes()
+  snapshots.ScheduleBuilds(timestamp_name)
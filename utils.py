@@ -18,6 +18,8 @@
 
 import time
 import logging
+from google.appengine.api import memcache
+from google.appengine.ext import db
 
 def StringToInt(value, allow_hex = True):
   """Convert a string value to an int
@@ -55,3 +57,82 @@ def StringToInt(value, allow_hex = True):
 def TimestampToInt(timestamp):
   """Convert a DateTimeProperty to an int."""
   return int(time.mktime(timestamp.timetuple()))
+
+
+def GetGeneration(memcache_key):
+  """Get a cache generation number from memcache.
+
+  Generations are used to invalidate cached data on all instances at once. If
+  the generation has been evicted a new one is created, so anything cached
+  against the old generation is ignored.
+
+  Returns:
+    The current generation.
+  """
+  generation = memcache.get(memcache_key)
+  if generation is None:
+    memcache.add(memcache_key, int(time.time() * 1000))
+    generation = memcache.get(memcache_key)
+  return generation
+
+
+def IncrementGeneration(memcache_key):
+  """Move a cache generation number on, invalidating the data cached against
+     it.
+  """
+  if memcache.incr(memcache_key) is None:
+    memcache.set(memcache_key, int(time.time() * 1000))
+
+
+def PrefetchReferences(entities, *props):
+  """Resolve the ReferenceProperties of a list of entities with one batch get.
+
+  Once this returns, accessing entity.prop doesn't cause a datastore get.
+
+  Args:
+    entities: a list of entities.
+    props: the ReferenceProperties to resolve, e.g. Responder.manufacturer
+
+  Returns:
+    The list of entities.
+  """
+  fields = [(entity, prop) for entity in entities for prop in props]
+  ref_keys = [prop.get_value_for_datastore(entity) for entity, prop in fields]
+  unique_keys = list(set(key for key in ref_keys if key is not None))
+  ref_entities = dict((key, entity) for key, entity in
+                      zip(unique_keys, db.get(unique_keys))
+                      if entity is not None)
+  for (entity, prop), ref_key in zip(fields, ref_keys):
+    if ref_key in ref_entities:
+      prop.__set__(entity, ref_entities[ref_key])
+  return entities
+
+
+# The number of queries QueryByReference() runs at once.
+MAX_PARALLEL_QUERIES = 20
+
+
+def QueryByReference(prop, keys):
+  """Fetch the entities which refer to each of a list of keys.
+
+  This is one query per key. The queries are started MAX_PARALLEL_QUERIES at
+  a time, before any of their results are read, so each group runs in
+  parallel without having too many RPCs in flight.
+
+  Args:
+    prop: the ReferenceProperty to match, e.g. ResponderSensor.sw_version
+    keys: a list of db.Keys.
+
+  Returns:
+    A dict of key to the list of entities which refer to it.
+  """
+  results = {}
+  for i in xrange(0, len(keys), MAX_PARALLEL_QUERIES):
+    queries = []
+    for key in keys[i:i + MAX_PARALLEL_QUERIES]:
+      query = prop.model_class.all()
+      query.filter('%s = ' % prop.name, key)
+      queries.append((key, query.run()))
+    for key, entities in queries:
+      results[key] = list(entities)
+  return results